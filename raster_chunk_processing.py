@@ -50,20 +50,34 @@
 import numpy as np
 import datetime
 import os
+import sys
 import subprocess
 import contextlib
 import tempfile
+import shutil
 import warnings
 import csv
+import json
+import queue
 import argparse
+import importlib
 import traceback
 import math
+import time
+import socket
+import threading
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import numba
-from astropy.convolution import convolve_fft
 from skimage import exposure
 from osgeo import gdal, gdal_array
 
+# resource isn't available on Windows; peak RSS just isn't reported there
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 # Just a simple class to hold the information about each chunk
 class Chunk:
@@ -128,24 +142,117 @@ def stretch_scale(in_array, start_elev, max_elev, z, sigma, radius):
     raise NotImplementedError
 
 
-def blur_mean(in_array, radius):
+def fast_length(n):
     '''
-    Performs a simple blur based on the average of nearby values. Uses circular
-    mask from Inigo Hernaez Corres, https://stackoverflow.com/questions/8647024/how-to-apply-a-disc-shaped-mask-to-a-numpy-array
-    This is the equivalent of ArcGIS' Focal Statistics (Mean) raster processing
-    tool using a circular neighborhood.
-    in_array:       The input array, should be read using the supper_array
-                    technique from below.
-    radius:         The radius (in grid cells) of the circle used to define
-                    nearby pixels. A larger value creates more pronounced
-                    smoothing. The diameter of the circle becomes 2*radius + 1,
-                    to account for the subject pixel.
+    Returns the smallest length >= n with no prime factors above 5, which
+    FFTs handle quickly.
     '''
+    best = 2 * n
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # Smallest power of 2 times p35 that's >= n
+            length = p35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+# Most kernel spectra fft_convolve() keeps per worker; edge chunks come in a
+# few other shapes. estimate_chunk_memory() counts them.
+spectrum_cache_size = 4
+
+
+def fft_convolve(in_array, key, make_kernel, normalize_kernel=True):
+    '''
+    Convolves in_array with a kernel, giving the same results as astropy's
+    convolve_fft(in_array, kernel, nan_treatment='interpolate',
+    normalize_kernel=normalize_kernel) with its default zero-fill boundary
+    (to within floating point error): NaNs are left out, and the result
+    is divided by the weight of the kernel that fell on valid cells.
+
+    The difference is that the kernel is only built and transformed once
+    per worker for each chunk shape instead of for every chunk. Its
+    spectrum is kept in a per-worker cache keyed by key and the padded
+    shape, and most chunks are the same shape. The FFTs are real-to-complex,
+    and the weights' FFTs are skipped when nothing is NaN (the weights are
+    all 1 then). Most chunks only need the forward FFT of the data and one
+    inverse FFT. numpy's FFT keeps its own plans for each length it's seen,
+    so those are reused as well.
+    in_array:       2D float array, with NaNs for cells to leave out.
+    key:            Hashable description of the kernel, like
+                    ("blur_mean", radius); same key, same kernel.
+    make_kernel:    Function that builds the kernel (a 2D array with odd
+                    dimensions), only called when it isn't cached.
+    normalize_kernel:
+                    Divide the result by the kernel's sum, as astropy does.
+    '''
+    kernels = worker.__dict__.setdefault("kernels", {})
+    spectra = worker.__dict__.setdefault("spectra", {})
+    kernel = kernels.get(key)
+    if kernel is None:
+        kernel = kernels[key] = make_kernel()
+
+    # Pad by at least the kernel size so nothing wraps around from the
+    # other side of the array; the padding is 0 with a weight of 1, like
+    # astropy's fill boundary
+    rows, cols = in_array.shape
+    k_rows, k_cols = kernel.shape
+    shape = (fast_length(rows + k_rows), fast_length(cols + k_cols))
+
+    spectrum_key = (key, shape, in_array.dtype.str)
+    if spectrum_key not in spectra:
+        # Only keep a few of these
+        if len(spectra) >= spectrum_cache_size:
+            del spectra[next(iter(spectra))]
+        kernel_sum = kernel.sum()
+        # Normalized kernel with its center at [0, 0], wrapping around to
+        # the far edges
+        big_kernel = np.zeros(shape, in_array.dtype)
+        big_kernel[:k_rows, :k_cols] = kernel / kernel_sum
+        big_kernel = np.roll(big_kernel, (-(k_rows // 2), -(k_cols // 2)),
+                             axis=(0, 1))
+        spectra[spectrum_key] = (np.fft.rfft2(big_kernel), kernel_sum)
+        big_kernel = None
+    spectrum, kernel_sum = spectra[spectrum_key]
+
+    valid = np.isfinite(in_array)
+    data = np.where(valid, in_array, 0)
+    product = np.fft.rfft2(data, shape)
+    data = None
+    product *= spectrum
+    smoothed = np.fft.irfft2(product, shape)[:rows, :cols].astype(
+        in_array.dtype)
+    product = None
+
+    if not valid.all():
+        weights = np.ones(shape, in_array.dtype)
+        weights[:rows, :cols] = valid
+        weights = np.fft.rfft2(weights)
+        weights *= spectrum
+        weights = np.fft.irfft2(weights, shape)[:rows, :cols]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            smoothed /= weights
+        # No valid cells under the kernel
+        smoothed[weights < 10 * np.finfo(in_array.dtype).eps] = 0
+        weights = None
+
+    if not normalize_kernel:
+        smoothed *= kernel_sum
+
+    return smoothed
 
+
+def mean_kernel(radius):
+    '''
+    Circular mean kernel for blur_mean(): 1 / (the number of cells in the
+    circle) inside a circle of the given radius, 0 outside.
+    '''
     # Using modified circular mask from user Inigo Hernaez Corres, https://stackoverflow.com/questions/8647024/how-to-apply-a-disc-shaped-mask-to-a-numpy-array
-    # Using convolve_fft instead of gf(np.mean), which massively speeds up
-    # execution (from ~3 hours to ~5 minutes on one dataset).
-    nan_array = np.where(in_array == s_nodata, np.nan, in_array)
     diameter = 2 * radius + 1
     # Create a circular mask
     y, x = np.ogrid[-radius:radius + 1, -radius:radius + 1]
@@ -161,14 +268,52 @@ def blur_mean(in_array, radius):
     #           [0, 0.001, 0],
     #           [0, 0, -5]]
 
+    return kernel
+
+
+def blur_mean(in_array, radius):
+    '''
+    Performs a simple blur based on the average of nearby values. Uses circular
+    mask from Inigo Hernaez Corres, https://stackoverflow.com/questions/8647024/how-to-apply-a-disc-shaped-mask-to-a-numpy-array
+    This is the equivalent of ArcGIS' Focal Statistics (Mean) raster processing
+    tool using a circular neighborhood.
+    in_array:       The input array, should be read using the supper_array
+                    technique from below.
+    radius:         The radius (in grid cells) of the circle used to define
+                    nearby pixels. A larger value creates more pronounced
+                    smoothing. The diameter of the circle becomes 2*radius + 1,
+                    to account for the subject pixel.
+    '''
+
+    # Using an FFT convolution instead of gf(np.mean), which massively speeds
+    # up execution (from ~3 hours to ~5 minutes on one dataset).
+    nan_array = np.where(in_array == s_nodata, np.nan, in_array)
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        circular_mean = convolve_fft(nan_array, kernel,
-                                     nan_treatment='interpolate')#, normalize_kernel=False)
+        circular_mean = fft_convolve(nan_array, ("blur_mean", radius),
+                                     lambda: mean_kernel(radius))
 
     return circular_mean
 
 
+def gauss_kernel(sigma, radius):
+    '''
+    Gaussian kernel for blur_gauss(), (2 * radius + 1) cells on a side.
+    '''
+    # build kernel (Gaussian blur function)
+    # g is a 2d gaussian distribution of size (2*size) + 1
+    x, y = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    # Gaussian distribution
+    twosig = 2 * sigma**2
+    g = np.exp(-(x**2 / twosig + y**2 / twosig)) / (twosig * math.pi)
+    #LoG
+    #g = (-1/(math.pi*sigma**4))*(1-(x**2 + y**2)/twosig)*np.exp(-(x**2 / twosig + y**2 / twosig)) / (twosig)
+
+    #g = 1 - g
+    return g
+
+
 def blur_gauss(in_array, sigma, radius=30):
     '''
     Performs a gaussian blur on an array of elevations. Modified from Mike
@@ -198,30 +343,35 @@ def blur_gauss(in_array, sigma, radius=30):
     # Create new array with s_nodata values set to np.nan (for edges of raster)
     nan_array = np.where(in_array == s_nodata, np.nan, in_array)
 
-    # build kernel (Gaussian blur function)
-    # g is a 2d gaussian distribution of size (2*size) + 1
-    x, y = np.mgrid[-radius:radius + 1, -radius:radius + 1]
-    # Gaussian distribution
-    twosig = 2 * sigma**2
-    g = np.exp(-(x**2 / twosig + y**2 / twosig)) / (twosig * math.pi)
-    #LoG
-    #g = (-1/(math.pi*sigma**4))*(1-(x**2 + y**2)/twosig)*np.exp(-(x**2 / twosig + y**2 / twosig)) / (twosig)
-
-    #g = 1 - g
     # Convolve the data and Gaussian function (do the Gaussian blur)
     # Supressing runtime warnings due to NaNs (they just get hidden by NoData
     # masks in the supper_array rebuild anyways)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        # Use the astropy function because fftconvolve does not like np.nan
+        # fft_convolve() leaves out the NaNs, because fftconvolve does not
+        # like np.nan
         #smoothed = fftconvolve(padded_array, g, mode="valid")
-        smoothed = convolve_fft(nan_array, g, nan_treatment='interpolate', normalize_kernel=False)
+        smoothed = fft_convolve(nan_array, ("blur_gauss", sigma, radius),
+                                lambda: gauss_kernel(sigma, radius),
+                                normalize_kernel=False)
         # Uncomment the following line for a high-pass filter
         #smoothed = nan_array - smoothed
 
     return smoothed
 
 
+def toews_kernel(radius):
+    '''
+    Blur kernel for blur_toews(), (2 * radius + 1) cells on a side.
+    '''
+    # build kernel
+    x, y = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    g = np.exp(-(x**2 / float(radius) + y**2 / float(radius)))
+    g = g / g.sum()
+    #g = 1 - g
+    return g
+
+
 def blur_toews(in_array, radius):
     '''
     Performs a blur on an array of elevations based on convolution kernel from
@@ -234,17 +384,12 @@ def blur_toews(in_array, radius):
     # Create new array with s_nodata values set to np.nan (for edges of raster)
     nan_array = np.where(in_array == s_nodata, np.nan, in_array)
 
-    # build kernel
-    x, y = np.mgrid[-radius:radius + 1, -radius:radius + 1]
-    g = np.exp(-(x**2 / float(radius) + y**2 / float(radius)))
-    g = (g / g.sum()).astype(nan_array.dtype)
-    #g = 1 - g
-
     # Supressing runtime warnings due to NaNs (they just get hidden by NoData
     # masks in the supper_array rebuild anyways)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        smoothed = convolve_fft(nan_array, g, nan_treatment='interpolate')
+        smoothed = fft_convolve(nan_array, ("blur_toews", radius),
+                                lambda: toews_kernel(radius))
         # Uncomment the following line for a high-pass filter
         #smoothed = nan_array - smoothed
     return smoothed
@@ -326,7 +471,83 @@ def mdenoise(in_array, t, n, v, tile=None):
     return mdenoised_array
 
 
-def hillshade(in_array, az, alt, nodata, scale=False):
+def scratch_buffers():
+    '''
+    Returns this worker's dictionary of scratch arrays when the run is in
+    low-memory mode (see ParallelRCP()), None otherwise. Methods that
+    support it pass this on to scratch_array() as their buffers.
+    '''
+    return getattr(worker, "scratch", None)
+
+
+def scratch_array(buffers, name, shape, dtype):
+    '''
+    Returns an uninitialized array to work in. With a buffers dictionary
+    (see scratch_buffers()), the array stored under name is reused as long
+    as it's the right shape and type, so a worker only allocates its working
+    arrays once for all the luminance lines of a chunk and all the chunks of
+    the same size; otherwise it's a new array. Anything handed back to
+    process_window() must be a new array, not a scratch one: the results
+    for each band are kept until the chunk is done.
+    buffers:        Dictionary of scratch arrays, or None.
+    name:           Which scratch array.
+    shape, dtype:   Shape and type of the array.
+    '''
+    if buffers is None:
+        return np.empty(shape, dtype)
+    array = buffers.get(name)
+    if array is None or array.shape != shape or array.dtype != dtype:
+        # Drop the old one first so we never hold both
+        buffers[name] = None
+        array = buffers[name] = np.empty(shape, dtype)
+    return array
+
+
+def gradient(in_array, spacing, axis, out):
+    '''
+    np.gradient(in_array, spacing, axis=axis, edge_order=2), written into
+    out instead of a new array. Gives exactly the same results.
+    in_array:       2D array.
+    spacing:        Distance between cells (a plain number).
+    axis:           Axis to take the gradient along.
+    out:            Array of the same shape to write the gradient to.
+    '''
+    f = np.moveaxis(in_array, axis, 0)
+    o = np.moveaxis(out, axis, 0)
+    # Central differences on the interior
+    np.subtract(f[2:], f[:-2], out=o[1:-1])
+    np.divide(o[1:-1], 2. * spacing, out=o[1:-1])
+    # Second order one-sided differences on the edges
+    o[0] = -1.5 / spacing * f[0] + 2. / spacing * f[1] + -0.5 / spacing * f[2]
+    o[-1] = 0.5 / spacing * f[-3] + -2. / spacing * f[-2] + 1.5 / spacing * f[-1]
+    return out
+
+
+def nan_gradients(in_array, nodata, buffers=None):
+    '''
+    Returns the x and y gradients (along the rows and columns) of in_array
+    with nodata values set to np.nan, as np.gradient() would. With buffers
+    (see scratch_array()), the NaN'd copy and the gradients are scratch
+    arrays; the NaN'd copy is left in "shade_t1", which shade() uses next.
+    in_array:       The input array.
+    nodata:         The source raster's nodata value.
+    buffers:        Dictionary of scratch arrays, or None.
+    '''
+    # Create new array with nodata values set to np.nan (for edges)
+    nan_array = scratch_array(buffers, "shade_t1", in_array.shape,
+                              in_array.dtype)
+    np.copyto(nan_array, in_array)
+    np.copyto(nan_array, np.nan, where=in_array == nodata)
+
+    x = gradient(nan_array, cell_size, 0,
+                 scratch_array(buffers, "x", in_array.shape, in_array.dtype))
+    y = gradient(nan_array, cell_size, 1,
+                 scratch_array(buffers, "y", in_array.shape, in_array.dtype))
+    return x, y
+
+
+def hillshade(in_array, az, alt, nodata, scale=False, out=None,
+              buffers=None):
     '''
     Custom implmentation of hillshading, using the algorithm from the source
     code for gdaldem. The inputs and outputs are the same as in gdal or ArcGIS.
@@ -339,41 +560,15 @@ def hillshade(in_array, az, alt, nodata, scale=False):
                     as part of a parallel or multi-chunk process, each chunk
                     has different min and max values, which leads to different
                     stretching for each chunk.
+    out:            Optional array to write the result to (see shade()).
+    buffers:        Optional dictionary of scratch arrays to work in (see
+                    scratch_array()).
     '''
 
-    # Create new array wsith nodata values set to np.nan (for edges)
-    nan_array = np.where(in_array == nodata, np.nan, in_array)
-
-    # x = np.zeros(nan_array.shape)
-    # y = np.zeros(nan_array.shape)
-
-    # Conversion between mathematical and nautical azimuth
-    az = 90. - az
-
-    azrad = az * np.pi / 180.
-    altrad = alt * np.pi / 180.
-
-    x, y = np.gradient(nan_array, cell_size, cell_size, edge_order=2)
+    x, y = nan_gradients(in_array, nodata, buffers)
     # x, y = np.gradient(in_array, cell_size, cell_size, edge_order=2)
 
-    sinalt = np.sin(altrad)
-    cosaz = np.cos(azrad)
-    cosalt = np.cos(altrad)
-    sinaz = np.sin(azrad)
-    xx_plus_yy = x * x + y * y
-    alpha = y * cosaz * cosalt - x * sinaz * cosalt
-    x = None
-    y = None
-    shaded = (sinalt - alpha) / np.sqrt(1 + xx_plus_yy)
-    # result is +-1, scale to 0-255, mult by weight
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        # newmax = 255
-        # newmin = 0
-        # oldmax = 1
-        # oldmin = -1
-        # ((newmax-newmin)(val-oldmin))/(oldmax-oldmin)+newmin
-        result = 127.5 * (shaded + 1)
+    result = shade(x, y, az, alt, out, buffers)
 
     return result
 
@@ -397,7 +592,119 @@ def hillshade(in_array, az, alt, nodata, scale=False):
     # return result
 
 # @numba.jit(nopython=True)
-def skymodel(in_array, lum_lines, overlap, nodata, res):
+def shade(x, y, az, alt, out=None, buffers=None):
+    '''
+    Hillshades from the gradients of a DEM (as returned by np.gradient() on
+    the NaN'd DEM), so that several products can share a single gradient
+    calculation. Returns values 0-255.
+    x:              Gradient along the rows (axis 0).
+    y:              Gradient along the columns (axis 1).
+    az:             The sun's azimuth, in degrees.
+    alt:            The sun's altitude, in degrees.
+    out:            Optional array to write the result to instead of a new
+                    one (can be a view into a bigger array).
+    buffers:        Optional dictionary of scratch arrays for the two
+                    temporary arrays (see scratch_array()).
+    '''
+
+    # Conversion between mathematical and nautical azimuth
+    az = 90. - az
+
+    azrad = az * np.pi / 180.
+    altrad = alt * np.pi / 180.
+
+    # math instead of np so these are plain floats, which don't promote
+    # float32 gradients to float64
+    sinalt = math.sin(altrad)
+    cosaz = math.cos(azrad)
+    cosalt = math.cos(altrad)
+    sinaz = math.sin(azrad)
+
+    # Same as
+    #   xx_plus_yy = x * x + y * y
+    #   alpha = y * cosaz * cosalt - x * sinaz * cosalt
+    #   shaded = (sinalt - alpha) / np.sqrt(1 + xx_plus_yy)
+    # but in place, so it only needs two temporary arrays
+    t1 = scratch_array(buffers, "shade_t1", x.shape, x.dtype)
+    t2 = scratch_array(buffers, "shade_t2", x.shape, x.dtype)
+    if out is None:
+        out = np.empty(x.shape, x.dtype)
+    np.multiply(x, x, out=t1)
+    np.multiply(y, y, out=t2)
+    np.add(t1, t2, out=t1)
+    np.add(t1, 1, out=t1)
+    np.sqrt(t1, out=t1)
+    np.multiply(y, cosaz, out=t2)
+    np.multiply(t2, cosalt, out=t2)
+    np.multiply(x, sinaz, out=out)
+    np.multiply(out, cosalt, out=out)
+    np.subtract(t2, out, out=out)
+    np.subtract(sinalt, out, out=out)
+    np.divide(out, t1, out=out)
+    # result is +-1, scale to 0-255, mult by weight
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        # newmax = 255
+        # newmin = 0
+        # oldmax = 1
+        # oldmin = -1
+        # ((newmax-newmin)(val-oldmin))/(oldmax-oldmin)+newmin
+        np.add(out, 1, out=out)
+        np.multiply(out, 127.5, out=out)
+
+    return out
+
+
+def terrain(in_array, az, alt, nodata, buffers=None):
+    '''
+    Slope, aspect, and hillshade from one gradient calculation. Returns a
+    dictionary of arrays keyed by "slope", "aspect", and "hillshade".
+    in_array:       The input array, should be read using the supper_array
+                    technique from below.
+    az:             The sun's azimuth for the hillshade, in degrees.
+    alt:            The sun's altitude for the hillshade, in degrees.
+    nodata:         The source raster's nodata value.
+    buffers:        Optional dictionary of scratch arrays to work in (see
+                    scratch_array()).
+    '''
+
+    x, y = nan_gradients(in_array, nodata, buffers)
+
+    # Slope in degrees
+    slope = np.degrees(np.arctan(np.sqrt(x * x + y * y)))
+
+    # Aspect in degrees clockwise from north, the direction the slope faces
+    # (downhill). x increases to the south and y to the east, so downhill
+    # is (-y, x) in (east, north). Flat cells get -1.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        aspect = np.degrees(np.arctan2(-y, x)) % 360.
+        aspect[(x == 0) & (y == 0)] = -1
+
+    return {"slope": slope, "aspect": aspect,
+            "hillshade": shade(x, y, az, alt, buffers=buffers)}
+
+
+def multi_hillshade(in_array, azimuths, alt, nodata, buffers=None):
+    '''
+    Hillshades at several azimuths from one gradient calculation. Returns a
+    dictionary of arrays keyed by "hs" plus the azimuth (eg, "hs315").
+    in_array:       The input array, should be read using the supper_array
+                    technique from below.
+    azimuths:       List of the sun's azimuths, in degrees.
+    alt:            The sun's altitude, in degrees.
+    nodata:         The source raster's nodata value.
+    buffers:        Optional dictionary of scratch arrays to work in (see
+                    scratch_array()).
+    '''
+
+    x, y = nan_gradients(in_array, nodata, buffers)
+
+    return {"hs{}".format(az): shade(x, y, az, alt, buffers=buffers)
+            for az in azimuths}
+
+
+def skymodel(in_array, lum_lines, overlap, nodata, res, buffers=None):
     '''
     Creates a unique hillshade based on a skymodel, implmenting the method
     defined in Kennelly and Stewart (2014), A Uniform Sky Illumination Model to
@@ -408,18 +715,35 @@ def skymodel(in_array, lum_lines, overlap, nodata, res):
     lum_lines:      The azimuth, altitude, and weight for each iteration of the
                     hillshade. Stored as an array lines, with each line being
                     an array of [az, alt, weight].
+    buffers:        Optional dictionary of scratch arrays (see
+                    scratch_array()). The working arrays for each luminance
+                    line are reused for the next one either way; with
+                    buffers, they're reused for the next chunk too.
     '''
 
     # initialize skyshade as 0's
-    skyshade = np.zeros(in_array.shape)
+    skyshade = np.zeros(in_array.shape, in_array.dtype)
 
     # If it's all NoData, just return an array of 0's
     if in_array.mean() == nodata:
         return skyshade
 
-    # Multiply elevation by 5 as per original paper
-    in_array *= 5
-    # nan_array *= 5
+    # Multiply elevation by 5 as per original paper. This is a copy so that
+    # in_array (which is the caller's super array) keeps its NoData values
+    # for masking the result.
+    elev = scratch_array(buffers, "elev", in_array.shape, in_array.dtype)
+    np.multiply(in_array, 5, out=elev)
+    # Scale NoData in the array's own type so it still matches afterwards
+    # (a float32 NoData near the bottom of the range becomes -inf, just like
+    # the cells that had it)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        nodata5 = in_array.dtype.type(nodata) * 5
+
+    shade = scratch_array(buffers, "sky_shade", in_array.shape,
+                          in_array.dtype)
+    shadowed = scratch_array(buffers, "shadowed", in_array.shape,
+                             in_array.dtype)
 
     # Loop through luminance file lines to calculate multiple hillshades
     for line in lum_lines:
@@ -432,12 +756,12 @@ def skymodel(in_array, lum_lines, overlap, nodata, res):
             hs_overlap = overlap - 20
         else:
             hs_overlap = 0
-        shade = np.zeros(in_array.shape)
-        shade[hs_overlap:-hs_overlap, hs_overlap:-hs_overlap] = hillshade(
-                    in_array[hs_overlap:-hs_overlap, hs_overlap:-hs_overlap],
-                    az=az, alt=alt, nodata=nodata*5, scale=False,
-                    )
-        shadowed = shadows(in_array, az, alt, res, overlap, nodata*5)
+        shade.fill(0)
+        hillshade(elev[hs_overlap:-hs_overlap, hs_overlap:-hs_overlap],
+                  az=az, alt=alt, nodata=nodata5, scale=False,
+                  out=shade[hs_overlap:-hs_overlap, hs_overlap:-hs_overlap],
+                  buffers=buffers)
+        shadows(elev, az, alt, res, overlap, nodata5, shadowed)
         # shade = hillshade(nan_array, az=az, alt=alt, scale=False) * weight
         # shadowed = shadowing.shadows(nan_array, az, alt, cell_size, overlap, nodata)
         # scale from 0-255 to 1-255, apply weight to scaled (I think arcpy hillshades range from 1-255, with 0 being nodata)
@@ -446,20 +770,27 @@ def skymodel(in_array, lum_lines, overlap, nodata, res):
         # scaled = 0.996078431*(shade*shadowed) + 1
         # skyshade += (0.996078431*(shade*shadowed) + 1) * weight
 
-        skyshade += shade * shadowed * weight
-
-
-        shade = None
+        # skyshade += shade * shadowed * weight, in place
+        np.multiply(shade, shadowed, out=shade)
+        np.multiply(shade, weight, out=shade)
+        np.add(skyshade, shade, out=skyshade)
 
     return skyshade
 
 
-@numba.jit(nopython=True)
-def shadows(in_array, az, alt, res, overlap, nodata):
+# nogil lets the thread backend run shadows() on several chunks at once
+@numba.jit(nopython=True, nogil=True)
+def shadows(in_array, az, alt, res, overlap, nodata, out=None):
     # Rows = i = y values, cols = j = x values
     rows = in_array.shape[0]
     cols = in_array.shape[1]
-    shadow_array = np.ones(in_array.shape)  # init to 1 (not shadowed), change to 0 if shadowed
+    # init to 1 (not shadowed), change to 0 if shadowed. out reuses an
+    # existing array.
+    if out is None:
+        shadow_array = np.ones(in_array.shape, in_array.dtype)
+    else:
+        shadow_array = out
+        shadow_array[:] = 1
     max_elev = np.max(in_array)
 
     az = 90. - az  # convert from 0 = north, cw to 0 = east, ccw
@@ -566,341 +897,2056 @@ def TPI(in_array, radius):
     return in_array - circular_mean
 
 
-def ProcessSuperArray(chunk_info):
+class Method:
     '''
-    Given starting and ending indices of a chunk, overlap value, and relevant
-    raster file info via the chunk_info object, this function calculates the
-    indices of a "super array" that is 'overlap'-values larger than the chunk
-    in each dimension (-x, x, -y, y). It automatically computes edge conditions
-    for chunks on the edges of the original raster. It then calls the specified
-    method on this super array, masks out the overlap areas on the resulting
-    array (if nodata is set), and writes the processed chunk to the output
-    file.
+    Everything the chunk engine needs to know about a processing method. Add
+    new methods with register_method() rather than creating these directly.
+    '''
+
+    def __init__(self, name, function, required=(), overlap=None,
+                 dtype=gdal.GDT_Float32, nodata=None, setup=None,
+                 prepare=None, memory=10, fft_arrays=0, cost=None,
+                 max_chunk=2048, outputs=None, compact=None):
+        self.name = name
+        self.function = function
+        self.required = list(required)
+        self.overlap = overlap
+        self.dtype = dtype
+        self.nodata = nodata
+        self.setup = setup
+        self.prepare = prepare
+        self.memory = memory
+        self.fft_arrays = fft_arrays
+        self.cost = cost
+        self.max_chunk = max_chunk
+        self.outputs = outputs
+        self.compact = compact
+
+
+# Registry of processing methods, keyed by name. ParallelRCP(),
+# ProcessSuperArray(), and the argument parser all work from this.
+methods = {}
+
+
+def register_method(name, function, required=(), overlap=None,
+                    dtype=gdal.GDT_Float32, nodata=None, setup=None,
+                    prepare=None, memory=10, fft_arrays=0, cost=None,
+                    max_chunk=2048, outputs=None, compact=None):
+    '''
+    Adds a processing method to the registry so it can be used with
+    ParallelRCP() and from the command line. In-house methods can live in
+    their own module that imports this one and calls register_method(); pass
+    the module name with --plugin (or plugins= to ParallelRCP()) so that it's
+    imported in every worker process too.
+    name:           Name used for -m/method.
+    function:       Called as function(in_array, options, tile, overlap) for
+                    each band of each super array, where in_array is the 2D
+                    super array, options is the options dictionary, tile is
+                    the tile name (for unique temp file names), and overlap
+                    is the overlap on each side of the super array. Must
+                    return an array of the same shape.
+    required:       Names of options that must be set for this method.
+    overlap:        Function that returns the minimum overlap the method
+                    needs given the options dictionary; the overlap is
+                    raised to this if it's smaller. None means the method
+                    uses the overlap as given.
+    dtype:          GDAL data type of the output raster.
+    nodata:         Output NoData value; None uses the source's.
+    setup:          Optional function called as setup(options) once in each
+                    worker process before any chunks are processed (kernel
+                    construction, JIT warm-up, etc).
+    prepare:        Optional function called as prepare(options, verbose)
+                    once in the main process before the run starts, for
+                    reading in supporting files and the like. It can add
+                    entries to options.
+    memory:         Rough number of super-array-sized arrays (of the work
+                    type, see work_dtype()) the method has alive at its
+                    peak, for estimate_chunk_memory().
+    fft_arrays:     Number of complex FFT-padded arrays alive at the peak, for
+                    methods that use fft_convolve().
+    cost:           Optional function called as cost(super_area, area, valid,
+                    steepness) that returns the relative cost of a chunk for
+                    estimate_chunk_cost(); defaults to the super array area.
+    max_chunk:      Largest chunk size auto_chunk_size() will choose.
+    outputs:        For methods that produce several products from one
+                    read, either a list of the product names or a function
+                    that returns them given the options dictionary. function
+                    then returns a dictionary of arrays keyed by those names,
+                    and each product is written to its own raster (see
+                    output_paths()). None means function returns one array.
+    compact:        Optional function called as compact(options) that returns
+                    a (dtype, nodata, scale, offset) tuple for writing the
+                    method's results as a smaller integer type instead of
+                    dtype, or None to write dtype with these options.
+                    Results are stored as round((value - offset) / scale)
+                    and the scale and offset are set on the output bands so
+                    that GDAL-aware software reads back the original units.
+                    That's within half a step for results inside the type's
+                    range, less nodata; results outside it are clipped (see
+                    encode_output()), so the scale and offset have to cover
+                    everything the method can return. Used unless
+                    ParallelRCP() is asked for float output.
+    '''
+    methods[name] = Method(name, function, required, overlap, dtype, nodata,
+                           setup, prepare, memory, fft_arrays, cost,
+                           max_chunk, outputs, compact)
 
-    Relies on having a global lock object, normally passed through mp.pool()
-    with a simple initializer function.
 
-    chunk_info:     A simple Chunk() data structure obejct that holds the
-                    information about the chunk and the file as a whole.
-                    pool.map() iterates over a single collection, so this
-                    function uses a single picklable object to easily pass all
-                    the needed info to the function.
+def method_outputs(method_info, options):
     '''
+    Returns the list of product names for a method, or [None] for a method
+    that only produces one array.
+    method_info:    The method's Method() from the registry.
+    options:        Dictionary of method options.
+    '''
+    if method_info.outputs is None:
+        return [None]
+    if callable(method_info.outputs):
+        return list(method_info.outputs(options))
+    return list(method_info.outputs)
 
-    # Unpack chunk-specific info
-    tile = chunk_info.tile
-    progress = chunk_info.progress
-    total_chunks = chunk_info.total_chunks
-    x_start = chunk_info.x_start
-    y_start = chunk_info.y_start
-    x_end = chunk_info.x_end
-    y_end = chunk_info.y_end
 
-    # Unpack general info
-    source_dem_path = chunk_info.in_dem_path
-    target_dem_path = chunk_info.out_dem_path
+def output_paths(out_dem_path, outputs):
+    '''
+    Returns a dictionary of the raster path for each product name. A single
+    unnamed product is written to out_dem_path itself; named products go to
+    {base}_{name}{ext} next to it (eg, dem_slope.tif).
+    out_dem_path:   Full path to the resulting raster given by the user.
+    outputs:        List of product names from method_outputs().
+    '''
+    if outputs == [None]:
+        return {None: out_dem_path}
+    base, ext = os.path.splitext(out_dem_path)
+    return {name: "{}_{}{}".format(base, name, ext) for name in outputs}
 
-    f2 = chunk_info.f2
 
-    rows = chunk_info.rows
-    cols = chunk_info.cols
+def encode_output(in_array, np_dtype, nodata, scale=1, offset=0,
+                  valid=None):
+    '''
+    Converts a method's float results to a compact integer type: removes the
+    offset, divides by the scale, rounds, and clips to the type's range. The
+    nodata value is kept out of the range of valid results, and NaNs become
+    nodata.
+
+    Clipping moves a result by up to one step when nodata sits at the end of
+    the range (a hillshade's 0 is written as 1, like gdaldem's), but by any
+    amount past that. Returns the converted array and the number of cells
+    that were clipped by more than one step, counting only the cells in
+    valid, so the caller can say the scale and offset don't fit.
+    in_array:       The float results.
+    np_dtype:       The numpy integer type to convert to.
+    nodata:         The output nodata value.
+    scale:          Size of one step of the integer type, in result units.
+    offset:         Result value stored as 0.
+    valid:          Optional boolean array of the cells that hold results
+                    (ie, not the source's NoData areas).
+    '''
+    if scale != 1 or offset != 0:
+        in_array = (in_array - offset) / scale
+    info = np.iinfo(np_dtype)
+    low = info.min + 1 if nodata == info.min else info.min
+    high = info.max - 1 if nodata == info.max else info.max
+    nan_mask = np.isnan(in_array)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        clipped = (in_array < low - 1) | (in_array > high + 1)
+        out_array = np.clip(np.round(in_array), low, high)
+    if valid is not None:
+        clipped &= valid
+    out_array[nan_mask] = nodata
+    return out_array.astype(np_dtype), int(np.count_nonzero(clipped))
 
-    bands = chunk_info.bands
 
-    method = chunk_info.method
-    options = chunk_info.options  # dictionary of options
+def work_dtype(s_type, nodata=None):
+    '''
+    Picks the float type the methods work in for a source of GDAL type
+    s_type. Byte, 16-bit integer, and Float32 sources (ie, just about every
+    DEM) fit in float32 exactly, which halves the memory of every working
+    array compared to float64; anything else, or a NoData value float32
+    can't hold, gets float64. Returned as a string so it can go in a
+    manifest.
+    s_type:         GDAL data type of the source.
+    nodata:         The source's NoData value, if any.
+    '''
+    if s_type in (gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16,
+                  gdal.GDT_Float32):
+        if nodata is None or np.float32(nodata) == nodata:
+            return "float32"
+    return "float64"
 
-    starttime = chunk_info.start_time
 
-    # Being lazy, setting these as global so I don't have to alter the
-    # processing method signatures
-    global s_nodata
-    global cell_size
-    global verbose
-    s_nodata = chunk_info.s_nodata
-    t_nodata = chunk_info.t_nodata
-    cell_size = chunk_info.cell_size
-    verbose = chunk_info.verbose
+def total_lum_weight(options):
+    '''
+    Returns the sum of the weights in the skymodel luminance file, which is
+    the largest a skymodel value can be divided by 255.
+    options:        Options dictionary with "lum_lines" read in.
+    '''
+    return sum(float(line[2]) for line in options["lum_lines"]) or 1.
+
+
+def skymodel_compact(options):
+    '''
+    UInt16 encoding for skymodel (see register_method()). Skymodel values
+    run from 0 (shaded from every light) to 255 times the total weight, so
+    that range is spread over 1-65535 with the offset set one step below 0;
+    that way a 0 doesn't have to be clipped away from nodata.
+    options:        Options dictionary with "lum_lines" read in.
+    '''
+    scale = 255. * total_lum_weight(options) / 65534.
+    return (gdal.GDT_UInt16, 0, scale, -scale)
+
+
+def split_stages(method):
+    '''
+    Splits a method chain like "blur_gauss,skymodel" into a list of method
+    names, which are run one after another on each super array. A single
+    method gives a list of one; lists are passed through.
+    method:         Method name, comma-separated chain, or list of names.
+    '''
+    if isinstance(method, str):
+        return [m.strip() for m in method.split(",") if m.strip()]
+    return list(method)
+
+
+def load_plugins(plugins):
+    '''
+    Imports modules that add methods with register_method().
+    plugins:        Names of the modules to import.
+    '''
+    # When this file is run as a script it's __main__ (or __mp_main__ in
+    # spawned worker processes), so a plugin's "import
+    # raster_chunk_processing" would load a second copy with its own
+    # registry. Point that name at this module first.
+    sys.modules.setdefault("raster_chunk_processing", sys.modules[__name__])
+    for plugin in plugins:
+        importlib.import_module(plugin)
+
+
+def read_lum_file(options, verbose=False):
+    '''
+    Reads the skymodel luminance file into options["lum_lines"], so the
+    whole file only has to be read once per run.
+    options:        Options dictionary; options["lum_file"] is the path.
+    verbose:        Flag to print out more information.
+    '''
+    if verbose:
+        print("Reading in luminance file {}".format(options["lum_file"]))
+    lines = []
+    with open(options["lum_file"], 'r') as l:
+        reader = csv.reader(l)
+        for line in reader:
+            lines.append(line)
+    options["lum_lines"] = lines
+
+
+def skymodel_cost(super_area, area, valid, steepness):
+    '''
+    Shadow tracing dominates and only covers the chunk's valid pixels.
+    shadows() stops tracing a pixel as soon as it's shadowed or its ray hits
+    NoData, so steep terrain is cheaper per pixel than flat ground (where
+    every ray runs the full distance).
+    '''
+    return super_area + 10 * area * valid / (1 + 2 * steepness)
+
+
+def clahe(in_array, kernel_size, clip_limit):
+    '''
+    Contrast Limited Adaptive Histogram Equalization of an image band using
+    scikit-image, scaled back to 0-255.
+    in_array:       The input array, should be read using the supper_array
+                    technique from below.
+    kernel_size:    Size of the contextual regions, in pixels.
+    clip_limit:     Clipping limit; higher values give more contrast.
+    '''
+    new_data = exposure.equalize_adapthist(in_array.astype(int), kernel_size,
+                                           clip_limit)
+    new_data *= 255.0  # scale CLAHE from 0-1 to 0-255
+    return new_data
+
+
+# Overlaps are twice the kernel size (or radius) so the kernel never runs off
+# the edge of the super array for pixels we keep. The blurs' real FFTs (see
+# fft_convolve()) only need half-size spectra, so three padded complex
+# arrays' worth covers the cached kernel spectrum and the data's.
+# Compact outputs: hillshades are 0-255 anyways, so they go to Byte (1-255,
+# with 0 as NoData like gdaldem). skymodel's sum of weighted hillshades is
+# normalized by the total luminance weight into UInt16 (the band scale gets
+# back the float values). TPI goes to Int16 in steps of the scale option
+# (default 0.1 elevation units) from the offset option.
+register_method(
+    "blur_gauss",
+    lambda a, o, tile, f2: blur_gauss(a, o["sigma"], o["radius"]),
+    required=["radius", "sigma"], overlap=lambda o: 2 * o["radius"],
+    memory=2, fft_arrays=3)
+register_method(
+    "blur_mean", lambda a, o, tile, f2: blur_mean(a, o["radius"]),
+    required=["radius"], overlap=lambda o: 2 * o["radius"],
+    memory=2, fft_arrays=3)
+register_method(
+    "blur_toews", lambda a, o, tile, f2: blur_toews(a, o["radius"]),
+    required=["radius"], overlap=lambda o: 2 * o["radius"],
+    memory=2, fft_arrays=3)
+# mdenoise's memory includes mdenoise.exe's own copy of the mesh. The stock
+# mdenoise.exe runs out of memory somewhere between 1500 and 2000; see notes
+# in mdenoise().
+register_method(
+    "mdenoise",
+    lambda a, o, tile, f2: mdenoise(a, o["t"], o["n"], o["v"], tile),
+    required=["t", "n", "v"], memory=12,
+    cost=lambda super_area, area, valid, steepness: super_area * valid,
+    max_chunk=1536)
+register_method(
+    "clahe",
+    lambda a, o, tile, f2: clahe(a, o["kernel_size"], o["clip_limit"]),
+    required=["kernel_size", "clip_limit"],
+    overlap=lambda o: 2 * o["kernel_size"], dtype=gdal.GDT_Byte, nodata=0,
+    memory=8)
+register_method(
+    "TPI", lambda a, o, tile, f2: TPI(a, o["radius"]),
+    required=["radius"], overlap=lambda o: 2 * o["radius"],
+    memory=3, fft_arrays=3,
+    compact=lambda o: None if o.get("scale") is None and o.get(
+        "offset") is None else (gdal.GDT_Int16, -32768, o.get("scale") or 0.1,
+                                o.get("offset") or 0))
+register_method(
+    "hillshade",
+    lambda a, o, tile, f2: hillshade(a, o["az"], o["alt"], s_nodata,
+                                     buffers=scratch_buffers()),
+    required=["alt", "az"], memory=7,
+    compact=lambda o: (gdal.GDT_Byte, 0, 1, 0))
+register_method(
+    "terrain",
+    lambda a, o, tile, f2: terrain(a, o["az"], o["alt"], s_nodata,
+                                   scratch_buffers()),
+    required=["alt", "az"], memory=9,
+    outputs=["slope", "aspect", "hillshade"])
+register_method(
+    "multi_hillshade",
+    lambda a, o, tile, f2: multi_hillshade(a, o["azimuths"], o["alt"],
+                                           s_nodata, scratch_buffers()),
+    required=["alt", "azimuths"], memory=7,
+    outputs=lambda o: ["hs{}".format(az) for az in o["azimuths"]],
+    compact=lambda o: (gdal.GDT_Byte, 0, 1, 0))
+register_method(
+    "skymodel",
+    lambda a, o, tile, f2: skymodel(a, o["lum_lines"], f2, s_nodata,
+                                    cell_size, scratch_buffers()),
+    required=["lum_file"], prepare=read_lum_file, memory=10,
+    cost=skymodel_cost,
+    compact=skymodel_compact)
+register_method("test", lambda a, o, tile, f2: a + 5, memory=1)
+
+
+# Rough memory footprint of a worker process with python, numpy, gdal,
+# numba, and skimage loaded but no data.
+process_overhead = 150 * 1024**2
+
+
+def parse_mem(mem):
+    '''
+    Converts a memory size like "48G", "512M", or "1.5T" into bytes. A bare
+    number is taken to be in gigabytes.
+    mem:            The memory size string (or number).
+    '''
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    mem = str(mem).strip().upper().rstrip("B").rstrip("I")
+    if mem and mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(float(mem) * units["G"])
+
+
+def estimate_chunk_memory(method, options, chunk_size, overlap, bands,
+                          s_itemsize, prefetch=False, work_itemsize=8,
+                          strips=False):
+    '''
+    Estimates the peak memory, in bytes, that one worker process needs to
+    process a single chunk. This is deliberately on the generous side; it's
+    used to keep a run from getting OOM-killed, not to predict exact usage.
+    method:         Name of the raster processing method (or method chain).
+    options:        Dictionary of method options (used for kernel radius).
+    chunk_size:     Square dimension of the chunk.
+    overlap:        Overlap on each side of the chunk (f2).
+    bands:          Number of bands in the source.
+    s_itemsize:     Size in bytes of one source pixel.
+    prefetch:       The next chunk is read while this one is processed (see
+                    RunChunks()).
+    work_itemsize:  Size in bytes of the float type the methods work in (see
+                    work_dtype()).
+    strips:         The worker runs whole columns of chunks and carries the
+                    overlap rows from one chunk to the next (see RunStrip()).
+    '''
+    side = chunk_size + 2 * overlap
+    pixels = side * side
+
+    # read_array (source type) and super_array (work type), all bands, and
+    # the same again for the next chunk if it's being read ahead
+    total = bands * pixels * (s_itemsize + work_itemsize)
+    if prefetch:
+        total *= 2
+    # The overlap rows carried over to the next chunk in a strip, which stay
+    # around for the whole chunk, and the block of new rows read_window()
+    # reads below them before copying them into the super array
+    if strips:
+        total += bands * side * (2 * overlap + chunk_size) * work_itemsize
+
+    # The method's own working arrays; methods only work on one band at a
+    # time. For a chain of methods, only one stage runs at a time, plus the
+    # previous stage's result that it's working from.
+    stages = split_stages(method)
+    work = 0
+    # fft_convolve pads the array by the kernel size and then up to a fast
+    # FFT length (at most the next power of 2); its complex arrays are twice
+    # the size of the work type
+    kernel = 2 * (options.get("radius") or 0) + 1
+    padded = 2 ** int(math.ceil(math.log2(side + kernel)))
+    for stage in stages:
+        stage_work = methods[stage].memory * pixels * work_itemsize
+        if methods[stage].fft_arrays:
+            stage_work += (methods[stage].fft_arrays * padded * padded *
+                           2 * work_itemsize)
+        work = max(work, stage_work)
+    # The kernel spectra fft_convolve() keeps around for the life of the
+    # worker (half-width, since the FFTs are real-to-complex)
+    if any(methods[stage].fft_arrays for stage in stages):
+        total += (spectrum_cache_size * padded * (padded // 2 + 1) *
+                  2 * work_itemsize)
+    if len(stages) > 1:
+        work += pixels * work_itemsize
+    # Methods with several products keep all of them (and their trimmed
+    # copies for every band) until the chunk is handed to the writer
+    products = len(method_outputs(methods[stages[-1]], options))
+    if products > 1:
+        work += ((products - 1) * pixels * work_itemsize +
+                 bands * products * pixels * work_itemsize)
+    total += work
+
+    # Trimmed result for each band, plus the stacked copy sent to the writer
+    total += 2 * bands * chunk_size * chunk_size * work_itemsize
+
+    return total + process_overhead
+
+
+def fits_budget(method, options, chunk_size, overlap, bands, s_itemsize,
+                procs, mem_budget, threads=False, prefetch=False,
+                work_itemsize=8, strips=False):
+    '''
+    Whether procs workers processing chunks of chunk_size with this overlap
+    fit in mem_budget, counting the writer and the chunks waiting for it.
+    The arguments are the same as auto_chunk_size()'s.
+    '''
+    per_proc = estimate_chunk_memory(method, options, chunk_size, overlap,
+                                     bands, s_itemsize, prefetch,
+                                     work_itemsize, strips)
+    # The writer process plus the chunks waiting in the write queue
+    writer = process_overhead + 2 * procs * bands * chunk_size * chunk_size * 8
+    if threads:
+        # One process for everything
+        per_proc -= process_overhead
+    return procs * per_proc + writer <= mem_budget
+
+
+def auto_chunk_size(method, options, overlap, bands, s_itemsize, mem_budget,
+                    max_procs, chunk_size=None, block=256, threads=False,
+                    prefetch=False, work_itemsize=8, strips=False):
+    '''
+    Picks the chunk size and number of processes that fit in a memory budget.
+    We'd rather use every core than have huge chunks (past ~2000 pixels,
+    bigger chunks don't buy much), so this looks for the largest chunk up to
+    that size that fits with all max_procs processes running, and only backs
+    off on the process count if that chunk would be uselessly small.
+    Returns (chunk_size, num_processes).
+    method:         Name of the raster processing method.
+    options:        Dictionary of method options.
+    overlap:        Overlap on each side of the chunk.
+    bands:          Number of bands in the source.
+    s_itemsize:     Size in bytes of one source pixel.
+    mem_budget:     Total memory, in bytes, the run is allowed to use.
+    max_procs:      Upper limit on the number of processes.
+    chunk_size:     If given, the chunk size is kept and only the process
+                    count is chosen.
+    block:          Chunk sizes are multiples of this (the output block size).
+    threads:        The workers are threads in one process (the thread and
+                    serial backends), so the process overhead is only paid
+                    once and there's no separate writer process.
+    prefetch:       Each worker reads its next chunk ahead of time (see
+                    estimate_chunk_memory()).
+    work_itemsize:  Size in bytes of the float type the methods work in.
+    strips:         Each worker runs a column of chunks at a time (see
+                    estimate_chunk_memory()).
+    '''
+    largest = min(methods[stage].max_chunk for stage in split_stages(method))
+    smallest = max(512, overlap)
+    # A block that spans the largest chunk (ie, a striped, non-tiled output)
+    # doesn't constrain the chunk size; snap_to_blocks() leaves it alone too
+    if block >= largest or block <= 0:
+        block = min(256, largest)
+
+    if chunk_size:
+        sizes = [chunk_size]
+    else:
+        sizes = list(range(block * (largest // block), block - 1, -block))
+
+    for procs in range(max_procs, 0, -1):
+        for size in sizes:
+            if size < smallest and procs > 1 and not chunk_size:
+                break
+            if fits_budget(method, options, size, overlap, bands, s_itemsize,
+                           procs, mem_budget, threads, prefetch,
+                           work_itemsize, strips):
+                return size, procs
+
+    raise MemoryError("Memory budget of {} is too small to process even one "
+                      "chunk of {} pixels with method {}.".format(
+                          sizeof_fmt(mem_budget), min(sizes or [block]),
+                          method))
+
+
+def snap_to_blocks(size, block, extent):
+    '''
+    Rounds a chunk dimension to the nearest multiple of a raster's block
+    dimension (but never less than one block) so that chunk boundaries fall on
+    block boundaries. If the block spans the whole extent (ie, a striped,
+    non-tiled file), the size is returned unchanged.
+    size:           The requested chunk dimension, in pixels.
+    block:          The block dimension, in pixels.
+    extent:         The raster dimension, in pixels.
+    '''
+    if block >= extent or block <= 0:
+        return size
+    return max(block, int(round(size / block)) * block)
+
+
+def reads_aligned(f2, s_block, chunk_x, chunk_y, cols, rows):
+    '''
+    Whether the super array reads start and end on the source's block
+    boundaries, for the verbose report. That takes a tiled source, a chunk
+    grid that's a multiple of its blocks, and an overlap that is too. The
+    overlap isn't grown to get there: a read that doesn't line up decodes
+    the same blocks anyway, so a bigger overlap would only cost memory and
+    processing.
+    f2:             The overlap on each side of the chunk, in pixels.
+    s_block:        [x, y] block size of the source raster.
+    chunk_x/y:      The (block-snapped) chunk dimensions.
+    cols/rows:      The raster dimensions.
+    '''
+    s_bx, s_by = s_block
+    if s_bx >= cols or s_by >= rows:
+        return False
+    return not (chunk_x % s_bx or chunk_y % s_by or f2 % s_bx or f2 % s_by)
+
+
+def overview_factors(cols, rows, block):
+    '''
+    Returns the overview decimation factors (2, 4, 8, ...) a COG of this
+    size gets: levels are added until the smallest one fits in a single
+    block, same as gdaladdo and the COG driver do by default.
+    cols/rows:      The raster dimensions.
+    block:          The output's block dimension, in pixels.
+    '''
+    factors = []
+    factor = 2
+    while max(cols, rows) / (factor // 2) > block:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def downsample(in_array, factor, nodata=None):
+    '''
+    NoData-aware average downsampling of a [bands, rows, cols] array by an
+    integer factor, for building overviews. Partial windows along the right
+    and bottom edges are averaged over the pixels they do have, like GDAL's
+    average resampling. Windows that are all NoData come out as NoData.
+    in_array:       The array to downsample.
+    factor:         The decimation factor.
+    nodata:         NoData value to ignore, if any.
+    '''
+    bands, rows, cols = in_array.shape
+    o_rows = -(-rows // factor)
+    o_cols = -(-cols // factor)
+
+    # Pad out to whole windows with NaNs, which nanmean() ignores
+    padded = np.full((bands, o_rows * factor, o_cols * factor), np.nan)
+    padded[:, :rows, :cols] = in_array
+    if nodata is not None:
+        padded[padded == nodata] = np.nan
+
+    windows = padded.reshape(bands, o_rows, factor, o_cols, factor)
+    with warnings.catch_warnings():
+        # All-NaN windows are expected (NoData areas)
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        result = np.nanmean(windows, axis=(2, 4))
+    result[np.isnan(result)] = nodata if nodata is not None else 0
+
+    if np.issubdtype(in_array.dtype, np.integer):
+        result = np.round(result)
+    return result.astype(in_array.dtype)
+
+
+def write_overviews(t_fh, out_array, x_start, y_start, factors, nodata):
+    '''
+    Downsamples a finished chunk to each overview level and writes it into
+    the output's (already created) overviews, so they never have to be
+    built from the full-resolution output afterwards. The chunk's offsets
+    must be multiples of every factor for this to match averaging the whole
+    raster, which block-aligned chunks are.
+    t_fh:           Open (update) handle to the output raster.
+    out_array:      The chunk's [bands, rows, cols] array.
+    x_start/y_start: The chunk's offsets in the output.
+    factors:        Decimation factors of the overviews, in order.
+    nodata:         NoData value to ignore, if any.
+    '''
+    for level, factor in enumerate(factors):
+        ov_array = downsample(out_array, factor, nodata)
+        for band in range(ov_array.shape[0]):
+            ov_band = t_fh.GetRasterBand(band + 1).GetOverview(level)
+            ov_band.WriteArray(ov_array[band], x_start // factor,
+                               y_start // factor)
+        ov_array = None
+
 
+def finish_cog(target_path, streamed, factors, nodata, cog_opts,
+               mem_budget=None):
+    '''
+    Fills in the overview levels that are too coarse to build chunk by chunk
+    (where a chunk covers less than a whole overview block), each from the
+    level before it, then copies the output into a Cloud-Optimized GeoTIFF
+    that uses those overviews as-is and replaces the output with it. The
+    levels are built a window of whole overview blocks at a time, so the
+    memory used doesn't depend on the size of the raster.
+    target_path:    Full path to the output raster.
+    streamed:       Number of overview levels written by WriteChunks().
+    factors:        Decimation factors of all the overview levels.
+    nodata:         NoData value to ignore, if any.
+    cog_opts:       Creation options for the COG driver.
+    mem_budget:     Total memory, in bytes, the run may use; the windows are
+                    kept to a small part of it.
+    '''
+    window_bytes = 256 * 1024**2
+    if mem_budget:
+        window_bytes = min(window_bytes, mem_budget // 8)
+
+    t_fh = gdal.Open(target_path, gdal.GA_Update)
+    bands = [t_fh.GetRasterBand(b + 1) for b in range(t_fh.RasterCount)]
+    for level in range(streamed, len(factors)):
+        # Averaging averages is only approximate where windows are partly
+        # NoData or run off the edge, but these levels are small anyways
+        if level:
+            sources = [band.GetOverview(level - 1) for band in bands]
+            ratio = factors[level] // factors[level - 1]
+        else:
+            sources = bands
+            ratio = factors[0]
+        targets = [band.GetOverview(level) for band in bands]
+        s_cols, s_rows = sources[0].XSize, sources[0].YSize
+        o_cols, o_rows = targets[0].XSize, targets[0].YSize
+
+        # Windows of whole target blocks, so each block is written once.
+        # The source window is read as-is, then padded out as float64 by
+        # downsample(), which also makes a mask and its result.
+        block_x, block_y = targets[0].GetBlockSize()
+        block_bytes = len(bands) * block_x * block_y * ratio * ratio * 8 * 3
+        blocks = max(1, int(math.sqrt(window_bytes // block_bytes)))
+        win_x = block_x * blocks
+        win_y = block_y * blocks
+
+        for y in range(0, o_rows, win_y):
+            for x in range(0, o_cols, win_x):
+                o_width = min(win_x, o_cols - x)
+                o_height = min(win_y, o_rows - y)
+                s_x = x * ratio
+                s_y = y * ratio
+                s_width = min(o_width * ratio, s_cols - s_x)
+                s_height = min(o_height * ratio, s_rows - s_y)
+                window = np.stack([source.ReadAsArray(s_x, s_y, s_width,
+                                                      s_height)
+                                   for source in sources])
+                ov_array = downsample(window, ratio, nodata)
+                window = None
+                for target, ov_band in zip(targets, ov_array):
+                    target.WriteArray(ov_band[:o_height, :o_width], x, y)
+                ov_array = None
+    bands = None
+    sources = None
+    targets = None
+    t_fh = None
+
+    cog_path = target_path + ".cog"
+    gdal.Translate(cog_path, target_path, format="COG",
+                   creationOptions=cog_opts)
+    os.replace(cog_path, target_path)
+
+
+def tile_paths(tile_dir, tile, outputs):
+    '''
+    Returns a dictionary of the path of each product's file for one tile
+    written by WriteTile(): {tile}.tif in tile_dir for a single product, or
+    {tile}_{name}.tif for each named product (see output_paths()).
+    tile_dir:       Directory the tiles are written to.
+    tile:           Tile name ("i-j").
+    outputs:        List of product names from method_outputs().
+    '''
+    return output_paths(os.path.join(tile_dir, tile + ".tif"), outputs)
+
+
+def worker_tag():
+    '''
+    Returns a name for this worker (host, process, and thread) that no other
+    worker on any machine shares, for files that only it may touch.
+    '''
+    return "{}.{}.{}".format(socket.gethostname(), os.getpid(),
+                             threading.get_ident())
+
+
+def WriteTile(run, tile, x_start, y_start, out_arrays):
+    '''
+    Writes a finished chunk to its own small GeoTIFF in run.tile_dir (one
+    for each product) instead of handing it to WriteChunks(). Each worker
+    writes its own tiles, so there's no shared output handle to wait on.
+    Files are written under a temporary name, flushed to disk, and renamed
+    into place, and the tile's .done marker is only written once all of its
+    products are there, so neither a worker that dies partway through nor a
+    machine that goes down leaves a tile that looks finished.
+    run:            The run context (see ParallelRCP()).
+    tile:           Tile name ("i-j").
+    x_start:        Column of the chunk's upper left pixel in the full raster.
+    y_start:        Row of the chunk's upper left pixel in the full raster.
+    out_arrays:     Dictionary of [bands, rows, cols] arrays keyed by product
+                    name, as built by ProcessSuperArray().
+    '''
+    # The tile's georeference is the full raster's, shifted to its corner
+    transform = list(run.transform)
+    transform[0] += x_start * transform[1] + y_start * transform[2]
+    transform[3] += x_start * transform[4] + y_start * transform[5]
+
+    driver = gdal.GetDriverByName('gtiff')
+    paths = tile_paths(run.tile_dir, tile, run.outputs)
+    for name, out_array in out_arrays.items():
+        out_bands, out_rows, out_cols = out_array.shape
+        # Unique to this worker, in case another one is writing the same
+        # tile after taking over its claim (see claim_tile())
+        temp_path = "{}.part.{}".format(paths[name], worker_tag())
+        t_fh = driver.Create(temp_path, out_cols, out_rows, out_bands,
+                             run.dtype, options=run.tile_opts)
+        t_fh.SetGeoTransform(transform)
+        t_fh.SetProjection(run.projection)
+        for band in range(out_bands):
+            t_band = t_fh.GetRasterBand(band + 1)
+            if out_bands == 1:
+                t_band.SetNoDataValue(run.t_nodata)
+            if run.scale != 1 or run.offset != 0:
+                t_band.SetScale(run.scale)
+                t_band.SetOffset(run.offset)
+            t_band.WriteArray(out_array[band])
+        t_band = None
+        t_fh = None
+        fsync_path(temp_path)
+        os.replace(temp_path, paths[name])
+
+    with open(os.path.join(run.tile_dir, tile + ".done"), 'w'):
+        pass
+
+
+def read_block(run, source_fh, x_off, y_off, x_size, y_size):
+    '''
+    Reads a block of the source into a [bands, rows, cols] array, which can
+    hang off the edges of the raster; the parts that do are filled with
+    NoData (or 0 if there isn't a NoData value).
+    run:            The run context (see ParallelRCP()).
+    source_fh:      Open GDAL handle to the source raster.
+    x_off, y_off:   Column and row of the block's upper left corner in the
+                    full raster (can be negative).
+    x_size, y_size: Columns and rows in the block.
+    '''
+    # Edge logic: only read the part of the block that's inside the raster
+    read_x_start = max(x_off, 0)
+    read_y_start = max(y_off, 0)
+    read_x_end = min(x_off + x_size, run.cols)
+    read_y_end = min(y_off + y_size, run.rows)
+
+    # Array holding superset of actual desired window, initialized to
+    # NoData value if present, 0 otherwise.
+    # Edge case logic insures edges fill appropriate portion when loaded in
+    # super_array must be of type float for fftconvolve; it's float32 unless
+    # the source needs float64 (see work_dtype()), and the methods keep to
+    # that type
+    if s_nodata or s_nodata == 0:
+        block = np.full((run.bands, y_size, x_size), s_nodata,
+                        dtype=run.work_dtype)
+    else:
+        block = np.full((run.bands, y_size, x_size), 0,
+                        dtype=run.work_dtype)
+    if read_x_end <= read_x_start or read_y_end <= read_y_start:
+        return block
+
+    # We perform the read calls within the multiprocessing portion to avoid
+    # passing the entire raster to each process. Each worker (process or
+    # thread) opened its own handle to the source file in pool_init(), so
+    # reads don't need a lock; separate handles can read at the same time.
+    # (A worker's reader thread has a handle of its own; see RunChunks().)
+    # This reads all the bands in one dataset-level call, which gives us a
+    # [bands, rows, cols] array (or just [rows, cols] if there's only one
+    # band) and lets GDAL read pixel-interleaved files (like our JPEG-in-TIFF
+    # imagery) in one pass instead of once per band.
+    read_array = source_fh.ReadAsArray(read_x_start, read_y_start,
+                                       read_x_end - read_x_start,
+                                       read_y_end - read_y_start)
+    # Arrays are of form [bands, rows, cols], thus [band, y, x] when slicing
+    if read_array.ndim == 2:
+        read_array = read_array[np.newaxis, :, :]
+
+    # The cells of our NoData-intiliazed block corresponding to the
+    # read_array are replaced with data from read_array. This changes every
+    # value, except for edge cases that leave portions of the block as
+    # NoData.
+    block[:, read_y_start - y_off:read_y_end - y_off,
+          read_x_start - x_off:read_x_end - x_off] = read_array
+    read_array = None
+
+    return block
+
+
+def read_window(run, source_fh, x_start, y_start, x_end, y_end, carry=None,
+                core=None):
+    '''
+    Reads the super array for one window of the raster: the window plus
+    run.f2 pixels of overlap on each side, where the raster has them, and
+    NoData (or 0) where it doesn't (see read_block()).
+    run:            The run context (see ParallelRCP()).
+    source_fh:      Open GDAL handle to the source raster.
+    x_start, y_start, x_end, y_end:
+                    Columns and rows of the window in the full raster
+                    (x/y_end not included).
+    carry:          Optional (rows, y_off) tuple of full-width rows of an
+                    earlier super array in the same column of chunks and
+                    the raster row the first of them came from. Any of
+                    those rows this window needs are copied instead of read
+                    again (see RunStrip()).
+    core:           Optional [bands, rows, cols] array of the window itself,
+                    already read with read_block(). Only the overlap around
+                    it is read.
+
+    Returns the [bands, rows, cols] super array.
+    '''
     # Super array calculations
-    # Non-edge-case values for super array
     # f2 is our doubled overlap value; we multipy by 2 here to get an overlap
     # on each side of the dimension (ie, f2 <> x values <> f2)
+    f2 = run.f2
     x_size = x_end - x_start + 2 * f2
     y_size = y_end - y_start + 2 * f2
     x_off = x_start - f2
     y_off = y_start - f2
 
-    # Values for ReadAsArray, these aren't changed later unelss the border case
-    # checks change them
-    read_x_off = x_off
-    read_y_off = y_off
-    read_x_size = x_size
-    read_y_size = y_size
-
-    # Slice values (of super_array) for copying read_array in to super_array,
-    # these aren't changed later unelss the border case checks change them
-    sa_x_start = 0
-    sa_x_end = x_size
-    sa_y_start = 0
-    sa_y_end = y_size
-
-    # Edge logic
-    # If super_array exceeds bounds of image:
-    #   Adjust x/y offset to appropriate place (for < 0 cases only).
-    #   Reduce read size by f2 (we're not reading that edge area on one side)
-    #   Move start or end value for super_array slice to be -f2 ([:-f2])
-    # Checks both x and y, setting read and slice values for each dimension if
-    # needed
-    if x_off < 0:
-        read_x_off = 0
-        read_x_size -= f2
-        sa_x_start = f2
-    if x_off + x_size > cols:
-        read_x_size -= f2
-        sa_x_end = -f2
-
-    if y_off < 0:
-        read_y_off = 0
-        read_y_size -= f2
-        sa_y_start = f2
-    if y_off + y_size > rows:
-        read_y_size -= f2
-        sa_y_end = -f2
+    if core is not None:
+        if not f2:
+            return core
+        # The rows above and below the window, full width, and the columns
+        # on either side of it
+        super_array = np.empty((run.bands, y_size, x_size), dtype=core.dtype)
+        super_array[:, f2:-f2, f2:-f2] = core
+        super_array[:, :f2] = read_block(run, source_fh, x_off, y_off,
+                                         x_size, f2)
+        super_array[:, -f2:] = read_block(run, source_fh, x_off, y_end,
+                                          x_size, f2)
+        super_array[:, f2:-f2, :f2] = read_block(
+            run, source_fh, x_off, y_start, f2, y_end - y_start)
+        super_array[:, f2:-f2, -f2:] = read_block(
+            run, source_fh, x_end, y_start, f2, y_end - y_start)
+        return super_array
+
+    if carry is None or carry[0].shape[2] != x_size:
+        return read_block(run, source_fh, x_off, y_off, x_size, y_size)
+
+    # Rows we already have
+    rows, rows_y_off = carry
+    reuse_start = max(y_off, rows_y_off)
+    reuse_end = min(y_off + y_size, rows_y_off + rows.shape[1])
+    if reuse_end <= reuse_start:
+        return read_block(run, source_fh, x_off, y_off, x_size, y_size)
+
+    super_array = np.empty((run.bands, y_size, x_size), dtype=rows.dtype)
+    super_array[:, reuse_start - y_off:reuse_end - y_off] = \
+        rows[:, reuse_start - rows_y_off:reuse_end - rows_y_off]
+    # Read whatever's above and below them
+    if reuse_start > y_off:
+        super_array[:, :reuse_start - y_off] = read_block(
+            run, source_fh, x_off, y_off, x_size, reuse_start - y_off)
+    if reuse_end < y_off + y_size:
+        super_array[:, reuse_end - y_off:] = read_block(
+            run, source_fh, x_off, reuse_end, x_size,
+            y_off + y_size - reuse_end)
+    return super_array
+
+
+def process_window(run, tile, x_start, y_start, x_end, y_end,
+                   super_array=None):
+    '''
+    Reads the super array for one window of the raster (the window plus
+    run.f2 pixels of overlap on each side, see read_window()), runs
+    the run's method (or chain of methods) on each band, and trims the
+    results back down to the window. Used by ProcessSuperArray(), normally
+    once per chunk with the chunk as the window.
+    run:            The run context (see ParallelRCP()).
+    tile:           Name of the tile the window belongs to (for methods that
+                    need unique temp file names).
+    x_start, y_start, x_end, y_end:
+                    Columns and rows of the window in the full raster
+                    (x/y_end not included).
+    super_array:    The window's super array, if it's already been read
+                    (see read_window()).
+
+    Returns a dictionary of [bands, rows, cols] result arrays keyed by
+    product name (None for single-output methods), the number of valid
+    pixels in the window, and the read and compute times in seconds.
+    '''
+    # Unpack general info
+    f2 = run.f2
+
+    bands = run.bands
+
+    method = run.method
+    options = run.options  # dictionary of options
+
+    t_nodata = run.t_nodata
+
+    # Read the super array, unless it's been read ahead of time (see
+    # RunChunks()). The window itself is read first: if it's all NoData the
+    # results would all be reset to NoData anyway, so there's no need to
+    # read the overlap around it (or run the method) at all.
+    read_start = time.perf_counter()
+    if super_array is None:
+        core = read_block(run, worker.source_fh, x_start, y_start,
+                          x_end - x_start, y_end - y_start)
+        if s_nodata is not None and not np.any(core != s_nodata):
+            out_arrays = {name: np.full(core.shape, t_nodata,
+                                        dtype=run.np_dtype)
+                          for name in run.outputs}
+            return (out_arrays, 0, time.perf_counter() - read_start, 0)
+        super_array = read_window(run, worker.source_fh, x_start, y_start,
+                                  x_end, y_end, core=core)
+        core = None
+    compute_start = time.perf_counter()
+    valid = 0
+
+    # The methods all work on a single 2D array, so we run the method on each
+    # band of the in-memory super array and stack the results back up. Each
+    # product of a multi-output method gets its own stack.
+    out_bands = {}
+    for band in range(bands):
+        band_array = super_array[band]
+
+        # If nodata in source, make sure nodata areas are transferred back.
+        # slice down super_array to get original chunk of data (ie,
+        # super_array minus additional data on edges) to use for finding
+        # NoData areas
+        if f2 > 0:
+            read_sub_array = band_array[f2:-f2, f2:-f2]
+        else:
+            read_sub_array = band_array
+        if s_nodata is not None:
+            band_valid = int(np.count_nonzero(read_sub_array != s_nodata))
+        else:
+            band_valid = read_sub_array.size
+        valid += band_valid
+
+        # The planning pass only skips chunks it can be sure are empty (see
+        # classify_chunk()), so this is where the rest of the empty ones are
+        # found: everything in the window would be reset to NoData anyway,
+        # so there's no need to run the method at all
+        if not band_valid:
+            for name in run.outputs:
+                out_bands.setdefault(name, []).append(np.full(
+                    read_sub_array.shape, t_nodata, dtype=run.np_dtype))
+            continue
+
+        # Do something with the data. For a chain of methods, each stage
+        # works on the previous stage's in-memory result; only the last
+        # one's result gets written.
+        new_data = band_array
+        for stage_num, stage in enumerate(method):
+            if stage_num > 0 and s_nodata is not None:
+                # Put NoData back where the source had it (and wherever the
+                # previous stage left NaNs) so the next stage sees the same
+                # NoData areas as the source
+                new_data = np.where(
+                    np.isnan(new_data) | (band_array == s_nodata),
+                    s_nodata, new_data)
+            new_data = methods[stage].function(new_data, options, tile, f2)
+
+        # Single-output methods give back one array; treat it as an unnamed
+        # product so everything downstream only has to handle products
+        if not isinstance(new_data, dict):
+            new_data = {None: new_data}
+
+        for name, product in new_data.items():
+            # Resulting array is a superset of the data; we need to strip off
+            # the overlap before writing it
+            if f2 > 0:
+                temp_array = product[f2:-f2, f2:-f2]
+            else:
+                temp_array = product
+            if run.compact:
+                temp_array, clipped = encode_output(
+                    temp_array, run.np_dtype, t_nodata, run.scale,
+                    run.offset, None if s_nodata is None
+                    else read_sub_array != s_nodata)
+                if clipped:
+                    print("Tile {}: {} cells were outside the range of the "
+                          "{} output and were clipped; rerun with --float32 "
+                          "(or a larger --scale) to keep them".format(
+                              tile, clipped, np.dtype(run.np_dtype).name))
+            if s_nodata is not None:
+                # Reset NoData values in our result to match the NoData areas
+                # in the source array (areas in temp_array where
+                # corresponding cells in read_sub_array==NoData get set to
+                # t_nodata)
+                np.putmask(temp_array, read_sub_array == s_nodata, t_nodata)
+
+            out_bands.setdefault(name, []).append(temp_array)
+
+    out_arrays = {name: np.stack(out_bands[name]) for name in out_bands}
+    compute_end = time.perf_counter()
+
+    # Explicit memory management
+    super_array = None
+    band_array = None
+    new_data = None
+    read_sub_array = None
+    temp_array = None
+    out_bands = None
+
+    return (out_arrays, valid, compute_start - read_start,
+            compute_end - compute_start)
+
+
+def ProcessSuperArray(task, super_array=None):
+    '''
+    Given starting and ending indices of a chunk, overlap value, and relevant
+    raster file info from the run context, this function calculates the
+    indices of a "super array" that is 'overlap'-values larger than the chunk
+    in each dimension (-x, x, -y, y). It automatically computes edge conditions
+    for chunks on the edges of the original raster. It then calls the specified
+    method on this super array, masks out the overlap areas on the resulting
+    array (if nodata is set), and sends the processed chunk to the writer
+    queue to be written to the output file. The reading and processing is
+    done by process_window().
+
+    Relies on having a per-worker source file handle, run context, and a
+    global write queue, normally set up in each worker by the pool_init()
+    initializer.
+
+    task:           (i, j, progress) tuple: the chunk's row and column in the
+                    chunk grid and its place in the dispatch order. Everything
+                    that's the same for every chunk comes from the run context
+                    (see pool_init()) so that it's only sent to each worker
+                    once instead of being pickled into every task. An
+                    optional fourth value splits the chunk into that many
+                    pieces in each direction, each processed as its own
+                    (smaller) super array with the full overlap and then put
+                    back together before writing (see RunChunk()).
+    super_array:    The chunk's super array, if it's already been read (see
+                    RunChunks()). Ignored if the chunk is split.
+
+    Returns the chunk's tile name so the caller can report progress, along
+    with its telemetry (see log_telemetry()).
+    '''
+
+    run = worker.run
+
+    # Unpack chunk-specific info
+    i, j, progress = task[:3]
+    tile = "{}-{}".format(i, j)
+    x_start = run.col_splits[j]
+    y_start = run.row_splits[i]
+    x_end = run.col_splits[j + 1]
+    y_end = run.row_splits[i + 1]
+    # Pieces have to be at least a pixel across
+    split = task[3] if len(task) > 3 else 1
+    split = max(1, min(split, x_end - x_start, y_end - y_start))
+
+    # Unpack general info
+    total_chunks = run.total_chunks
+    starttime = run.start_time
 
     percent = (progress / total_chunks) * 100
     elapsed = datetime.datetime.now() - starttime
+    pieces = "" if split == 1 else " in {0} x {0} pieces".format(split)
     if verbose:
-        print("Tile {0}: {1:d} of {2:d} ({3:0.3f}%) started at {4} Indices: [{5}:{6}, {7}:{8}] PID: {9}".format(tile, progress, total_chunks, percent, elapsed, read_y_off, read_y_off + read_y_size, read_x_off, read_x_off + read_x_size, mp.current_process().pid))
+        print("Tile {0}: {1:d} of {2:d} ({3:0.3f}%) started at {4}{5} Indices: [{6}:{7}, {8}:{9}] PID: {10}".format(tile, progress, total_chunks, percent, elapsed, pieces, y_start, y_end, x_start, x_end, mp.current_process().pid))
     else:
-        print("Tile {0}: {1:d} of {2:d} ({3:0.3f}%) started at {4}".format(tile, progress, total_chunks, percent, elapsed))
-
-    for band in range(1, bands + 1):
-        # We perform the read calls within the multiprocessing portion to avoid
-        # passing the entire raster to each process. This means we need to
-        # acquire a lock prior to reading in the chunk so that we're not trying
-        # to read the file at the same time.
-        with lock:
-            # ===== LOCK HERE =====
-            # Open source file handle
-            s_fh = gdal.Open(source_dem_path, gdal.GA_ReadOnly)
-            s_band = s_fh.GetRasterBand(band)
-
-            # Master read call. read_ variables have been changed for edge
-            # cases if needed
-            read_array = s_band.ReadAsArray(read_x_off, read_y_off,
-                                            read_x_size, read_y_size)
-            # Arrays are of form [rows, cols], thus [y, x] when slicing
-
-            s_band = None
-            s_fh = None
-            # ===== UNLOCK HERE =====
-
-        # Array holding superset of actual desired window, initialized to
-        # NoData value if present, 0 otherwise.
-        # Edge case logic insures edges fill appropriate portion when loaded in
-        # super_array must be of type float for fftconvolve
-        if s_nodata or s_nodata == 0:
-            super_array = np.full((y_size, x_size), s_nodata)
-        else:
-            super_array = np.full((y_size, x_size), 0)
-
-        # The cells of our NoData-intiliazed super_array corresponding to the
-        # read_array are replaced with data from read_array. This changes every
-        # value, except for edge cases that leave portions of the super_array
-        # as NoData.
-        super_array[sa_y_start:sa_y_end, sa_x_start:sa_x_end] = read_array
-        # Do something with the data
-        if method == "blur_gauss":
-            new_data = blur_gauss(super_array, options["sigma"], options["radius"])
-        elif method == "blur_mean":
-            new_data = blur_mean(super_array, options["radius"])
-        elif method == "blur_toews":
-            new_data = blur_toews(super_array, options["radius"])
-        elif method == "mdenoise":
-            new_data = mdenoise(super_array, options["t"],
-                                options["n"], options["v"], tile)
-        elif method == "clahe":
-            new_data = exposure.equalize_adapthist(super_array.astype(int),
-                                                   options["kernel_size"],
-                                                   options["clip_limit"])
-            new_data *= 255.0  # scale CLAHE from 0-1 to 0-255
-        elif method == "TPI":
-            new_data = TPI(super_array, options["radius"])
-        elif method == "hillshade":
-            new_data = hillshade(super_array, options["az"], options["alt"], s_nodata)
-        elif method == "skymodel":
-            new_data = skymodel(super_array, options["lum_lines"], f2, s_nodata, cell_size)
-        elif method == "test":
-            new_data = super_array + 5
-        else:
-            raise NotImplementedError("Method not implemented: {}".format(
-                method))
+        print("Tile {0}: {1:d} of {2:d} ({3:0.3f}%) started at {4}{5}".format(tile, progress, total_chunks, percent, elapsed, pieces))
+
+    # Almost always the whole chunk is one super array. When it's split,
+    # each piece's results are copied into place in arrays for the whole
+    # chunk so that it's still written (and journaled) all at once.
+    x_breaks = [x_start + (x_end - x_start) * n // split
+                for n in range(split + 1)]
+    y_breaks = [y_start + (y_end - y_start) * n // split
+                for n in range(split + 1)]
+    out_arrays = None
+    valid = 0
+    read_secs = 0.
+    compute_secs = 0.
+    for sub_i in range(split):
+        for sub_j in range(split):
+            products, sub_valid, sub_read, sub_compute = process_window(
+                run, tile, x_breaks[sub_j], y_breaks[sub_i],
+                x_breaks[sub_j + 1], y_breaks[sub_i + 1],
+                super_array if split == 1 else None)
+            valid += sub_valid
+            read_secs += sub_read
+            compute_secs += sub_compute
+            if split == 1:
+                out_arrays = products
+                continue
+            if out_arrays is None:
+                out_arrays = {name: np.empty(
+                    (product.shape[0], y_end - y_start, x_end - x_start),
+                    dtype=product.dtype)
+                    for name, product in products.items()}
+            for name, product in products.items():
+                out_arrays[name][:, y_breaks[sub_i] - y_start:
+                                 y_breaks[sub_i + 1] - y_start,
+                                 x_breaks[sub_j] - x_start:
+                                 x_breaks[sub_j + 1] - x_start] = product
+            products = None
+
+    # Hand the finished chunk (all bands of all products) off to the writer
+    # process, which holds the only open handles to the target files and
+    # writes each product with one dataset-level call. put() blocks if the
+    # writer has fallen behind, which keeps finished chunks from piling up in
+    # memory. Runs that write each chunk to its own file (like manifest
+    # runs) write it right here instead.
+    put_start = time.perf_counter()
+
+    # A sparse output leaves empty chunks unwritten, same as the ones the
+    # planning pass found; the writer still journals them
+    if not valid and run.sparse and not run.tile_dir:
+        out_arrays = {}
+
+    if run.tile_dir:
+        WriteTile(run, tile, x_start, y_start, out_arrays)
+    else:
+        write_queue.put((tile, x_start, y_start, out_arrays))
+
+    # Telemetry for the chunk; ParallelRCP() adds the writer's time and logs
+    # it. The time spent blocked on a full queue (ie, waiting for the writer)
+    # has replaced the old write lock as the only thing workers wait on.
+    stats = {"tile": tile, "pid": os.getpid(),
+             "thread": threading.get_ident(),
+             "read": read_secs,
+             "compute": compute_secs,
+             "queue_wait": time.perf_counter() - put_start,
+             "valid": valid, "peak_rss": peak_rss()}
+    if run.tile_dir:
+        stats["queue_wait"] = 0.
+        stats["write"] = time.perf_counter() - put_start
 
-        # Resulting array is a superset of the data; we need to strip off the
-        # overlap before writing it
-        if f2 > 0:
-            temp_array = new_data[f2:-f2, f2:-f2]
+    # Explicit memory management
+    super_array = None
+    out_arrays = None
+
+    return tile, stats
+
+
+def RunChunk(task, super_array=None):
+    '''
+    Runs ProcessSuperArray() on a chunk, catching any exception so that one
+    bad chunk doesn't take the whole run down with it. A chunk that fails is
+    tried again up to run.retries more times, each time split into smaller
+    pieces (2 x 2, then 4 x 4, and so on; see ProcessSuperArray()), since
+    some failures (like mdenoise.exe crashing on large windows) depend on
+    the size of the super array.
+    task:           (i, j, progress) tuple (see ProcessSuperArray()).
+    super_array:    The chunk's super array, if it's already been read (see
+                    RunChunks()); only used for the first attempt.
+
+    Returns the chunk's tile name along with either its telemetry or, if
+    every attempt failed, a dictionary describing the failure (with the
+    last attempt's "error" and "traceback" and the number of "attempts").
+    '''
+    run = worker.run
+    i, j, progress = task
+    tile = "{}-{}".format(i, j)
+    attempts = run.retries + 1
+    if getattr(worker, "started", None) is not None:
+        worker.started.put((tile, os.getpid()))
+    for attempt in range(attempts):
+        try:
+            return ProcessSuperArray((i, j, progress, 2 ** attempt),
+                                     super_array)
+        except Exception as e:
+            super_array = None
+            error = "{}: {}".format(type(e).__name__, e)
+            trace = traceback.format_exc()
+            print("Tile {} failed (attempt {} of {}): {}".format(
+                tile, attempt + 1, attempts, error))
+    return tile, {"tile": tile, "error": error, "traceback": trace,
+                  "attempts": attempts}
+
+
+def read_chunk(run, source_fh, task):
+    '''
+    Reads the super array for a whole chunk (see read_window()). Run on the
+    worker's reader thread by RunChunks(); returns None instead of raising
+    so that a failed read just gets tried again (and reported) by
+    RunChunk().
+    run:            The run context.
+    source_fh:      The worker's handle to the source raster.
+    task:           (i, j, progress) tuple.
+    '''
+    i, j = task[0], task[1]
+    try:
+        return read_window(run, source_fh, run.col_splits[j],
+                           run.row_splits[i], run.col_splits[j + 1],
+                           run.row_splits[i + 1])
+    except Exception:
+        return None
+
+
+def RunChunks(batch):
+    '''
+    Runs a batch of chunks through RunChunk() one after another, reading
+    each chunk's super array on a reader thread while the one before it is
+    being processed. Reading from disk (or the
+    network) and computing overlap this way instead of taking turns, at the
+    cost of one more super array in memory. The reader thread has its own
+    handle to the source, since GDAL handles can't be used by two threads
+    at once.
+    batch:          List of (i, j, progress) tasks, in the order to run them.
+
+    Returns a list of RunChunk()'s results for the chunks. The read time in
+    each chunk's telemetry is just the time spent waiting for its read to
+    finish.
+    '''
+    run = worker.run
+    results = []
+    reader = ThreadPool(processes=1)
+    try:
+        reading = reader.apply_async(read_chunk,
+                                     (run, worker.reader_fh, batch[0]))
+        for n, task in enumerate(batch):
+            wait_start = time.perf_counter()
+            super_array = reading.get()
+            wait = time.perf_counter() - wait_start
+            if n + 1 < len(batch):
+                reading = reader.apply_async(
+                    read_chunk, (run, worker.reader_fh, batch[n + 1]))
+            tile, stats = RunChunk(task, super_array)
+            super_array = None
+            if "error" not in stats:
+                stats["read"] += wait
+            results.append((tile, stats))
+    finally:
+        reader.close()
+        reader.join()
+    return results
+
+
+def RunStrip(strip):
+    '''
+    Runs a vertical strip of chunks (all in the same column of the chunk
+    grid) through RunChunk() from top to bottom. Neighboring chunks in a
+    column share 2 * f2 rows of overlap, so instead of reading each super
+    array from scratch we hold on to the bottom rows of one chunk's super
+    array and only read the rows below them for the next chunk (see
+    read_window()). For large overlaps (like skymodel's) this cuts the
+    amount read several-fold.
+    strip:          List of (i, j, progress) tasks in the same column, sorted
+                    by row.
+
+    Returns a list of RunChunk()'s results for the chunks.
+    '''
+    run = worker.run
+    f2 = run.f2
+    results = []
+    carry = None
+    for n, task in enumerate(strip):
+        i, j = task[0], task[1]
+        read_start = time.perf_counter()
+        try:
+            super_array = read_window(run, worker.source_fh,
+                                      run.col_splits[j], run.row_splits[i],
+                                      run.col_splits[j + 1],
+                                      run.row_splits[i + 1], carry)
+        except Exception:
+            # RunChunk() will try the read again (and report it)
+            super_array = None
+        read_secs = time.perf_counter() - read_start
+
+        # Keep the rows the next chunk will need. This has to be a copy,
+        # since methods are free to change the super array in place.
+        carry = None
+        if super_array is not None and n + 1 < len(strip):
+            y_off = run.row_splits[i] - f2
+            next_y_off = run.row_splits[strip[n + 1][0]] - f2
+            if 0 < next_y_off - y_off < super_array.shape[1]:
+                carry = (super_array[:, next_y_off - y_off:].copy(),
+                         next_y_off)
+
+        tile, stats = RunChunk(task, super_array)
+        super_array = None
+        if "error" not in stats:
+            stats["read"] += read_secs
+        results.append((tile, stats))
+    return results
+
+
+def classify_chunk(s_band, x_off, y_off, x_size, y_size, decimated=True,
+                   samples=16):
+    '''
+    Cheaply works out whether a chunk of the source has any valid data, so
+    that ParallelRCP() can skip the ones that are entirely NoData, and
+    gathers a couple of statistics for estimate_chunk_cost(). This runs in
+    the parent before anything is handed out, so it must never read the
+    chunk itself. Sparse files can tell us directly which chunks are empty.
+    With decimated, we also do a decimated, averaged read for the
+    statistics, which only makes sense when GDAL can satisfy it from
+    overviews; without them, it would decode every block of the source.
+    When the mask is just the NoData value (the usual case for DEMs), that's
+    a single read of the data band: averaging skips NoData, so a cell of
+    the decimated array only comes out as NoData if none of its pixels are
+    valid, and the rest give us the relief. Other masks need a read of the
+    mask band as well.
+    An overview built with nearest resampling (gdaladdo's default) can miss
+    a thin strip of valid pixels entirely, so a chunk that only looks empty
+    in the overviews is called "partial" (with no valid pixels, so it's
+    handed out last) rather than skipped. The worker then finds out for sure
+    from the read it does anyway (see process_window()).
+    Returns "empty", "partial", or "full", the fraction of valid pixels (for
+    a NoData-value mask, the fraction of decimated cells with any valid
+    pixels, which is close enough for ordering chunks), and the relief (max
+    - min of the decimated valid elevations). A chunk that isn't known to
+    be empty and wasn't read is "full", with no relief.
+    s_band:         Source band (band 1 of the source).
+    x/y_off:        Upper left corner of the chunk.
+    x/y_size:       Dimensions of the chunk.
+    decimated:      Do the decimated read as well (the source has
+                    overviews).
+    samples:        Size of the decimated read along each dimension.
+    '''
+    if hasattr(s_band, "GetDataCoverageStatus"):
+        flags, _ = s_band.GetDataCoverageStatus(x_off, y_off, x_size, y_size)
+        if flags == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+            return "empty", 0., 0.
+    if not decimated:
+        return "full", 1., 0.
+
+    buf_x = min(samples, x_size)
+    buf_y = min(samples, y_size)
+    nodata = s_band.GetNoDataValue()
+
+    # Averaged elevations ignore NoData, so any cell with a valid pixel in
+    # it has a usable value
+    elevs = s_band.ReadAsArray(
+        x_off, y_off, x_size, y_size, buf_xsize=buf_x, buf_ysize=buf_y,
+        buf_type=gdal.GDT_Float32, resample_alg=gdal.GRIORA_Average)
+    if s_band.GetMaskFlags() == gdal.GMF_NODATA and nodata is not None:
+        # The decimated read comes back as Float32, NoData included
+        mask = (elevs != np.float32(nodata)) & ~np.isnan(elevs)
+        valid = float(mask.mean())
+    else:
+        mask = s_band.GetMaskBand().ReadAsArray(
+            x_off, y_off, x_size, y_size, buf_xsize=buf_x, buf_ysize=buf_y,
+            buf_type=gdal.GDT_Float32, resample_alg=gdal.GRIORA_Average)
+        valid = float(mask.mean()) / 255.
+        mask = mask > 0
+
+    if not mask.any():
+        return "partial", 0., 0.
+
+    valid_elevs = elevs[mask]
+    relief = float(valid_elevs.max() - valid_elevs.min())
+
+    if valid >= 1.:
+        return "full", 1., relief
+    return "partial", valid, relief
+
+
+def has_data_coverage(s_band, cols, rows):
+    '''
+    Whether the source's driver can say which parts of the raster hold data
+    without reading them (sparse GeoTIFFs, for instance; see
+    classify_chunk()).
+    s_band:         Source band.
+    cols/rows:      The raster dimensions.
+    '''
+    if not hasattr(s_band, "GetDataCoverageStatus"):
+        return False
+    flags, _ = s_band.GetDataCoverageStatus(0, 0, cols, rows)
+    return not flags & gdal.GDAL_DATA_COVERAGE_STATUS_UNIMPLEMENTED
+
+
+def estimate_chunk_cost(method, x_size, y_size, f2, valid, relief,
+                        cell_size):
+    '''
+    Relative cost of processing a chunk, used to hand out the expensive
+    chunks first so a run doesn't end with one process grinding away on the
+    last big chunk while the rest sit idle. Only the ordering matters, not
+    the units.
+    method:         Name of the raster processing method.
+    x/y_size:       Dimensions of the chunk.
+    f2:             Overlap on each side of the chunk.
+    valid:          Fraction of the chunk's pixels that aren't NoData.
+    relief:         Elevation range of the chunk, from classify_chunk().
+    cell_size:      Cell size of the raster (same units as relief).
+    '''
+    # Reads and the FFT/gradient-based methods work on the whole super array
+    # whether or not it's NoData
+    super_area = (x_size + 2 * f2) * (y_size + 2 * f2)
+    area = x_size * y_size
+    steepness = relief / (max(x_size, y_size) * cell_size)
+
+    # A chain of methods costs the sum of its stages
+    cost = 0
+    for stage in split_stages(method):
+        if methods[stage].cost:
+            cost += methods[stage].cost(super_area, area, valid, steepness)
         else:
-            temp_array = new_data
-        # If nodata in source, make sure nodata areas are transferred back
-        if s_nodata is not None:
-            # slice down super_array to get original chunk of data (ie,
-            # super_array minus additional data on edges) to use for finding
-            # NoData areas
-            if f2 > 0:
-                read_sub_array = super_array[f2:-f2, f2:-f2]
+            cost += super_area
+    return cost
+
+
+def fsync_path(path):
+    '''
+    Asks the OS to write a file's data all the way to disk. GDAL's
+    FlushCache() only hands its blocks to the OS, which can sit on them in
+    the page cache for a while; a node that loses power in the meantime
+    loses them too.
+    path:           Full path to the file.
+    '''
+    # Windows can only commit files opened for writing
+    fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def plain_json(obj):
+    '''
+    json default for the journal header and the manifest: numpy scalars
+    and arrays (options computed with numpy when ParallelRCP() is called
+    from Python) become plain numbers and lists.
+    obj:            The object json can't serialize itself.
+    '''
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return float(obj)
+
+
+def changed_settings(header, settings):
+    '''
+    Returns the names of the run settings that differ between a journal's
+    header and the run trying to resume it (see ParallelRCP()). They're
+    compared as JSON so that tuples and lists (and NaN nodata values)
+    compare the way they're stored.
+    header:         The journal header (see read_journal()).
+    settings:       Dictionary of the new run's settings.
+    '''
+    return [key for key in settings
+            if json.dumps(header.get(key), sort_keys=True) !=
+            json.dumps(settings[key], sort_keys=True)]
+
+
+def read_journal(journal_path):
+    '''
+    Reads a chunk journal written by WriteChunks(). The first line is a
+    header describing the run's chunk grid and the settings that affect its
+    output (see ParallelRCP()); every line after that is a chunk whose write
+    has been flushed to disk.
+    Returns the header dictionary and a set of the finished tiles.
+    journal_path:   Full path to the journal file.
+    '''
+    header = None
+    done = set()
+    with open(journal_path, 'r') as j:
+        for line in j:
+            # A crash partway through appending can leave a partial last line
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if header is None:
+                header = entry
             else:
-                read_sub_array = super_array
+                done.add(entry["tile"])
+    if header is None:
+        raise ValueError("Journal {} is empty.".format(journal_path))
+    return header, done
 
-            # Reset NoData values in our result to match the NoData areas in
-            # the source array (areas in temp_array where corresponding cells
-            # in read_sub_array==NoData get set to t_nodata)
-            np.putmask(temp_array, read_sub_array == s_nodata, t_nodata)
 
-        with lock:
-            # ===== LOCK HERE =====
-            # Open target file handle
-            t_fh = gdal.Open(target_dem_path, gdal.GA_Update)
-            t_band = t_fh.GetRasterBand(band)
+# Columns of the per-chunk telemetry log, in order. Times are in seconds,
+# peak_rss is in bytes, and valid is the number of non-NoData pixels in the
+# chunk (all bands).
+telemetry_fields = ["tile", "pid", "thread", "read", "compute",
+                    "queue_wait", "write", "valid", "peak_rss"]
 
-            # Sliced down chunk gets written into new file its original
-            # position in the file (super array dimensions and offsets have
-            # been calculated, used, and discarded and are no longer
-            # applicable)
-            t_band.WriteArray(temp_array, x_start, y_start)
 
-            t_band = None
-            t_fh = None
-            # ===== UNLOCK HERE =====
+def peak_rss(children=False):
+    '''
+    Returns the peak resident memory of this process so far, in bytes, or
+    None where the resource module isn't available (Windows). Pool workers
+    are replaced every maxtasksperchild chunks, which resets this.
+    children:       Return the largest peak of this process and any child
+                    processes it has waited on (ie, pool workers and the
+                    writer) instead.
+    '''
+    if resource is None:
+        return None
+    whos = [resource.RUSAGE_SELF]
+    if children:
+        whos.append(resource.RUSAGE_CHILDREN)
+    rss = max(resource.getrusage(who).ru_maxrss for who in whos)
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+
+def drain_write_times(timing_queue, write_times, timeout=None):
+    '''
+    Moves the (tile, seconds) write times WriteChunks() has reported from
+    its queue into the write_times dictionary without blocking (or waiting
+    up to timeout seconds for the first one).
+    timing_queue:   mp.Queue() that WriteChunks() puts write times on.
+    write_times:    Dictionary of write time by tile to add them to.
+    timeout:        Seconds to wait for the first write time, if any.
+    '''
+    try:
+        tile, seconds = timing_queue.get(timeout=timeout) if timeout \
+            else timing_queue.get_nowait()
+        write_times[tile] = seconds
+        while True:
+            tile, seconds = timing_queue.get_nowait()
+            write_times[tile] = seconds
+    except queue.Empty:
+        pass
 
-    # Explicit memory management
-    read_array = None
-    super_array = None
-    new_data = None
-    read_sub_array = None
-    temp_array = None
 
+def poll_results(results, check, count, interval=1):
+    '''
+    Yields the results of a pool's imap_unordered() as they come in, calling
+    check() every interval seconds while waiting for the next one. check()
+    raises to stop the run, which keeps the loop over the results from
+    waiting on a pool that's stuck (or on work that will be thrown away). It
+    returns a list of results to stand in for work the pool lost (see
+    find_lost_work()), which are yielded in its place; once count results
+    have been yielded, the pool isn't waited on any more.
+    results:        The iterator returned by imap_unordered().
+    check:          Function to call while waiting.
+    count:          Number of results expected.
+    interval:       Seconds to wait for a result between calls to check().
+    '''
+    received = 0
+    while received < count:
+        try:
+            result = results.next(timeout=interval)
+        except StopIteration:
+            return
+        except mp.TimeoutError:
+            for result in check():
+                received += 1
+                yield result
+            continue
+        received += 1
+        yield result
+
+
+def find_lost_work(pool, started, running, returned, gone, grace=5):
+    '''
+    Finds the chunks whose pool worker process died partway through them
+    (killed by the OOM killer, or a crash in GDAL or numba code). The pool
+    quietly replaces the process but never hands its chunk back, so without
+    this a run would wait on it forever. Returns a list of (tile, exitcode)
+    for the chunks lost; exitcode is None if the pool had already cleaned
+    up after the process.
+    pool:           The mp.Pool().
+    started:        mp.Queue() of (tile, pid) put by RunChunk() as each
+                    chunk starts.
+    running:        Dictionary of the tile each worker last started, by pid;
+                    kept up to date here.
+    returned:       Set of the tiles whose results have come back.
+    gone:           Dictionary of when each worker was first found gone
+                    with its chunk outstanding, by pid; kept up to date here.
+    grace:          Seconds to give a chunk whose worker is gone to come
+                    back anyway, since a worker that exits normally (every
+                    maxtasksperchild chunks) can do so before its last
+                    result has made it to us.
+    '''
+    # The pool drops workers from its list once they've exited
+    alive = {process.pid: process for process in list(pool._pool)}
+    try:
+        while True:
+            tile, pid = started.get_nowait()
+            running[pid] = tile
+    except queue.Empty:
+        pass
 
-def lock_init(l):
+    lost = []
+    now = time.time()
+    for pid, tile in list(running.items()):
+        process = alive.get(pid)
+        exitcode = process.exitcode if process is not None else None
+        if process is not None and exitcode is None:
+            continue
+        if tile in returned:
+            del running[pid]
+            gone.pop(pid, None)
+            continue
+        if not exitcode and now - gone.setdefault(pid, now) < grace:
+            continue
+        del running[pid]
+        gone.pop(pid, None)
+        lost.append((tile, exitcode))
+    return lost
+
+
+def close_pool(pool, lost=False):
+    '''
+    Lets a pool's workers finish and exit instead of terminating them;
+    mp.Queue.put() hands a finished chunk off to a background feeder thread,
+    and terminating a worker before that thread has flushed would lose the
+    chunk. If any of the pool's work was lost (see find_lost_work()),
+    pool.join() would wait for it forever, so the workers are waited on
+    directly and then the pool is terminated.
+    pool:           The pool.
+    lost:           Whether any of the pool's work was lost.
+    '''
+    pool.close()
+    if not lost:
+        pool.join()
+        return
+    # The pool keeps replacing workers while it has work outstanding, so
+    # tell the ones it has now to exit ourselves (None is the pool's own
+    # signal for that) and wait for them before terminating the rest
+    workers = list(pool._pool)
+    for process in workers:
+        pool._inqueue.put(None)
+    for process in workers:
+        process.join(timeout=60)
+    pool.terminate()
+
+
+def log_telemetry(log, log_csv, record):
     '''
-    Mini helper method that allows us to use a global lock accross a pool of
-    processes. Used to safely read and write the input/output rasters.
-    l:              mp.lock() created and passed as part of mp.pool
-                    initialization
+    Writes one chunk's telemetry record to the log as a JSON line or a CSV
+    row.
+    log:            Open log file, or None to not log anything.
+    log_csv:        csv.DictWriter for the log if it's a CSV, otherwise None.
+    record:         Dictionary of the telemetry_fields for the chunk.
     '''
-    global lock
-    lock = l
+    if log is None:
+        return
+    if log_csv:
+        log_csv.writerow(record)
+    else:
+        log.write(json.dumps(record) + "\n")
+    log.flush()
+
+
+def print_telemetry_summary(records):
+    '''
+    Prints a table of where the chunks spent their time (read, compute,
+    waiting on the write queue, and the writer's time) along with peak
+    memory, so it's easy to see whether a run is bound by reads, compute, or
+    writes.
+    records:        List of telemetry dictionaries, one per chunk.
+    '''
+    if not records:
+        return
+    print("\nChunk telemetry ({} chunks, {} workers):".format(
+        len(records), len(set((r["pid"], r["thread"]) for r in records))))
+    print("\t{:<12}{:>12}{:>12}{:>12}{:>8}".format(
+        "", "total (s)", "mean (s)", "max (s)", "share"))
+    totals = {}
+    for field in ["read", "compute", "queue_wait", "write"]:
+        totals[field] = [r[field] for r in records if r.get(field) is not None]
+    grand_total = sum(sum(t) for t in totals.values()) or 1
+    for field, times in totals.items():
+        if not times:
+            continue
+        print("\t{:<12}{:>12.2f}{:>12.3f}{:>12.3f}{:>7.1f}%".format(
+            field, sum(times), sum(times) / len(times), max(times),
+            100 * sum(times) / grand_total))
+    rss = [r["peak_rss"] for r in records if r.get("peak_rss")]
+    if rss:
+        print("\tPeak worker RSS: {}".format(sizeof_fmt(max(rss))))
+    print("\tValid pixels: {}".format(sum(r["valid"] for r in records)))
+
+
+# Per-worker state set up by pool_init(). GDAL dataset handles can't be
+# shared between threads, so with the thread backend each thread needs its
+# own; with processes this is just the one worker's.
+worker = threading.local()
+
+
+def pool_init(run, q, started=None):
+    '''
+    Initializer for each worker in the pool. Opens the source raster once
+    and keeps the handle open for the life of the worker so that
+    ProcessSuperArray() doesn't have to reopen it (expensive for VRTs with
+    lots of member files) or lock around it for every chunk. Also keeps the
+    run context, sets up the global write queue that finished chunks are put
+    on for WriteChunks(), imports any plugin modules, and runs the method's
+    setup hook.
+    run:            Chunk() object holding everything that's the same for
+                    every chunk in the run (paths, chunk grid, nodata, method
+                    and options, etc; see ParallelRCP()). It's sent once per
+                    worker here instead of with every task.
+    q:              Queue that WriteChunks() is reading from
+    started:        Optional mp.Queue() that RunChunk() reports each chunk
+                    it starts on, so that the chunks of workers that die can
+                    be found (see find_lost_work()).
+    '''
+    global write_queue
+
+    # Being lazy, setting these as global so I don't have to alter the
+    # processing method signatures. They're the same for the whole run, so
+    # threads can share them.
+    global s_nodata
+    global cell_size
+    global verbose
+    global mdenoise_path
+    s_nodata = run.s_nodata
+    cell_size = run.cell_size
+    verbose = run.verbose
+    mdenoise_path = run.mdenoise_path
+
+    load_plugins(run.plugins)
+    gdal.UseExceptions()
+    worker.run = run
+    worker.source_fh = gdal.Open(run.in_dem_path, gdal.GA_ReadOnly)
+    # Chunks are read ahead with a handle of their own (see RunChunks())
+    if run.prefetch > 1:
+        worker.reader_fh = gdal.Open(run.in_dem_path, gdal.GA_ReadOnly)
+    # Working arrays the methods reuse from chunk to chunk (see
+    # scratch_array())
+    worker.scratch = {} if run.low_memory else None
+    write_queue = q
+    worker.started = started
+    for stage in run.method:
+        if methods[stage].setup:
+            methods[stage].setup(run.options)
+
+
+def WriteChunks(chunk_queue, target_paths, journal_path, error_queue,
+                overviews=(), nodata=None, timing_queue=None,
+                sync_interval=10):
+    '''
+    Writer loop run in its own process by ParallelRCP(). Keeps a single
+    handle to each target file open for the whole run and writes each
+    finished chunk as it comes off the queue, so the pool workers never have
+    to open the outputs themselves. Every sync_interval seconds the outputs
+    are flushed and synced to disk, and then the tiles written since the
+    last sync are added to the journal, so that an interrupted run (even one
+    cut short by a reboot) can be resumed. Syncing a batch at a time keeps
+    the writer from waiting on the disk (or network share) for every chunk;
+    a crash only costs the chunks written since the last sync. Stops when it
+    gets a None off the queue.
+
+    chunk_queue:    mp.Queue() of (tile, x_start, y_start, arrays) tuples put
+                    there by ProcessSuperArray(); arrays is a dictionary of
+                    [bands, rows, cols] arrays keyed by product name.
+    target_paths:   Dictionary of the full path to the output raster for
+                    each product name (see output_paths()).
+    journal_path:   Full path to the journal file (see read_journal()).
+    error_queue:    mp.Queue() that the first exception raised while writing
+                    is put on, so that ParallelRCP() can stop the run and
+                    report it.
+    overviews:      Decimation factors of the overview levels to build from
+                    each chunk as it's written (see write_overviews()).
+    nodata:         The outputs' NoData value, ignored when averaging
+                    overviews.
+    timing_queue:   mp.Queue() to put (tile, seconds) on for each chunk
+                    written, for the telemetry log. Each chunk's time
+                    includes its share of the sync it was journaled after.
+    sync_interval:  Most seconds to let written chunks wait for a sync.
+    '''
+
+    gdal.UseExceptions()
+    t_fhs = {name: gdal.Open(path, gdal.GA_Update)
+             for name, path in target_paths.items()}
+    journal = open(journal_path, 'a')
+    failed = False
+    # Written but not yet synced: (tile, write seconds) for each chunk
+    unsynced = []
+    sync_due = None
+
+    def sync():
+        # Make sure the chunks are actually on disk before we record them
+        # as done: FlushCache() gets them from GDAL to the OS, and the fsync
+        # from the OS to the disk
+        sync_start = time.perf_counter()
+        for name, t_fh in t_fhs.items():
+            t_fh.FlushCache()
+            fsync_path(target_paths[name])
+        for tile, seconds in unsynced:
+            journal.write(json.dumps({"tile": tile}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+        share = (time.perf_counter() - sync_start) / len(unsynced)
+        if timing_queue is not None:
+            for tile, seconds in unsynced:
+                timing_queue.put((tile, seconds + share))
+        del unsynced[:]
+
+    while True:
+        try:
+            if sync_due is None:
+                item = chunk_queue.get()
+            else:
+                item = chunk_queue.get(
+                    timeout=max(0, sync_due - time.time()))
+        except queue.Empty:
+            item = False
+        if unsynced and (item is None or item is False or
+                         time.time() >= sync_due):
+            try:
+                if not failed:
+                    sync()
+            except Exception as e:
+                failed = True
+                error_queue.put("Error syncing chunks {}: {}".format(
+                    ", ".join(tile for tile, seconds in unsynced), e))
+            # Chunks that didn't make it into the journal get redone when
+            # the run is resumed
+            del unsynced[:]
+            sync_due = None
+        if item is None:
+            break
+        if item is False:
+            continue
+
+        # If a write has already failed, keep draining the queue so the
+        # workers don't block forever on a full queue.
+        if failed:
+            continue
+
+        tile, x_start, y_start, out_arrays = item
+        try:
+            write_start = time.perf_counter()
+            for name, out_array in out_arrays.items():
+                # Sliced down chunk gets written into new file its original
+                # position in the file (super array dimensions and offsets
+                # have been calculated, used, and discarded and are no longer
+                # applicable). All the bands are written in one call;
+                # out_array is [bands, rows, cols], which is the
+                # band-sequential layout WriteRaster() expects by default.
+                t_fh = t_fhs[name]
+                out_bands, out_rows, out_cols = out_array.shape
+                buf_type = gdal_array.NumericTypeCodeToGDALTypeCode(
+                    out_array.dtype.type)
+                t_fh.WriteRaster(x_start, y_start, out_cols, out_rows,
+                                 np.ascontiguousarray(out_array).tobytes(),
+                                 buf_type=buf_type,
+                                 band_list=list(range(1, out_bands + 1)))
+                if overviews:
+                    write_overviews(t_fh, out_array, x_start, y_start,
+                                    overviews, nodata)
+            unsynced.append((tile, time.perf_counter() - write_start))
+            if sync_due is None:
+                sync_due = time.time() + sync_interval
+        except Exception as e:
+            failed = True
+            error_queue.put("Error writing chunk at {}, {}: {}".format(
+                x_start, y_start, e))
+
+    # Closing the file handles flushes everything to disk
+    t_fh = None
+    t_fhs = None
+    journal.close()
 
 
 def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
-                options, num_threads=1, verbose=False):
+                options, num_threads=1, verbose=False, mem_budget=None,
+                resume=False, sparse=False, plugins=(), cog=False,
+                log_path=None, backend="processes", float_output=False,
+                manifest=None, tile_output=False, retries=1, prefetch=0,
+                strips=False, low_memory=False, plan=True):
     '''
     Breaks a raster into smaller chunks for easier processing. This method
     determines the file parameters, prepares the output parameter, calculates
-    the start/end indices for each chunk, and stores info about each chunk in
-    a Chunk() object. This object is then passed to mp.pool() along with a
-    call to ProcessSuperArray() to perform the actual processing in parallel.
+    the start/end indices for each chunk, and stores the run-wide info in a
+    Chunk() object that's sent once to each worker by pool_init(). The
+    chunks themselves are then handed to the pool as small (i, j, progress)
+    tasks for ProcessSuperArray() to perform the actual processing in
+    parallel.
 
     in_dem_path:    Full path to input raster.
-    out_dem_path:   Full path to resulting raster.
-    chunk_size:     Square dimension of data chunk to process.
+    out_dem_path:   Full path to resulting raster. Methods that produce
+                    several products (like terrain) write each one to
+                    {base}_{name}{ext} instead (see output_paths()), all from
+                    a single read of each chunk.
+    chunk_size:     Square dimension of data chunk to process. Rounded to
+                    the nearest multiple of the output's block size so that
+                    chunks line up with the output tiles.
     overlap:        Data to be read beyond dimensions of chunk_size to ensure
                     methods that require neighboring pixels produce accurate
                     results on the borders. Should be at least 2x any filter
                     or kernel size for any method (will automattically be set
                     if method is blur_gauss, blur_mean, clahe, or TPI).
-    method:         Name of the raster processing tool to be run on the chunks.
+    method:         Name of the raster processing tool to be run on the chunks
+                    (see the methods registry and register_method()). Can
+                    also be a chain of methods, either comma-separated
+                    ("blur_gauss,skymodel") or a list, that are run back to
+                    back on each chunk in memory; only the last one's result
+                    is written. The overlap is the sum of what each stage
+                    needs.
     options:        Dictionary of opt, value pairs to be passed to the
                     processing tool. Any opts that don't apply to the specific
                     method will be ignored.
-    num_threads:    The number of concurrent processes to be spawned by
-                    mp.pool().
+    num_threads:    The number of concurrent processes (or threads, see
+                    backend) to be spawned by the pool. If mem_budget is
+                    set, this is the most that will be used (defaults to the
+                    number of cores if None).
     verbose:        Flag to print out more information (including mdenoise
                     output)
+    mem_budget:     Total memory, in bytes, the run may use. If set, the
+                    chunk size (if chunk_size is None) and the number of
+                    processes are chosen automatically to fit within it.
+    resume:         If the output already exists, pick up where a previous
+                    run left off instead of raising an error. The chunk grid
+                    is read from the journal (out_dem_path + ".journal") and
+                    only the chunks not listed in it are processed. The
+                    method, its options, and the output type, nodata, and
+                    encoding must match the ones in the journal.
+    sparse:         Create the output as a sparse GeoTIFF and don't write
+                    the chunks that are entirely NoData at all (they read
+                    back as NoData). Otherwise they're filled with NoData
+                    directly by the writer. Empty chunks of sparse-file
+                    sources are found while planning and never sent to the
+                    pool; other sources' are found by the workers, which
+                    read the chunk itself before its overlap and stop there
+                    if it's all NoData (see process_window()).
+    plugins:        Names of modules to import (in this process and in each
+                    worker) that add methods with register_method().
+    cog:            Write a Cloud-Optimized GeoTIFF. The overviews are built
+                    from each chunk as it's written instead of re-reading
+                    the whole output afterwards, and the output is copied
+                    into COG layout at the end (see finish_cog()).
+    log_path:       File to append per-chunk telemetry to (read, compute,
+                    write-queue wait, and write times, peak RSS, valid
+                    pixels, and worker PID; see telemetry_fields). Written
+                    as CSV if it ends in .csv, JSON lines otherwise. A
+                    summary table is printed at the end either way.
+    backend:        How the chunks are run: "processes" (an mp.Pool, the
+                    default), "threads" (a ThreadPool in this process, which
+                    avoids pickling chunks and shares GDAL's block cache;
+                    best for methods that spend their time in GDAL, numpy
+                    FFTs, or nogil numba code like hillshade and skymodel),
+                    or "serial" (one at a time in this process, handy for
+                    debugging and profiling).
+    float_output:   Write Float32 (or the method's own type) even for methods
+                    that have a compact integer output (hillshade to Byte,
+                    skymodel to UInt16, and TPI to Int16 if given a scale or
+                    offset; see register_method()).
+    manifest:       Instead of processing anything, plan the run and write
+                    it to this manifest file for RunManifestWorker() to
+                    work through on any number of machines that can see it
+                    (see WriteManifest()). AssembleManifest() then builds
+                    out_dem_path from the workers' tiles. in_dem_path and
+                    the manifest have to be on storage that all the workers
+                    share.
+    tile_output:    Have the workers write each chunk to its own small
+                    GeoTIFF in {base}_tiles next to out_dem_path instead of
+                    sending it to a single writer, then build out_dem_path
+                    from the tiles at the end (see BuildMosaic()): just a VRT
+                    over them if out_dem_path ends in .vrt, otherwise
+                    consolidated into one file, after which the tiles are
+                    removed (unless some chunks failed). Nothing waits on a
+                    shared output, and resume only has to redo the tiles
+                    that weren't finished.
+    retries:        Times to retry a chunk that raises an error, each time
+                    split into smaller pieces (see RunChunk()). Chunks that
+                    still fail are left as NoData and listed in
+                    out_dem_path + ".failed.json" (see
+                    write_failure_report()) once the rest of the run is
+                    done, and the journal is kept so that resume can try
+                    them again. None means 1.
+    prefetch:       Hand the chunks to the workers in batches of this many
+                    and have each worker read the next chunk of its batch
+                    while it processes the current one (see RunChunks()),
+                    so that reading and computing overlap. Costs another
+                    super array per worker, and bigger batches make the
+                    end of the run a little more uneven. 0 (or 1) reads
+                    each chunk when it's processed.
+    strips:         Hand each worker a whole column of chunks and have it
+                    work down the column, reusing the overlap rows of one
+                    chunk for the next instead of reading them again (see
+                    RunStrip()). Cuts the amount read several-fold for
+                    large overlaps, but gives the pool far fewer, bigger
+                    pieces of work. Takes the place of prefetch.
+    low_memory:     Have each worker keep the working arrays of the methods
+                    that support it (hillshade, terrain, multi_hillshade,
+                    and skymodel) and reuse them for every chunk of the same
+                    size, instead of allocating new ones for every chunk
+                    (and, for skymodel, every luminance line). Keeps peak
+                    memory steady at a few chunk-sized arrays, at the cost
+                    of holding on to them between chunks.
+    plan:           Look for empty chunks and estimate each chunk's cost
+                    before handing any out, if the source makes that cheap
+                    (it has overviews, or is a sparse file; see
+                    classify_chunk()). False hands the chunks out in grid
+                    order and leaves finding the empty ones to the workers.
 
     Returns the time needed to process the entire raster.
     '''
 
     start = datetime.datetime.now()
 
-    # Method name and option checks
-    if method == "blur_gauss":
-        gauss_opts = ["radius", "sigma"]
-        for opt in gauss_opts:
-            # if the req'd option isn't in the options dictionary or the value
-            # in the dictionary is None
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-        # Check overlap against radius
-        if overlap < 2 * options["radius"]:
-            overlap = 2 * options["radius"]
-
-    elif method == "blur_mean":
-        mean_opts = ["radius"]
-        for opt in mean_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-        if overlap < 2 * options["radius"]:
-            overlap = 2 * options["radius"]
-
-    elif method == "blur_toews":
-        mean_opts = ["radius"]
-        for opt in mean_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-        if overlap < 2 * options["radius"]:
-            overlap = 2 * options["radius"]
-
-    elif method == "mdenoise":
-        mdenoise_opts = ["t", "n", "v"]
-        for opt in mdenoise_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-
-    elif method == "clahe":
-        clahe_opts = ["kernel_size", "clip_limit"]
-        for opt in clahe_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-        if overlap < 2 * options["kernel_size"]:
-            overlap = 2 * options["kernel_size"]
-
-    elif method == "TPI":
-        TPI_opts = ["radius"]
-        for opt in TPI_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-        if overlap < 2 * options["radius"]:
-            overlap = 2 * options["radius"]
-
-    elif method == "hillshade":
-        hillshade_opts = ["alt", "az"]
-        for opt in hillshade_opts:
-            if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
+    if backend not in ("processes", "threads", "serial"):
+        raise ValueError("Backend not recognized: {}".format(backend))
+    if retries is None:
+        retries = 1
+    if retries < 0:
+        raise ValueError("retries can't be negative: {}".format(retries))
 
-    elif method == "skymodel":
-        sky_opts = ["lum_file"]
-        for opt in sky_opts:
+    # Method name and option checks
+    load_plugins(plugins)
+    stages = split_stages(method)
+    if not stages:
+        raise ValueError("No method given.")
+    for stage in stages:
+        if stage not in methods:
+            raise NotImplementedError("Method not recognized: {}".format(
+                stage))
+        for opt in methods[stage].required:
+            # if the req'd option isn't in the options dictionary or the
+            # value in the dictionary is None
             if opt not in options or not options[opt]:
-                raise ValueError("Required option {} not provided for method {}.".format(opt, method))
-    elif method == "test":
-        pass
-    else:
-        raise NotImplementedError("Method not recognized: {}".format(method))
-
-    # If we're doing a skymodel, we need to read in the whole luminance file
-    # and add that list to the options dictionary
-    if method == "skymodel":
-        if verbose:
-            print("Reading in luminance file {}".format(options["lum_file"]))
-        lines = []
-        with open(options["lum_file"], 'r') as l:
-            reader = csv.reader(l)
-            for line in reader:
-                lines.append(line)
-        options["lum_lines"] = lines
+                raise ValueError("Required option {} not provided for method {}.".format(opt, stage))
+    for stage in stages[:-1]:
+        if methods[stage].outputs is not None:
+            raise ValueError("Method {} writes several outputs and can only "
+                             "be the last method in a chain.".format(stage))
+    method = ",".join(stages)
+
+    # Check overlap against what the methods need (ie, their kernel sizes).
+    # In a chain, each stage eats into the overlap by its own kernel size, so
+    # the stages' overlaps add up; stages that don't declare an overlap (like
+    # skymodel) use the overlap we were given.
+    needed = sum(methods[stage].overlap(options) for stage in stages
+                 if methods[stage].overlap)
+    if any(not methods[stage].overlap for stage in stages):
+        needed += overlap
+    if overlap < needed:
+        overlap = needed
+
+    # Give the methods a chance to read in anything they need for the whole
+    # run (like skymodel's luminance file) and add it to the options
+    # dictionary
+    for stage in stages:
+        if methods[stage].prepare:
+            methods[stage].prepare(options, verbose)
+
+    # The output's data type, nodata, and products come from the last stage
+    method_info = methods[stages[-1]]
+    outputs = method_outputs(method_info, options)
+    if not outputs:
+        raise ValueError("Method {} has no outputs with these "
+                         "options.".format(method_info.name))
+    target_paths = output_paths(out_dem_path, outputs)
 
     gdal.UseExceptions()
 
@@ -918,6 +2964,11 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
     projection = s_fh.GetProjection()
     cell_size = abs(transform[5])  # Assumes square pixels where height=width
     s_nodata = s_band.GetNoDataValue()
+    s_block = s_band.GetBlockSize()
+    s_itemsize = gdal.GetDataTypeSize(s_band.DataType) // 8
+    # The methods work in float32 unless the source needs float64
+    s_work_dtype = work_dtype(s_band.DataType, s_nodata)
+    work_itemsize = np.dtype(s_work_dtype).itemsize
 
     if s_nodata is None and bands == 1:  # assume a multiband file is an image
         raise ValueError("No NoData value set in input DEM.")
@@ -932,26 +2983,58 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
     # If we've been given a vrt as a source, force the output to be geotiff
     if driver.LongName == 'Virtual Raster':
         driver = gdal.GetDriverByName('gtiff')
-    if os.path.exists(out_dem_path):
-        raise IOError("Output file {} already exists.".format(out_dem_path))
-    # Set outfile options
-    # If it's hillshade or skymodel, we want nodata = 0 and gdal byte
-    # THIS WAS FOR SCALING, BUT SCALING DOESN'T WORK (SEE NOTE IN SKYMODEL)
-    # Now using for CLAHE
-    if method in ['clahe']:
-        t_nodata = 0
-        dtype = gdal.GDT_Byte
+    journal_path = out_dem_path + ".journal"
+    existing = [path for path in target_paths.values()
+                if os.path.exists(path)]
+    if tile_output:
+        # The outputs aren't written until the very end, so a previous run's
+        # progress is in its tile directory and journal instead
+        tile_dir = "{}_tiles".format(
+            os.path.splitext(os.path.abspath(out_dem_path))[0])
+        resuming = resume and os.path.exists(journal_path)
+        if existing and not resuming:
+            raise IOError("Output file {} already exists.".format(
+                existing[0]))
+        if os.path.exists(tile_dir) and not resuming:
+            raise IOError("Tile directory {} already exists; use resume to "
+                          "finish it.".format(tile_dir))
     else:
+        resuming = resume and len(existing) > 0
+        if existing and not resuming:
+            raise IOError("Output file {} already exists.".format(
+                existing[0]))
+        if resuming and len(existing) < len(target_paths):
+            raise IOError("Can't resume {}: some of its outputs are "
+                          "missing.".format(out_dem_path))
+        if resuming and not os.path.exists(journal_path):
+            raise IOError("Can't resume {}: journal {} not found.".format(
+                out_dem_path, journal_path))
+    # Set outfile options from the method (CLAHE is Byte with nodata = 0,
+    # hillshades, skymodel, and TPI with --scale/--offset have compact integer
+    # types unless we've been asked for floats, and everything else defaults
+    # to Float32 with the source's nodata)
+    scale = 1
+    offset = 0
+    encoding = None
+    if method_info.compact is not None and not float_output:
+        encoding = method_info.compact(options)
+    compact = encoding is not None
+    if compact:
+        dtype, t_nodata, scale, offset = encoding
+    elif method_info.nodata is None:
         t_nodata = s_nodata
-        dtype = gdal.GDT_Float32
+        dtype = method_info.dtype
+    else:
+        t_nodata = method_info.nodata
+        dtype = method_info.dtype
 
     # compression Options
     jpeg_opts = ["compress=jpeg", "interleave=pixel", "photometric=ycbcr",
                  "tiled=yes", "jpeg_quality=90", "bigtiff=yes"]
-    #lzw_opts = ["compress=lzw", "tiled=yes", "bigtiff=yes"]
-    # Both lzw and deflate occasionally cause bad chunks in the final output;
-    # disabling until I can figure out why.
-    lzw_opts = ["tiled=yes", "bigtiff=yes"]
+    # lzw and deflate used to occasionally cause bad chunks in the final
+    # output when every process opened and closed the target for each write.
+    # Now that WriteChunks() holds the only handle, compression is safe again.
+    lzw_opts = ["compress=lzw", "tiled=yes", "bigtiff=yes"]
     # Use jpeg compression opts if three bands, otherwise lzw
     if bands == 3 and driver.LongName == 'GeoTIFF':
         opts = jpeg_opts
@@ -959,37 +3042,202 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
         opts = lzw_opts
     else:
         opts = []
-
-    t_fh = driver.Create(out_dem_path, cols, rows, bands, dtype, options=opts)
-    t_fh.SetGeoTransform(transform)
-    t_fh.SetProjection(projection)
-    t_band = t_fh.GetRasterBand(1)
-    if bands == 1:
-        t_band.SetNoDataValue(t_nodata)
+    # Sparse files need GeoTIFF; other drivers get their empty chunks filled
+    if sparse and driver.LongName == 'GeoTIFF':
+        opts = opts + ["sparse_ok=true"]
+    else:
+        sparse = False
+    # Same goes for COGs
+    if cog and driver.LongName != 'GeoTIFF':
+        print("COG output needs a GeoTIFF; writing a {} instead".format(
+            driver.LongName))
+        cog = False
+
+    # Manifest and tiled runs write each chunk to its own tile and build
+    # the outputs at the end, so the outputs aren't created here. The tiles
+    # are always GeoTIFFs with 256 x 256 blocks, which the chunk grid is
+    # snapped to instead.
+    mosaic_cog = False
+    if manifest and os.path.exists(manifest):
+        raise IOError("Manifest {} already exists.".format(manifest))
+    # A leftover tile directory's finished tiles would end up in this run's
+    # outputs
+    if manifest and os.path.exists("{}_tiles".format(
+            os.path.splitext(os.path.abspath(manifest))[0])):
+        raise IOError("Tile directory for manifest {} already exists; "
+                      "remove it or use another manifest.".format(manifest))
+    if manifest:
+        resuming = False
+    if manifest or tile_output:
+        tile_opts = [opt for opt in (jpeg_opts if bands == 3 else lzw_opts)
+                     if not opt.startswith("bigtiff")]
+        mosaic_cog = cog
+        cog = False
+        t_block = [256, 256]
+
+    # One output file for each of the method's products, all with the same
+    # dimensions, type, and nodata
+    for path in target_paths.values():
+        if manifest or tile_output:
+            break
+        if resuming:
+            # Reuse the partial output from the previous run
+            t_fh = gdal.Open(path, gdal.GA_ReadOnly)
+            if (t_fh.RasterXSize != cols or t_fh.RasterYSize != rows or
+                    t_fh.RasterCount != bands):
+                raise ValueError("Can't resume: {} doesn't match the "
+                                 "dimensions of {}.".format(path,
+                                                            in_dem_path))
+            t_band = t_fh.GetRasterBand(1)
+        else:
+            t_fh = driver.Create(path, cols, rows, bands, dtype,
+                                 options=opts)
+            t_fh.SetGeoTransform(transform)
+            t_fh.SetProjection(projection)
+            t_band = t_fh.GetRasterBand(1)
+            if bands == 1:
+                t_band.SetNoDataValue(t_nodata)
+            # So GDAL-aware software can read compact outputs back in the
+            # original units
+            if scale != 1 or offset != 0:
+                for band in range(bands):
+                    t_fh.GetRasterBand(band + 1).SetScale(scale)
+                    t_fh.GetRasterBand(band + 1).SetOffset(offset)
+        t_block = t_band.GetBlockSize()
+
+        # Empty overview levels for WriteChunks() to fill in as chunks are
+        # written; 'NONE' creates them without computing anything
+        if cog:
+            factors = overview_factors(cols, rows, t_block[0])
+            if not resuming:
+                t_fh.BuildOverviews('NONE', factors)
+            elif t_band.GetOverviewCount() != len(factors):
+                raise ValueError("Can't resume: {} wasn't started as a "
+                                 "COG.".format(path))
+            ov_blocks = [t_band.GetOverview(level).GetBlockSize()
+                         for level in range(len(factors))]
 
     if verbose:
         #print("Method: {}".format(method))
         print("Options:")
         for opt in options:
             print("\t{}: {}".format(opt, options[opt]))
-        print("Preparing output file {}...".format(out_dem_path))
+        for path in target_paths.values():
+            print("Preparing output file {}...".format(path))
         print("\tOutput dimensions: {} rows by {} columns.".format(rows, cols))
         print("\tOutput data type: {}".format(
             gdal_array.GDALTypeCodeToNumericTypeCode(dtype)))
         print("\tOutput size: {}".format(
-            sizeof_fmt(bands * rows * cols * gdal.GetDataTypeSize(dtype) / 8)))
+            sizeof_fmt(len(target_paths) * bands * rows * cols *
+                       gdal.GetDataTypeSize(dtype) / 8)))
         print("\tOutput NoData Value: {}".format(t_nodata))
+        if scale != 1 or offset != 0:
+            print("\tOutput scale: {}, offset: {}".format(scale, offset))
 
     # Close target file handle (causes entire file to be written to disk)
     t_band = None
     t_fh = None
 
-    # We could probably code up an automatic chunk_size setter based on
-    # data type and system memory limits
+    # Pick the chunk size and number of processes from the memory budget
+    if backend == "serial":
+        num_threads = 1
+    # Strips already read each chunk's rows only once; there's nothing left
+    # to read ahead. They hold on to overlap rows between chunks instead,
+    # which the budget counts separately.
+    if strips:
+        prefetch = 0
+    if mem_budget:
+        max_procs = num_threads if num_threads else mp.cpu_count()
+        chunk_size, num_threads = auto_chunk_size(
+            method, options, overlap, bands, s_itemsize, mem_budget,
+            max_procs, chunk_size, t_block[0], backend != "processes",
+            prefetch > 1, work_itemsize, strips)
+    elif not num_threads:
+        num_threads = 1
+    if not chunk_size:
+        raise ValueError("Chunk size must be given if there's no memory "
+                         "budget.")
+
+    # Snap the chunk grid to the output's internal tiling so that every
+    # write covers whole blocks. Writes that end partway through a block make
+    # GDAL decompress and recompress that block for each neighboring chunk,
+    # and with JPEG compression they leave artifacts along the seams.
+    chunk_x = snap_to_blocks(chunk_size, t_block[0], cols)
+    chunk_y = snap_to_blocks(chunk_size, t_block[1], rows)
+
+    # Everything that changes what gets written for a chunk. It goes in the
+    # journal header, and a run can only be resumed with the same settings;
+    # otherwise chunks from the two runs would end up side by side in one
+    # output. Compared as JSON so that tuples and lists (and NaN nodata
+    # values) compare the way they're stored.
+    settings = {"method": method, "rows": rows, "cols": cols,
+                "options": {opt: options.get(opt) for stage in stages
+                            for opt in methods[stage].required},
+                "dtype": dtype, "nodata": t_nodata,
+                "float_output": bool(float_output), "compact": compact,
+                "scale": scale, "offset": offset}
+    # Normalized to what the journal will read back as (see plain_json())
+    settings = json.loads(json.dumps(settings, default=plain_json))
+
+    # When resuming, the chunk grid has to match the previous run's exactly,
+    # so it comes from the journal rather than chunk_size or the budget
+    done_tiles = set()
+    if resuming:
+        header, done_tiles = read_journal(journal_path)
+        if "options" not in header:
+            raise ValueError("Can't resume: journal {} doesn't record the "
+                             "run's settings (it was written by an older "
+                             "version), so there's no telling whether they "
+                             "match. Start over.".format(journal_path))
+        changed = changed_settings(header, settings)
+        if changed:
+            raise ValueError("Can't resume: journal {} is for a run with "
+                             "different settings ({}). Use the same "
+                             "method, options, and output type as the run "
+                             "being resumed, or start over.".format(
+                                 journal_path, "; ".join(
+                                     "{} was {}, now {}".format(
+                                         key, json.dumps(header.get(key)),
+                                         json.dumps(settings[key]))
+                                     for key in changed)))
+        chunk_x = header["chunk_x"]
+        chunk_y = header["chunk_y"]
+        if tile_output:
+            done_tiles |= finished_tiles(tile_dir)
+
+    # Overview levels that whole chunks can be averaged down to exactly, and
+    # that each chunk fills whole blocks of, get written along with the
+    # chunks. At coarser levels every chunk would only fill part of a block,
+    # and that block would be decoded and recompressed once for each chunk
+    # in it (losing a little more quality each time with JPEG). Those levels
+    # are filled in from the coarsest streamed one at the end instead.
+    if cog:
+        streamed = []
+        for factor, ov_block in zip(factors, ov_blocks):
+            if (chunk_x % factor or chunk_y % factor or
+                    (chunk_x // factor) % ov_block[0] or
+                    (chunk_y // factor) % ov_block[1]):
+                break
+            streamed.append(factor)
+        ov_nodata = t_nodata if bands == 1 else None
+        cog_opts = ["blocksize={}".format(t_block[0]), "bigtiff=if_safer",
+                    "overviews=force_use_existing"]
+        if bands == 3:
+            cog_opts += ["compress=jpeg", "quality=90"]
+        else:
+            cog_opts += ["compress=lzw"]
+        if sparse:
+            cog_opts += ["sparse_ok=true"]
+        if verbose:
+            print("COG overviews: {} ({} built from chunks)".format(
+                factors, len(streamed)))
+    else:
+        streamed = []
+        ov_nodata = None
 
-    # calculate breaks every chunk_size pixels
-    row_splits = list(range(0, rows, chunk_size))
-    col_splits = list(range(0, cols, chunk_size))
+    # calculate breaks every chunk_x/y pixels
+    row_splits = list(range(0, rows, chunk_y))
+    col_splits = list(range(0, cols, chunk_x))
 
     # add total number of rows/cols to be last break (used for x/y_end)
     row_splits.append(rows)
@@ -999,7 +3247,6 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
     iterables = []
 
     total_chunks = (len(row_splits) - 1) * (len(col_splits) - 1)
-    progress = 0
 
     # Double the overlap just to be safe. This distance becomes one side of
     # the super_array beyond the wanted data (f2 <> x values <> f2)
@@ -1011,77 +3258,467 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
     else:
         f2 = 0
 
+    if resuming:
+        f2 = header["f2"]
+    elif not manifest:
+        # Start a new journal with the chunk grid and settings for this run
+        header = dict(settings, chunk_x=chunk_x, chunk_y=chunk_y, f2=f2)
+        with open(journal_path, 'w') as j:
+            j.write(json.dumps(header, default=plain_json) + "\n")
+
+    if verbose:
+        read_aligned = reads_aligned(f2, s_block, chunk_x, chunk_y, cols,
+                                     rows)
+        print("Chunk grid:")
+        print("\tOutput block size: {} x {}".format(t_block[0], t_block[1]))
+        print("\tSource block size: {} x {}".format(s_block[0], s_block[1]))
+        print("\tChunk size: {} x {} (requested {})".format(
+            chunk_x, chunk_y, chunk_size))
+        print("\tOverlap: {} ({})".format(
+            f2, "aligned to source blocks" if read_aligned
+            else "reads not aligned to source blocks"))
+        print("\tTotal chunks: {}".format(total_chunks))
+        if mem_budget:
+            # With the overlap and chunk size actually used
+            per_proc = estimate_chunk_memory(method, options,
+                                             max(chunk_x, chunk_y), f2,
+                                             bands, s_itemsize, prefetch > 1,
+                                             work_itemsize, strips)
+            print("Memory budget: {}".format(sizeof_fmt(mem_budget)))
+            print("\tProcesses: {}".format(num_threads))
+            print("\tEstimated memory per process: {}".format(
+                sizeof_fmt(per_proc)))
+    if resuming:
+        print("Resuming: {} of {} chunks already done".format(
+            len(done_tiles), total_chunks))
+
+    # Planning pass: find the chunks that are entirely NoData so they never
+    # get read, padded, processed, and written by the pool, and order the
+    # rest by cost. Only worth doing if the source actually has NoData areas,
+    # and only if it's cheap: the workers sit idle until it's done, so it
+    # can't read the source itself. That leaves sparse files, which know
+    # where their data is, and overviews for the decimated reads. Anything
+    # else gets its empty chunks found by the workers instead (see
+    # process_window()).
+    plan_fh = gdal.Open(in_dem_path, gdal.GA_ReadOnly)
+    plan_band = plan_fh.GetRasterBand(1)
+    decimated = plan_band.GetOverviewCount() > 0
+    planning = plan and s_nodata is not None and not (
+        plan_band.GetMaskFlags() & gdal.GMF_ALL_VALID) and (
+        decimated or has_data_coverage(plan_band, cols, rows))
+    empty_chunks = []
+    counts = {"empty": 0, "partial": 0, "full": 0}
+
     # === Multiprocessing notes ===
     # Procedure: open s/t, get and set relevant metadata, close, create
-    # list of chunk objects, create pool, execute super_array with
-    # map(function, list of chunks)
+    # list of chunk objects, create pool (sending it the run context), execute
+    # super_array with map(function, list of (i, j, progress) tasks)
     #   x/y_start = col/row_splits[j/i]- starting original raster index
     #   of the chunk
     #   x/y_end = col/row_splits[j/i +1]- ending (up to, not including)
     #   original raster index of the chunk
 
-    # Create simple chunk objects that hold data about each chunk to be
-    # sent to the processor
+    # Create simple chunk objects that hold planning data about each chunk
     # Rows = i = y values, cols = j = x values
     for i in range(0, len(row_splits) - 1):
         for j in range(0, len(col_splits) - 1):
-            progress += 1
-
-            # chunk object to hold all the data
+            # Skip chunks a previous run already finished
+            tile = "{}-{}".format(i, j)
+            if tile in done_tiles:
+                continue
+
+            if planning:
+                status, valid, relief = classify_chunk(
+                    plan_band, col_splits[j], row_splits[i],
+                    col_splits[j + 1] - col_splits[j],
+                    row_splits[i + 1] - row_splits[i], decimated)
+            else:
+                status, valid, relief = "full", 1., 0.
+            counts[status] += 1
+            if status == "empty":
+                empty_chunks.append((tile, col_splits[j], row_splits[i],
+                                     col_splits[j + 1] - col_splits[j],
+                                     row_splits[i + 1] - row_splits[i]))
+                continue
+
+            # chunk object to hold the chunk-specific planning info; only
+            # the chunk's grid position is sent to the pool
             chunk = Chunk()
-
-            # These are specific to each chunk
-            chunk.progress = progress
-            chunk.tile = "{}-{}".format(i, j)
-            # x/y_start are the starting position of the original chunk
-            # before adjusting the dimensions to read in the super array;
-            # they are not used directly in the ReadAsArray() calls but are
-            # used as the location that the altered array should be
-            # written in the output bands WriteArray() calls.
-            chunk.x_start = col_splits[j]
-            chunk.y_start = row_splits[i]
-            # end positions of initial chunk, used to compute read window
-            chunk.x_end = col_splits[j + 1]
-            chunk.y_end = row_splits[i + 1]
-
-            # These are constant over the whole raster
-            chunk.s_nodata = s_nodata
-            chunk.t_nodata = t_nodata
-            chunk.cell_size = cell_size
-            chunk.mdenoise_path = mdenoise_path
-            chunk.in_dem_path = in_dem_path
-            chunk.out_dem_path = out_dem_path
-            chunk.f2 = f2
-            chunk.rows = rows
-            chunk.cols = cols
-            chunk.total_chunks = total_chunks
-            chunk.method = method
-            chunk.options = options
-            chunk.verbose = verbose
-            chunk.start_time = start
-            chunk.bands = bands
+            chunk.i = i
+            chunk.j = j
+            chunk.tile = tile
+            chunk.valid = valid
+            chunk.cost = estimate_chunk_cost(
+                method, col_splits[j + 1] - col_splits[j],
+                row_splits[i + 1] - row_splits[i], f2, valid, relief,
+                cell_size)
 
             iterables.append(chunk)
 
-    # Create lock to lock s_fh and t_fh reads and writes
-    l = mp.Lock()
+    plan_band = None
+    plan_fh = None
+
+    # Hand out the most expensive chunks first; the cheap ones fill in the
+    # gaps at the end of the run. progress now counts the order the chunks
+    # are dispatched in.
+    iterables.sort(key=lambda c: c.cost, reverse=True)
+    tasks = [(chunk.i, chunk.j, progress)
+             for progress, chunk in enumerate(iterables, 1)]
+
+    # Strip mode hands out whole columns of chunks instead (see RunStrip()),
+    # most expensive column first, each one from the top down.
+    strip_tasks = []
+    if strips:
+        columns = {}
+        for chunk in iterables:
+            columns.setdefault(chunk.j, []).append(chunk)
+        ordered = sorted(columns.values(),
+                         key=lambda c: sum(chunk.cost for chunk in c),
+                         reverse=True)
+        progress = 0
+        for column in ordered:
+            column.sort(key=lambda c: c.i)
+            strip_tasks.append([])
+            for chunk in column:
+                progress += 1
+                strip_tasks[-1].append((chunk.i, chunk.j, progress))
+
+    # Everything that's constant over the whole raster goes to each worker
+    # once, through pool_init(), instead of with every task. For skymodel
+    # the options alone include the whole luminance file.
+    run = Chunk()
+    run.in_dem_path = in_dem_path
+    run.out_dem_path = out_dem_path
+    run.s_nodata = s_nodata
+    run.t_nodata = t_nodata
+    run.compact = compact
+    run.np_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype)
+    run.work_dtype = s_work_dtype
+    run.scale = scale
+    run.offset = offset
+    run.cell_size = cell_size
+    run.mdenoise_path = mdenoise_path
+    # Breaks of the chunk grid; chunk i, j covers rows
+    # row_splits[i]:row_splits[i + 1] and columns
+    # col_splits[j]:col_splits[j + 1]
+    run.row_splits = row_splits
+    run.col_splits = col_splits
+    run.total_chunks = len(tasks)
+    run.f2 = f2
+    run.rows = rows
+    run.cols = cols
+    run.bands = bands
+    run.method = stages
+    run.options = options
+    run.plugins = list(plugins)
+    run.verbose = verbose
+    run.start_time = start
+    run.retries = retries
+    run.prefetch = prefetch
+    run.low_memory = low_memory
+    run.sparse = sparse
+    # Chunks are only written to their own files (by the workers
+    # themselves, see WriteTile()) for manifest and tiled runs
+    run.outputs = list(target_paths)
+    run.tile_dir = None
+    if manifest:
+        run.tile_dir = "{}_tiles".format(
+            os.path.splitext(os.path.abspath(manifest))[0])
+    elif tile_output:
+        run.tile_dir = tile_dir
+        os.makedirs(tile_dir, exist_ok=True)
+    if run.tile_dir:
+        run.tile_opts = tile_opts
+        run.transform = list(transform)
+        run.projection = projection
+        run.dtype = dtype
+
+    if planning:
+        print("Planning: {} empty, {} partial, and {} full chunks".format(
+            counts["empty"], counts["partial"], counts["full"]))
+    # Without the decimated reads every chunk is "full" with no relief, so
+    # the cost ordering is really just grid order (biggest chunks first).
+    # Worth knowing when comparing against --no-plan.
+    if verbose and plan and not (planning and decimated):
+        if not planning and (s_nodata is None or decimated):
+            reason = "the source has no NoData areas to skip"
+        elif not planning:
+            reason = ("the source has neither overviews nor sparse-file "
+                      "information")
+        else:
+            reason = "the source has no overviews to estimate costs from"
+        print("Planning: {}, so chunks are handed out in grid order rather "
+              "than by estimated cost".format(reason))
+
+    # For a manifest run, everything the workers need goes in the manifest
+    # instead, and the chunks are left for RunManifestWorker() to claim
+    if manifest:
+        WriteManifest(manifest, run, tasks, target_paths, driver.ShortName,
+                      opts, mosaic_cog)
+        print("Wrote manifest {} for {} chunks ({} empty)".format(
+            manifest, len(tasks), len(empty_chunks)))
+        print("Start workers with --worker --manifest {0}, then build the "
+              "outputs with --assemble --manifest {0}".format(manifest))
+        return datetime.datetime.now() - start
+
+    # Finished chunks go through this queue to a single writer. The queue is
+    # bounded so that a slow disk makes the workers wait instead of filling
+    # up memory with finished chunks. With the process backend the writer is
+    # a process rather than a thread so that the pool can safely fork
+    # replacement workers (maxtasksperchild) while a write is in progress.
+    # Nothing forks with the other backends, so the writer is just a thread
+    # and the chunks are handed over without being pickled. Tiled runs don't
+    # need a writer at all.
+    if run.tile_dir:
+        q = None
+        write_errors = queue.Queue()
+        write_timing = queue.Queue()
+        writer = None
+    elif backend == "processes":
+        q = mp.Queue(maxsize=2 * num_threads)
+        write_errors = mp.Queue()
+        write_timing = mp.Queue()
+        writer = mp.Process(target=WriteChunks,
+                            args=(q, target_paths, journal_path,
+                                  write_errors, streamed, ov_nodata,
+                                  write_timing))
+    else:
+        q = queue.Queue(maxsize=2 * num_threads)
+        write_errors = queue.Queue()
+        write_timing = queue.Queue()
+        writer = threading.Thread(target=WriteChunks,
+                                  args=(q, target_paths, journal_path,
+                                        write_errors, streamed, ov_nodata,
+                                        write_timing))
+    if writer:
+        writer.start()
+
+    def check_writer():
+        # Once a write fails there's no point in computing the rest of the
+        # chunks, and if the writer died outright the workers would block
+        # forever on the full queue; either way the run stops right away
+        if not writer:
+            return
+        if not write_errors.empty():
+            raise IOError(write_errors.get())
+        if not writer.is_alive():
+            raise IOError("Writer stopped before the run finished (exit "
+                          "code {})".format(getattr(writer, "exitcode",
+                                                    None)))
+
+    # Telemetry: each chunk's record from the pool waits in pending until
+    # the writer reports how long it took to write
+    log = None
+    log_csv = None
+    if log_path:
+        log = open(log_path, 'a', newline='')
+        if log_path.lower().endswith(".csv"):
+            log_csv = csv.DictWriter(log, fieldnames=telemetry_fields)
+            if log.tell() == 0:
+                log_csv.writeheader()
+    pending = {}
+    write_times = {}
+    records = []
+    failures = []
 
     print("\nProcessing chunks...")
-    # Call pool.map with the lock initializer method, super array
-    # processor, and list of chunk objects.
-    # chunksize=1 keeps the input processing more-or-less in order
-    # (otherwise, for 4 processes working on 100 chunks, each process
-    # starts at 0, 25, 50, and 75).
-    # pool.map() guarantees the results will be in order, but not
-    # necessarily the processing.
+    # Call pool.imap_unordered with the initializer method, super array
+    # processor, and list of chunk objects (sorted most expensive first).
+    # chunksize=1 hands the chunks out one at a time in that order, and
+    # imap_unordered gives us each tile back as soon as it's done so we can
+    # report progress in the order chunks actually finish. RunChunk() catches
+    # (and retries) errors in each chunk so one bad chunk doesn't stop the
+    # rest of the run.
     # maxtasksperchild sets a limit on the number of tasks assigned to each
     # process, hopefully limiting memory leaks within each subprocess
-    with mp.Pool(processes=num_threads,
-                 initializer=lock_init,
-                 initargs=(l,),
-                 maxtasksperchild=10
-                 ) as pool:
-        pool.map(ProcessSuperArray, iterables, chunksize=1)
+    # Worker processes report the chunks they start on, so that a chunk
+    # whose worker is killed outright (say, by the OOM killer) can be
+    # reported as failed instead of being waited on forever. Threads can't
+    # die on their own.
+    started = mp.Queue() if backend == "processes" else None
+    initargs = (run, q, started)
+    if backend == "processes":
+        pool = mp.Pool(processes=num_threads, initializer=pool_init,
+                       initargs=initargs, maxtasksperchild=10)
+    elif backend == "threads":
+        pool = ThreadPool(processes=num_threads, initializer=pool_init,
+                          initargs=initargs)
+    else:
+        pool = None
+
+    # What's handed to the pool: strips, or batches of consecutive chunks
+    # (which have similar costs), or single chunks
+    batched = strips or prefetch > 1
+    if strips:
+        units = strip_tasks
+    elif batched:
+        units = [tasks[n:n + prefetch]
+                 for n in range(0, len(tasks), prefetch)]
+    else:
+        units = [[task] for task in tasks]
+    unit_of = {"{}-{}".format(task[0], task[1]): (n, pos)
+               for n, unit in enumerate(units)
+               for pos, task in enumerate(unit)}
+    returned = set()
+    lost_units = []
+    running = {}
+    gone = {}
+
+    def check_pool():
+        check_writer()
+        if started is None:
+            return []
+        # Everything from the chunk its worker was on to the end of its
+        # batch is lost; the chunks before it were already handed to the
+        # writer
+        lost_results = []
+        for tile, exitcode in find_lost_work(pool, started, running,
+                                             returned, gone):
+            n, pos = unit_of[tile]
+            lost_units.append(n)
+            lost = []
+            for task in units[n][pos:]:
+                lost_tile = "{}-{}".format(task[0], task[1])
+                lost.append((lost_tile, {
+                    "tile": lost_tile, "attempts": 1, "traceback": None,
+                    "error": "Worker process died{} while processing "
+                             "tile {}".format(
+                                 "" if exitcode is None else
+                                 " (exit code {})".format(exitcode), tile)}))
+            lost_results.append(lost if batched else lost[0])
+        return lost_results
+
+    try:
+        # Empty chunks skip the pool entirely; the writer just fills them
+        # with NoData (or, for sparse and tiled output, they're never
+        # written at all). The queue is bounded, so keep an eye on the
+        # writer while waiting for room.
+        if not sparse and not run.tile_dir:
+            np_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype)
+            for tile, x_start, y_start, x_size, y_size in empty_chunks:
+                fill = t_nodata if t_nodata is not None else 0
+                empty = np.full((bands, y_size, x_size), fill,
+                                dtype=np_dtype)
+                item = (tile, x_start, y_start,
+                        {name: empty for name in target_paths})
+                while True:
+                    try:
+                        q.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        check_writer()
+
+        if batched:
+            # Unpacked back into one result per chunk
+            run_batch = RunStrip if strips else RunChunks
+            if pool:
+                batch_results = poll_results(
+                    pool.imap_unordered(run_batch, units, chunksize=1),
+                    check_pool, len(units))
+            else:
+                pool_init(*initargs)
+                batch_results = map(run_batch, units)
+            results = (result for batch in batch_results for result in batch)
+        elif pool:
+            results = poll_results(
+                pool.imap_unordered(RunChunk, tasks, chunksize=1),
+                check_pool, len(tasks))
+        else:
+            pool_init(*initargs)
+            results = map(RunChunk, tasks)
+        for finished, (tile, stats) in enumerate(results, 1):
+            check_writer()
+            returned.add(tile)
+            percent = (finished / len(tasks)) * 100
+            elapsed = datetime.datetime.now() - start
+            if "error" in stats:
+                print("Tile {0} FAILED: {1:d} of {2:d} ({3:0.3f}%) at {4}: "
+                      "{5}".format(tile, finished, len(tasks), percent,
+                                   elapsed, stats["error"]))
+                failures.append(stats)
+                continue
+            print("Tile {0} finished: {1:d} of {2:d} ({3:0.3f}%) at "
+                  "{4}".format(tile, finished, len(tasks), percent,
+                               elapsed))
+
+            # Chunks written by the workers themselves come back with their
+            # write time
+            if "write" in stats:
+                write_times[tile] = stats.pop("write")
+            pending[tile] = stats
+            drain_write_times(write_timing, write_times)
+            for done in [t for t in pending if t in write_times]:
+                record = pending.pop(done)
+                record["write"] = write_times.pop(done)
+                records.append(record)
+                log_telemetry(log, log_csv, record)
+        if pool:
+            close_pool(pool, bool(lost_units))
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        # Tell the writer we're done and wait for it to finish writing,
+        # collecting its last write times as we go (it can't exit until
+        # they've been read off the queue)
+        if writer:
+            # A writer that died can't empty the queue, so don't wait on
+            # it forever to make room
+            while writer.is_alive():
+                try:
+                    q.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    drain_write_times(write_timing, write_times)
+            while writer.is_alive():
+                drain_write_times(write_timing, write_times, timeout=0.5)
+            writer.join()
+        drain_write_times(write_timing, write_times)
+        for tile in list(pending):
+            record = pending.pop(tile)
+            record["write"] = write_times.pop(tile, None)
+            records.append(record)
+            log_telemetry(log, log_csv, record)
+        if log:
+            log.close()
+
+    if not write_errors.empty():
+        raise IOError(write_errors.get())
+    if backend == "processes" and writer and writer.exitcode != 0:
+        raise IOError("Writer process exited with code {}".format(
+            writer.exitcode))
+
+    print_telemetry_summary(records)
+
+    # Chunks that failed every attempt are reported, and left out of the
+    # journal so that resuming the run tries them again
+    report_path = out_dem_path + ".failed.json"
+    if failures:
+        write_failure_report(report_path, failures, run)
+    elif os.path.exists(report_path):
+        # Left over from an earlier attempt that's now been resumed
+        os.remove(report_path)
+
+    # The tiles are kept if any chunks failed, so that resume can redo
+    # just those
+    if run.tile_dir:
+        BuildMosaic(run, finished_tiles(run.tile_dir), target_paths,
+                    driver.ShortName, opts, mosaic_cog, not failures)
+
+    # A COG can't be written to any more, so it waits until every chunk is
+    # in
+    if cog and failures:
+        print("Not building the COG until the failed chunks are done")
+    elif cog:
+        print("Building COG...")
+        for path in target_paths.values():
+            finish_cog(path, len(streamed), factors, ov_nodata, cog_opts,
+                       mem_budget)
+
+    # Everything's been written, so the journal isn't needed any more
+    if not failures:
+        os.remove(journal_path)
 
     finish = datetime.datetime.now() - start
     if verbose:
@@ -1089,6 +3726,489 @@ def ParallelRCP(in_dem_path, out_dem_path, chunk_size, overlap, method,
     return(finish)
 
 
+def write_failure_report(report_path, failures, run):
+    '''
+    Writes the chunks that failed every attempt (see RunChunk()) to a JSON
+    report and prints a summary of them.
+    report_path:    Full path to the report.
+    failures:       List of the failure dictionaries from RunChunk().
+    run:            The run context, for the chunks' extents.
+    '''
+    for failure in failures:
+        i, j = [int(n) for n in failure["tile"].split("-")]
+        failure["x_start"] = run.col_splits[j]
+        failure["y_start"] = run.row_splits[i]
+        failure["x_end"] = run.col_splits[j + 1]
+        failure["y_end"] = run.row_splits[i + 1]
+    with open(report_path, 'w') as report:
+        json.dump(failures, report, indent=1)
+
+    print("\n{} chunks failed and were left as NoData (details in "
+          "{}):".format(len(failures), report_path))
+    for failure in failures:
+        print("\tTile {} [{}:{}, {}:{}]: {}".format(
+            failure["tile"], failure["y_start"], failure["y_end"],
+            failure["x_start"], failure["x_end"], failure["error"]))
+    print("Resume the run to try them again.")
+
+
+def WriteManifest(manifest_path, run, tasks, target_paths, driver_name,
+                  out_opts, cog=False):
+    '''
+    Writes the plan for a run to a JSON manifest on shared storage so that
+    RunManifestWorker() can be started on any number of machines to work
+    through it, and creates the directory the workers write their tiles to
+    (run.tile_dir). Nothing else is needed to coordinate the workers: they
+    claim tiles with claim files in that directory (see claim_tile()).
+    manifest_path:  Full path to the manifest file.
+    run:            The run context built by ParallelRCP(), with the
+                    manifest-only fields (tile_dir, transform, etc) set.
+    tasks:          List of (i, j, progress) tasks, most expensive first,
+                    which is the order the workers claim them in.
+    target_paths:   Dictionary of the final output path for each product.
+    driver_name:    GDAL driver for the final outputs.
+    out_opts:       Creation options for the final outputs.
+    cog:            Build the final outputs as COGs.
+    '''
+    fields = dict(vars(run))
+    # np_dtype and start_time are filled back in by each worker
+    del fields["np_dtype"]
+    del fields["start_time"]
+    # Every node has to be able to find the source
+    fields["in_dem_path"] = os.path.abspath(run.in_dem_path)
+
+    # Written under a temporary name and renamed into place once it's all
+    # there (and the tile directory has been made), so a failure partway
+    # through doesn't leave a manifest or tile directory behind that would
+    # block trying again
+    temp_path = manifest_path + ".part"
+    try:
+        with open(temp_path, 'w') as m:
+            json.dump({"run": fields,
+                       "tasks": [list(task) for task in tasks],
+                       "outputs": [[name, os.path.abspath(path)]
+                                   for name, path in target_paths.items()],
+                       "driver": driver_name,
+                       "out_opts": out_opts,
+                       "cog": cog}, m, indent=1, default=plain_json)
+        fsync_path(temp_path)
+        os.makedirs(run.tile_dir)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, manifest_path)
+
+
+def read_manifest(manifest_path):
+    '''
+    Reads a manifest written by WriteManifest(). Returns the manifest
+    dictionary and the run context rebuilt from it as a Chunk() object.
+    manifest_path:  Full path to the manifest file.
+    '''
+    with open(manifest_path, 'r') as m:
+        manifest = json.load(m)
+    run = Chunk()
+    vars(run).update(manifest["run"])
+    run.np_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(run.dtype)
+    return manifest, run
+
+
+def claim_tile(tile_dir, tile, stale_after=None):
+    '''
+    Tries to claim a tile of a manifest run for this worker by creating
+    {tile}.claim in the tile directory with O_CREAT | O_EXCL, which only
+    succeeds for one of any number of workers trying at once. That holds on
+    local disks, SMB shares, and NFSv3 or later, so the shared directory is
+    all the coordination the workers need. Returns True if the tile is
+    ours to process.
+    tile_dir:       The run's tile directory (see WriteManifest()).
+    tile:           Tile name ("i-j").
+    stale_after:    Seconds after which another worker's claim on an
+                    unfinished tile is considered abandoned (its worker
+                    died) and can be taken over. Workers touch their claims
+                    every minute or so while they're working on them, so
+                    this should be a few minutes at least. None never takes
+                    over claims. A worker whose claim was taken over while
+                    it was still working can end up processing the same
+                    tile as the one that took it, which is harmless; each
+                    writes its own temporary files and renames them into
+                    place (see WriteTile()).
+    '''
+    # Finished, or failed every attempt (see RunManifestWorker())
+    if (os.path.exists(os.path.join(tile_dir, tile + ".done")) or
+            os.path.exists(os.path.join(tile_dir, tile + ".failed"))):
+        return False
+
+    claim_path = os.path.join(tile_dir, tile + ".claim")
+    if stale_after is not None:
+        try:
+            claim = os.stat(claim_path)
+            if time.time() - claim.st_mtime > stale_after:
+                # Several workers can find the same claim stale. Only one
+                # of them can rename it away, and the one that does checks
+                # that it got the stale claim and not a fresh one that
+                # another worker made after taking the stale one over.
+                taken_path = "{}.{}".format(claim_path, worker_tag())
+                os.rename(claim_path, taken_path)
+                taken = os.stat(taken_path)
+                if (taken.st_ino, taken.st_mtime) != (claim.st_ino,
+                                                      claim.st_mtime):
+                    os.rename(taken_path, claim_path)
+                    return False
+                os.remove(taken_path)
+        except OSError:
+            # Not claimed, or someone else got to the stale claim first
+            pass
+
+    try:
+        claim = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    # Who has it, for anyone looking through the tile directory
+    with os.fdopen(claim, 'w') as c:
+        c.write(json.dumps({"host": socket.gethostname(),
+                            "pid": os.getpid(),
+                            "time": datetime.datetime.now().isoformat()}))
+    return True
+
+
+def claim_tasks(tasks, tile_dir, stale_after=None):
+    '''
+    Generator that yields the tasks from a manifest that this worker
+    manages to claim (see claim_tile()), in the manifest's order. Tiles are
+    only claimed as the next one is asked for, so that a worker never holds
+    claims on more tiles than it's actually working on. With stale_after,
+    it makes a second pass at the end for claims that were abandoned while
+    the first pass was running.
+    tasks:          List of (i, j, progress) tasks from the manifest.
+    tile_dir:       The run's tile directory.
+    stale_after:    See claim_tile().
+    '''
+    passes = 1 if stale_after is None else 2
+    for manifest_pass in range(passes):
+        for task in tasks:
+            if claim_tile(tile_dir, "{}-{}".format(task[0], task[1]),
+                          stale_after):
+                yield tuple(task)
+
+
+def touch_claims(tile_dir, tiles, interval, stop):
+    '''
+    Heartbeat thread for RunManifestWorker(): touches the claims on the
+    tiles this worker is working on every interval seconds until stop is
+    set, so that other workers don't take them over as stale (see
+    claim_tile()).
+    tile_dir:       The run's tile directory.
+    tiles:          Set of the tiles being worked on, kept up to date by
+                    RunManifestWorker().
+    interval:       Seconds between touches.
+    stop:           threading.Event() that ends the thread.
+    '''
+    while not stop.wait(interval):
+        # copy() is a single step, so the set can't change underneath it
+        for tile in tiles.copy():
+            try:
+                os.utime(os.path.join(tile_dir, tile + ".claim"))
+            except OSError:
+                # Another worker took the claim over as stale; it'll redo
+                # the tile in its own files, and whoever finishes last wins
+                # (see WriteTile())
+                pass
+
+
+def RunManifestWorker(manifest_path, num_threads=1, verbose=False,
+                      backend="processes", stale_after=None, retries=None,
+                      low_memory=False):
+    '''
+    Works through the tiles of a manifest written by ParallelRCP(manifest=),
+    alongside any other workers on this or other machines, until there are
+    none left to claim. Each tile is claimed (see claim_tile()) just before
+    it's handed to the pool and written to its own GeoTIFF by the pool
+    worker (see WriteTile()). Chunks that fail every attempt (see
+    RunChunk()) get a {tile}.failed file with the error instead of a .done
+    marker, which stops other workers from trying them again; delete it
+    (and the .claim) to have them retried. If anything else goes wrong, the
+    claims on the tiles that didn't finish are released so they can be
+    picked up again.
+
+    manifest_path:  Full path to the manifest file.
+    num_threads:    Number of concurrent processes (or threads) on this
+                    machine.
+    verbose:        Flag to print out more information.
+    backend:        "processes", "threads", or "serial" (see ParallelRCP()).
+    stale_after:    Take over claims older than this many seconds (see
+                    claim_tile()).
+    retries:        Times to retry a failed chunk; None uses the number the
+                    manifest was made with.
+    low_memory:     Reuse the methods' working arrays between chunks (see
+                    ParallelRCP()), even if the manifest wasn't made that
+                    way.
+
+    Returns the number of tiles this worker processed.
+    '''
+    start = datetime.datetime.now()
+    if backend not in ("processes", "threads", "serial"):
+        raise ValueError("Backend not recognized: {}".format(backend))
+    if retries is not None and retries < 0:
+        raise ValueError("retries can't be negative: {}".format(retries))
+
+    gdal.UseExceptions()
+    manifest, run = read_manifest(manifest_path)
+    tasks = manifest["tasks"]
+    # These belong to this machine, not the one that wrote the manifest
+    run.verbose = verbose
+    run.mdenoise_path = mdenoise_path
+    run.start_time = start
+    if retries is not None:
+        run.retries = retries
+    if low_memory:
+        run.low_memory = True
+    # Tiles are claimed one at a time, so there's no batch to read ahead in
+    run.prefetch = 0
+
+    print("Working on {} ({} chunks) as {} PID {}".format(
+        manifest_path, len(tasks), socket.gethostname(), os.getpid()))
+
+    if backend == "serial" or not num_threads:
+        num_threads = 1
+    # See ParallelRCP()
+    started = mp.Queue() if backend == "processes" else None
+    initargs = (run, None, started)
+    if backend == "processes":
+        pool = mp.Pool(processes=num_threads, initializer=pool_init,
+                       initargs=initargs, maxtasksperchild=10)
+    elif backend == "threads":
+        pool = ThreadPool(processes=num_threads, initializer=pool_init,
+                          initargs=initargs)
+    else:
+        pool = None
+        pool_init(*initargs)
+
+    # Keep one claimed tile per process in the pool. Finished tiles (or the
+    # exception that stopped one) come back through this queue from the
+    # pool's callbacks.
+    claims = claim_tasks(tasks, run.tile_dir, stale_after)
+    finished = queue.Queue()
+    in_flight = set()
+    processed = 0
+    returned = set()
+    running = {}
+    gone = {}
+    lost_any = False
+
+    # Touch our claims now and then so that other workers know we're still
+    # alive (see claim_tile()). This is done on a thread of its own so that
+    # it keeps happening however long a chunk takes, including with the
+    # serial backend, where the chunks are run on this thread.
+    interval = 60 if stale_after is None else min(60, stale_after / 4)
+    stop_touching = threading.Event()
+    toucher = threading.Thread(target=touch_claims,
+                               args=(run.tile_dir, in_flight, interval,
+                                     stop_touching),
+                               daemon=True)
+    toucher.start()
+    try:
+        while True:
+            while len(in_flight) < num_threads:
+                task = next(claims, None)
+                if task is None:
+                    break
+                in_flight.add("{}-{}".format(task[0], task[1]))
+                if pool:
+                    pool.apply_async(RunChunk, (task,),
+                                     callback=finished.put,
+                                     error_callback=finished.put)
+                else:
+                    finished.put(RunChunk(task))
+            if not in_flight:
+                break
+
+            try:
+                result = finished.get(timeout=5)
+            except queue.Empty:
+                # A tile whose worker process died never comes back from
+                # the pool; it's failed like any other (see ParallelRCP())
+                if started is None:
+                    continue
+                for tile, exitcode in find_lost_work(pool, started, running,
+                                                     returned, gone):
+                    lost_any = True
+                    finished.put((tile, {
+                        "tile": tile, "attempts": 1, "traceback": None,
+                        "error": "Worker process died{}".format(
+                            "" if exitcode is None else
+                            " (exit code {})".format(exitcode))}))
+                continue
+            if isinstance(result, BaseException):
+                raise result
+
+            tile, stats = result
+            returned.add(tile)
+            in_flight.discard(tile)
+            if "error" in stats:
+                # Keep the claim too, so the tile isn't taken over as stale
+                with open(os.path.join(run.tile_dir, tile + ".failed"),
+                          'w') as failed:
+                    json.dump(stats, failed, indent=1)
+                print("Tile {} FAILED: {}".format(tile, stats["error"]))
+                continue
+            processed += 1
+            elapsed = datetime.datetime.now() - start
+            print("Tile {0} finished ({1:d} by this worker) at {2}".format(
+                tile, processed, elapsed))
+        if pool:
+            close_pool(pool, lost_any)
+    except BaseException:
+        if pool:
+            pool.terminate()
+        for tile in in_flight:
+            if not os.path.exists(os.path.join(run.tile_dir,
+                                               tile + ".done")):
+                # The claim may already be gone (broken as stale by another
+                # worker), and that mustn't hide the original error
+                try:
+                    os.remove(os.path.join(run.tile_dir, tile + ".claim"))
+                except OSError:
+                    pass
+        raise
+    finally:
+        stop_touching.set()
+        toucher.join()
+
+    done = finished_tiles(run.tile_dir)
+    failed = [task for task in tasks if os.path.exists(os.path.join(
+        run.tile_dir, "{}-{}.failed".format(task[0], task[1])))]
+    remaining = len(tasks) - len(done) - len(failed)
+    if failed:
+        print("{} chunks failed (see the .failed files in {})".format(
+            len(failed), run.tile_dir))
+    if remaining:
+        print("{} chunks are still being worked on by other "
+              "workers".format(remaining))
+    else:
+        print("No chunks left; build the outputs with --assemble "
+              "--manifest {}".format(manifest_path))
+    return processed
+
+
+def finished_tiles(tile_dir):
+    '''
+    Returns a set of the tiles in a tile directory that have been completely
+    written by WriteTile() (ie, that have a .done marker).
+    tile_dir:       The run's tile directory.
+    '''
+    return {name[:-len(".done")] for name in os.listdir(tile_dir)
+            if name.endswith(".done")}
+
+
+def BuildMosaic(run, tiles, target_paths, driver_name, out_opts, cog=False,
+                remove_tiles=False):
+    '''
+    Builds the outputs of a run whose chunks were written to their own files
+    by WriteTile(). A VRT over the tiles is built for each product (chunks
+    that were all NoData were never written and read back as NoData), which
+    is the output itself if its name ends in .vrt. Otherwise the VRT is
+    written next to the tiles and copied into a single raster, after which
+    the tile directory can be removed.
+    run:            The run context (see ParallelRCP()).
+    tiles:          List of the tiles to include.
+    target_paths:   Dictionary of the output path for each product.
+    driver_name:    GDAL driver for single-raster outputs.
+    out_opts:       Creation options for single-raster outputs.
+    cog:            Write single-raster outputs as COGs instead.
+    remove_tiles:   Remove the tile directory once every output has been
+                    copied out of it (never done for VRT outputs, which
+                    still point at the tiles).
+
+    Returns the list of output paths.
+    '''
+    # The VRT has to cover the whole source, even if the chunks on its
+    # edges were all NoData and never written. Assumes a north-up source.
+    transform = run.transform
+    bounds = (transform[0], transform[3] + run.rows * transform[5],
+              transform[0] + run.cols * transform[1], transform[3])
+    vrt_nodata = run.t_nodata if run.bands == 1 else None
+
+    out_paths = []
+    for name, target_path in target_paths.items():
+        sources = [tile_paths(run.tile_dir, tile, run.outputs)[name]
+                   for tile in sorted(tiles)]
+        if target_path.lower().endswith(".vrt"):
+            vrt_path = target_path
+        else:
+            vrt_path = os.path.join(run.tile_dir,
+                                    "{}.vrt".format(name or "mosaic"))
+        print("Building {} from {} tiles...".format(vrt_path, len(sources)))
+        vrt_opts = gdal.BuildVRTOptions(outputBounds=bounds,
+                                        VRTNodata=vrt_nodata)
+        vrt_fh = gdal.BuildVRT(vrt_path, sources, options=vrt_opts)
+        # So GDAL-aware software can read compact outputs back in the
+        # original units
+        if run.scale != 1 or run.offset != 0:
+            for band in range(run.bands):
+                vrt_fh.GetRasterBand(band + 1).SetScale(run.scale)
+                vrt_fh.GetRasterBand(band + 1).SetOffset(run.offset)
+        vrt_fh = None
+
+        if vrt_path != target_path:
+            print("Writing {}...".format(target_path))
+            if cog:
+                cog_opts = ["blocksize=256", "bigtiff=if_safer",
+                            "compress=jpeg" if run.bands == 3
+                            else "compress=lzw"]
+                gdal.Translate(target_path, vrt_path, format="COG",
+                               creationOptions=cog_opts)
+            else:
+                gdal.Translate(target_path, vrt_path, format=driver_name,
+                               creationOptions=out_opts)
+        out_paths.append(target_path)
+
+    vrt_output = any(path.lower().endswith(".vrt")
+                     for path in target_paths.values())
+    if remove_tiles and not vrt_output:
+        print("Removing {}...".format(run.tile_dir))
+        shutil.rmtree(run.tile_dir)
+    return out_paths
+
+
+def AssembleManifest(manifest_path, verbose=False):
+    '''
+    Builds the final outputs of a manifest run from the workers' tiles once
+    they're all done (see BuildMosaic()): a VRT over the tiles if the output
+    ends in .vrt, or a single raster (a COG if the manifest was made with
+    cog), after which the tiles are removed unless some chunks failed.
+    manifest_path:  Full path to the manifest file.
+    verbose:        Flag to print out more information.
+
+    Returns the list of output paths.
+    '''
+    gdal.UseExceptions()
+    manifest, run = read_manifest(manifest_path)
+    tasks = manifest["tasks"]
+    tiles = ["{}-{}".format(task[0], task[1]) for task in tasks]
+    done = finished_tiles(run.tile_dir)
+    failed = [tile for tile in tiles if tile not in done and os.path.exists(
+        os.path.join(run.tile_dir, tile + ".failed"))]
+    missing = [tile for tile in tiles if tile not in done and
+               tile not in failed]
+    if missing:
+        raise IOError("Can't assemble {}: {} of {} chunks aren't done yet "
+                      "(like {}).".format(manifest_path, len(missing),
+                                          len(tiles), missing[0]))
+    if failed:
+        print("{} chunks failed and will be NoData (see their .failed files "
+              "in {}): {}".format(len(failed), run.tile_dir,
+                                  ", ".join(failed)))
+
+    out_paths = BuildMosaic(run, done, dict(manifest["outputs"]),
+                            manifest["driver"], manifest["out_opts"],
+                            manifest["cog"], not failed)
+
+    if verbose:
+        print("Assembled {}".format(", ".join(out_paths)))
+    return out_paths
+
+
 # ==============================================================================
 # Main Variables
 
@@ -1100,16 +4220,31 @@ global cell_size
 global s_nodata
 global mdenoise_path
 mdenoise_path = r'c:\GIS\Installers\MDenoise.exe'
+# Set for each run by pool_init() and below; this is for methods called on
+# their own (like rcp_benchmark.py's in-process runs)
+verbose = False
 
 # Need this check for multiprocessing in windows
 if "__main__" in __name__:
 
     # Required arguments:
     # Parent:
-    #   -m method, string
+    #   -m method, string (or comma-separated chain of methods)
     #   -o overlap, int (filter_f below)
     #   -s chunk size, int (window size below)
     #   -p number of processes, int, default 1
+    #   --mem-budget memory limit, chooses -s and -p automatically
+    #   --resume picks up an interrupted run from its journal
+    #   --sparse leaves all-NoData chunks unwritten
+    #   --no-plan skips the planning pass over the source
+    #   --cog writes a Cloud-Optimized GeoTIFF with streamed overviews
+    #   --log per-chunk telemetry file (.csv or JSON lines)
+    #   --backend processes, threads, or serial
+    #   --float32 writes Float32 instead of compact integer types
+    #   --plugin module that registers extra methods
+    #   --tiles writes each chunk to its own file and builds outfile from them
+    #   --manifest plans a run for --worker processes on other machines,
+    #       which --assemble puts together at the end
     #   --verbose sets verbose to True
     # Method-specific:
     #   -r kernel radius, int (blur_mean, blur_gauss, TPI)
@@ -1120,27 +4255,89 @@ if "__main__" in __name__:
     #   -c clahe clip parameter, float
     #   -k clahe kernel size, int
     #   -l luminance file
-
-    args = argparse.ArgumentParser(usage='%(prog)s -m method [general options] [method specific options] infile outfile', description='Effectively divides arbitrarily large DEM rasters into chunks that will fit in memory and runs the specified processing method on each chunk, with parallel processing of the chunks available for significant runtime advantages. Current methods include smoothing algorithms (blur_mean, blur_gauss, and Sun et al\'s mdenoise), CLAHE contrast stretching, TPI, and Kennelly & Stewart\'s skymodel hillshade algorithm.')
+    #   --scale, --offset TPI Int16 output and its scaling
+    #   --azimuths multi_hillshade azimuths, comma-separated ints
+
+    # Plugins have to be imported before the parser is built so that their
+    # methods show up as choices for -m
+    plugin_parser = argparse.ArgumentParser(add_help=False)
+    plugin_parser.add_argument('--plugin', dest='plugins', action='append',
+                               default=[])
+    plugin_args, _ = plugin_parser.parse_known_args()
+    load_plugins(plugin_args.plugins)
+
+    args = argparse.ArgumentParser(usage='%(prog)s -m method [general options] [method specific options] infile outfile\n       %(prog)s --worker --manifest manifest [-p processes]\n       %(prog)s --assemble --manifest manifest', description='Effectively divides arbitrarily large DEM rasters into chunks that will fit in memory and runs the specified processing method on each chunk, with parallel processing of the chunks available for significant runtime advantages. Current methods include smoothing algorithms (blur_mean, blur_gauss, and Sun et al\'s mdenoise), CLAHE contrast stretching, TPI, hillshades (including slope/aspect/hillshade and multiple azimuths from a single read), and Kennelly & Stewart\'s skymodel hillshade algorithm.')
     all = args.add_argument_group('all', 'General options for all methods')
     all.add_argument('-m', dest='method',
-                     choices=['blur_mean', 'blur_gauss', 'blur_toews',
-                              'mdenoise', 'hillshade', 'skymodel', 'clahe',
-                              'TPI'],
-                     help='Processing method')
-    all.add_argument('-o', dest='chunk_overlap', required=True, type=int,
+                     help='Processing method, or a comma-separated chain of methods to run one after another on each chunk (like blur_gauss,skymodel). Choices: {}'.format(', '.join(methods)))
+    all.add_argument('-o', dest='chunk_overlap', type=int,
                      help='Chunk overlap size in pixels; try 25. Will be changed to 2*kernel size if less than 2*kernel size for relevant methods.')
-    all.add_argument('-s', dest='chunk_size', required=True, type=int,
-                     help='Chunk size in pixels; try 1500 for mdenoise')
-    all.add_argument('-p', dest='proc', default=1, type=int,
-                     help='Number of concurrent processes (default of 1)')
+    all.add_argument('-s', dest='chunk_size', type=int,
+                     help='Chunk size in pixels; try 1500 for mdenoise. Required unless --mem-budget is used.')
+    all.add_argument('-p', dest='proc', type=int,
+                     help='Number of concurrent processes or threads (default of 1, or the number of cores with --mem-budget)')
+    all.add_argument('--mem-budget', dest='mem_budget',
+                     help='Total memory the run may use, like 48G or 512M. Chooses the chunk size (if -s isn\'t given) and number of processes (up to -p) that fit.')
     all.add_argument('--verbose', dest='verbose', default=False,
                      help='Show detailed output', action='store_true')
+    all.add_argument('--sparse', dest='sparse', default=False,
+                     action='store_true',
+                     help='Write a sparse GeoTIFF, leaving chunks that are entirely NoData unwritten')
+    all.add_argument('--plugin', dest='plugins', action='append', default=[],
+                     help='Module that adds methods with register_method(); can be given more than once')
+    all.add_argument('--cog', dest='cog', default=False,
+                     action='store_true',
+                     help='Write a Cloud-Optimized GeoTIFF, building the overviews from the chunks as they\'re written')
+    all.add_argument('--backend', dest='backend', default='processes',
+                     choices=['processes', 'threads', 'serial'],
+                     help='Run chunks in a pool of processes (default), a pool of threads (less memory and no pickling; good for hillshade and skymodel), or one at a time')
+    all.add_argument('--float32', dest='float_output', default=False,
+                     action='store_true',
+                     help='Write Float32 instead of the compact types for hillshade (Byte) and skymodel (UInt16)')
+    all.add_argument('--log', dest='log_path',
+                     help='Append per-chunk read/compute/write times, peak memory, and valid pixel counts to this file (CSV if it ends in .csv, otherwise JSON lines)')
+    all.add_argument('--resume', dest='resume', default=False,
+                     action='store_true',
+                     help='Resume an interrupted run, processing only the chunks not recorded in outfile.journal. The method, its options, and the output type have to be the same as the interrupted run\'s.')
+    all.add_argument('--retries', dest='retries', type=int,
+                     help='Times to retry a chunk that fails, splitting it into smaller pieces each time (default 1, or with --worker, what the manifest was made with). Chunks that still fail are listed in outfile.failed.json and the rest of the run carries on.')
+    all.add_argument('--prefetch', dest='prefetch', type=int, default=0,
+                     help='Hand out chunks in batches of this many and read each worker\'s next chunk while it processes the current one; try 4. Helps most when reads are slow (network storage).')
+    all.add_argument('--low-memory', dest='low_memory', default=False,
+                     action='store_true',
+                     help='Have each worker reuse the working arrays of hillshade, terrain, multi_hillshade, and skymodel for every chunk instead of allocating new ones')
+    all.add_argument('--strips', dest='strips', default=False,
+                     action='store_true',
+                     help='Have each worker walk down a whole column of chunks, reusing the overlap rows from one chunk for the next instead of reading them again. Reads several times less for large overlaps (skymodel).')
+    all.add_argument('--no-plan', dest='plan', default=True,
+                     action='store_false',
+                     help='Don\'t look for empty chunks or estimate chunk costs before starting. Planning only reads the source\'s overviews or sparse-file information, and is skipped without them; the workers skip the processing of empty chunks either way.')
+    all.add_argument('--tiles', dest='tile_output', default=False,
+                     action='store_true',
+                     help='Write each chunk to its own GeoTIFF in outfile_tiles, then build outfile from them: a VRT if outfile ends in .vrt (the tiles are kept), otherwise one file copied from the tiles (which are then removed, unless some chunks failed)')
+
+    dist_args = args.add_argument_group('distributed', 'Spreading a run over several machines that share a directory')
+    dist_args.add_argument('--manifest', dest='manifest',
+                           help='Manifest file on shared storage. With the usual arguments, plans the run and writes the manifest instead of processing it; with --worker or --assemble, the manifest to work on.')
+    dist_args.add_argument('--worker', dest='worker', default=False,
+                           action='store_true',
+                           help='Process chunks from --manifest until none are left; start one on each machine (uses -p, --backend, and --verbose)')
+    dist_args.add_argument('--assemble', dest='assemble', default=False,
+                           action='store_true',
+                           help='Build outfile from the finished chunks of --manifest (a VRT if outfile ends in .vrt; otherwise the tiles are removed afterwards unless some chunks failed)')
+    dist_args.add_argument('--stale-after', dest='stale_after', type=float,
+                           help='With --worker, take over chunks claimed by workers that haven\'t checked in for this many seconds (their worker died); try 600')
 
     kernel_args = args.add_argument_group('kernel', 'Kernel radius for blur_mean, blur_gauss, blur_toews, and TPI')
     kernel_args.add_argument('-r', dest='radius',
                              type=int, help='Kernel radius in pixels; try 15')
 
+    tpi_args = args.add_argument_group('TPI', 'Compact (Int16) TPI output options. TPI is written as Float32 unless one of these is given; values beyond the 65534 steps of Int16 are clipped (with a warning).')
+    tpi_args.add_argument('--scale', dest='scale', type=float,
+                          help='Write Int16 with this many TPI units per step (default 0.1 with --offset, which covers +/-3276.7)')
+    tpi_args.add_argument('--offset', dest='offset', type=float,
+                          help='Write Int16 with this TPI value stored as 0 (default 0 with --scale)')
+
     blur_gauss_args = args.add_argument_group('blur_gauss', 'Gaussian blur options; also requires -r')
     blur_gauss_args.add_argument('-d', dest='sigma', type=float, help='Standard deviation of the distribution (sigma). Controls amount of smoothing; try 1.')
 
@@ -1163,19 +4360,40 @@ if "__main__" in __name__:
                          help='Azimuth (default of 315)')
     hs_args.add_argument('-alt', dest='alt', type=int, default=45,
                          help='Altitude (default of 45)')
+    hs_args.add_argument('--azimuths', dest='azimuths',
+                         type=lambda a: [int(az) for az in a.split(',')],
+                         help='Comma-separated azimuths for multi_hillshade, like 315,45,135,225; each one is written to outfile_hs<az>')
 
     sky_args = args.add_argument_group('sky', 'Skymodel options')
     sky_args.add_argument('-l', dest='lum_file',
                           help='Luminance file with header lines removed')
 
     out_args = args.add_argument_group('out', 'Input/Output files')
-    out_args.add_argument('infile', help='Input DEM')
-    out_args.add_argument('outfile', help='Output file')
+    out_args.add_argument('infile', nargs='?', help='Input DEM')
+    out_args.add_argument('outfile', nargs='?', help='Output file')
 
     arguments = args.parse_args()  # get the arguments as namespace object
 
     arg_dict = vars(arguments)  # serve the arguments as dictionary
 
+    # Workers and assembly get everything else from the manifest
+    if arg_dict['worker'] or arg_dict['assemble']:
+        if not arg_dict['manifest']:
+            args.error('--worker and --assemble need --manifest')
+    else:
+        for arg, name in (('method', '-m'), ('chunk_overlap', '-o'),
+                          ('infile', 'infile'), ('outfile', 'outfile')):
+            if arg_dict[arg] is None:
+                args.error('the following arguments are required: ' + name)
+
+    if arg_dict['retries'] is not None and arg_dict['retries'] < 0:
+        args.error('--retries can\'t be negative')
+
+    for stage in split_stages(arg_dict['method'] or ''):
+        if stage not in methods:
+            args.error('invalid method: {} (choose from {})'.format(
+                stage, ', '.join(methods)))
+
     input_DEM = arg_dict['infile']
     out_file = arg_dict['outfile']
     chunk_size = arg_dict['chunk_size']
@@ -1184,15 +4402,34 @@ if "__main__" in __name__:
     overlap = arg_dict['chunk_overlap']
     num_threads = arg_dict['proc']
     verbose = arg_dict['verbose']
+    mem_budget = None
+    if arg_dict['mem_budget']:
+        mem_budget = parse_mem(arg_dict['mem_budget'])
 
     try:
-        # Make sure mdenoise path is set
-        if arg_dict['method'] == 'mdenoise' and not mdenoise_path:
-            raise ValueError('Path to mdenoise executable must be set (variable mdenoise_path in raster_chunk_processing.py)')
-        if arg_dict['method'] == 'mdenoise' and not os.path.isfile(mdenoise_path):
-            raise FileNotFoundError('mdenoise executable {} not found'.format(mdenoise_path))
-        ParallelRCP(input_DEM, out_file, chunk_size, overlap, method, arg_dict,
-                    num_threads, verbose)
+        if arg_dict['worker']:
+            RunManifestWorker(arg_dict['manifest'], num_threads, verbose,
+                              arg_dict['backend'], arg_dict['stale_after'],
+                              arg_dict['retries'], arg_dict['low_memory'])
+        elif arg_dict['assemble']:
+            AssembleManifest(arg_dict['manifest'], verbose)
+        else:
+            # Make sure mdenoise path is set
+            if 'mdenoise' in split_stages(method) and not mdenoise_path:
+                raise ValueError('Path to mdenoise executable must be set (variable mdenoise_path in raster_chunk_processing.py)')
+            if 'mdenoise' in split_stages(method) and not os.path.isfile(mdenoise_path):
+                raise FileNotFoundError('mdenoise executable {} not found'.format(mdenoise_path))
+            if not chunk_size and not mem_budget:
+                raise ValueError('Either a chunk size (-s) or a memory budget (--mem-budget) must be given')
+            ParallelRCP(input_DEM, out_file, chunk_size, overlap, method,
+                        arg_dict, num_threads, verbose, mem_budget,
+                        arg_dict['resume'], arg_dict['sparse'],
+                        arg_dict['plugins'], arg_dict['cog'],
+                        arg_dict['log_path'], arg_dict['backend'],
+                        arg_dict['float_output'], arg_dict['manifest'],
+                        arg_dict['tile_output'], arg_dict['retries'],
+                        arg_dict['prefetch'], arg_dict['strips'],
+                        arg_dict['low_memory'], arg_dict['plan'])
     except Exception as e:
         print("\n--- Error ---")
         print(e)
@@ -1219,3 +4456,4 @@ if "__main__" in __name__:
 
 # Jpeg stuff
 # need to change the whole thing so that the window is a multiple of the tile to fix jpeg compression issues that create artifacts when the bottom or right edges don't end at a tile boundary (manually setting window size to 1024 fixes this)
+# Fixed: ParallelRCP() now snaps chunk_size to a multiple of the output block size (see snap_to_blocks())
@@ -0,0 +1,528 @@
+#*****************************************************************************
+#
+#  Project:  Parallel Raster Chunk Processing
+#  Purpose:  Benchmarks each RCP processing method on synthetic DEMs, both
+#            in-process and through ParallelRCP(), and compares the results
+#            against a stored baseline
+#
+#*****************************************************************************
+# MIT License
+#
+# Copyright (c) 2019 Jacob Adams
+#
+# See LICENSE for the full text.
+#*****************************************************************************
+
+# Usage:
+#   python rcp_benchmark.py --size 4096 --chunks 512,1024 --procs 1,4
+#   python rcp_benchmark.py --methods blur_gauss,TPI --save-baseline base.json
+#   python rcp_benchmark.py --baseline base.json
+#
+# Everything is generated in a temp directory (or --workdir), so no data
+# files are needed. Throughput is reported in megapixels of the source DEM per
+# second. Peak memory is tracemalloc's peak for the in-process runs (numpy
+# reports its allocations to it) and the largest RSS of the process running
+# ParallelRCP() and any of its workers for ParallelRCP() runs.
+
+
+import numpy as np
+import os
+import io
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import platform
+import contextlib
+import tracemalloc
+import multiprocessing as mp
+from osgeo import gdal
+
+import raster_chunk_processing as rcp
+
+
+# Options for each method, using the values suggested in RCP's --help. Keys
+# are RCP's option names; lum_file is filled in once the file's been made.
+bench_options = {
+    "blur_gauss": {"radius": 15, "sigma": 1},
+    "blur_mean": {"radius": 15},
+    "blur_toews": {"radius": 15},
+    "TPI": {"radius": 15},
+    "hillshade": {"az": 315, "alt": 45},
+    "skymodel": {"lum_file": None},
+    "clahe": {"kernel_size": 30, "clip_limit": 0.01},
+    "mdenoise": {"t": 0.6, "n": 10, "v": 20},
+}
+
+# A handful of sun positions is plenty for timing skymodel; real luminance
+# files have 250+ lines, so skymodel times scale roughly linearly from here.
+bench_lum_lines = [
+    (315, 45, 0.2), (270, 30, 0.15), (0, 60, 0.2), (225, 20, 0.1),
+    (90, 35, 0.1), (135, 50, 0.1), (180, 25, 0.1), (45, 15, 0.05),
+]
+
+bench_nodata = -9999.
+bench_cell_size = 10.
+
+
+def fractal_surface(size, beta=2.6, seed=0):
+    '''
+    Returns a size by size array of fractal (fractional Brownian) terrain
+    made by spectral synthesis: random phases with a power spectrum that
+    falls off as 1/f**beta, transformed back to the spatial domain.
+    size:           Rows and columns of the surface.
+    beta:           Spectral exponent; higher values give smoother terrain.
+    seed:           Random seed, so every run gets the same surface.
+    '''
+    random = np.random.RandomState(seed)
+    freq = np.fft.fftfreq(size)
+    k = np.sqrt(freq[np.newaxis, :]**2 + freq[:, np.newaxis]**2)
+    k[0, 0] = 1.
+    amplitude = k ** (-beta / 2.)
+    amplitude[0, 0] = 0.
+    phase = random.uniform(0, 2 * np.pi, (size, size))
+    spectrum = amplitude * random.normal(size=(size, size)) * np.exp(1j * phase)
+    surface = np.fft.ifft2(spectrum).real
+    spectrum = None
+
+    # Scale to something that looks like mountains, in meters
+    surface -= surface.min()
+    surface *= 2000. / surface.max()
+    surface += 1300.
+    return surface
+
+
+def add_holes(dem, nodata, holes=20, seed=0):
+    '''
+    Punches NoData holes in a DEM: a large clipped-off corner (like a DEM
+    clipped to a county boundary, which gives RCP's planning pass whole
+    empty chunks to skip) and a scattering of round holes (like water bodies
+    or voids) for partial chunks.
+    dem:            The DEM array, modified in place.
+    nodata:         The NoData value.
+    holes:          Number of round holes.
+    seed:           Random seed.
+    '''
+    random = np.random.RandomState(seed)
+    rows, cols = dem.shape
+    y, x = np.ogrid[0:rows, 0:cols]
+
+    # Corner triangle
+    dem[x / cols + y / rows < 0.35] = nodata
+
+    for hole in range(holes):
+        radius = random.uniform(0.005, 0.04) * min(rows, cols)
+        c_y = random.uniform(0, rows)
+        c_x = random.uniform(0, cols)
+        dem[(x - c_x)**2 + (y - c_y)**2 < radius**2] = nodata
+
+
+def write_raster(path, array, nodata=None, dtype=gdal.GDT_Float32):
+    '''
+    Writes a [rows, cols] or [bands, rows, cols] array to a tiled GeoTIFF.
+    path:           Full path to the new raster.
+    array:          The data.
+    nodata:         NoData value to set, if any.
+    dtype:          GDAL data type.
+    '''
+    if array.ndim == 2:
+        array = array[np.newaxis, :, :]
+    bands, rows, cols = array.shape
+    driver = gdal.GetDriverByName('gtiff')
+    fh = driver.Create(path, cols, rows, bands, dtype,
+                       options=["tiled=yes", "bigtiff=yes"])
+    fh.SetGeoTransform([400000., bench_cell_size, 0., 4600000., 0.,
+                        -bench_cell_size])
+    for band in range(bands):
+        b = fh.GetRasterBand(band + 1)
+        if nodata is not None:
+            b.SetNoDataValue(nodata)
+        b.WriteArray(array[band])
+    b = None
+    fh = None
+
+
+def make_inputs(workdir, size, seed=0):
+    '''
+    Generates the benchmark inputs in workdir: a fractal DEM with NoData
+    holes, a 3-band image for CLAHE (three differently-lit hillshades of the
+    same terrain), and a luminance file for skymodel. Returns a dictionary of
+    their paths.
+    workdir:        Directory to put them in.
+    size:           Rows and columns of the DEM and image.
+    seed:           Random seed.
+    '''
+    dem = fractal_surface(size, seed=seed)
+
+    # Image for CLAHE; needs the terrain before the holes go in
+    rcp.cell_size = bench_cell_size
+    image = np.stack([rcp.hillshade(dem, az, 45, bench_nodata)
+                      for az in (315, 45, 180)])
+    image = np.nan_to_num(image).clip(0, 255).astype(np.uint8)
+
+    add_holes(dem, bench_nodata, seed=seed)
+
+    paths = {"dem": os.path.join(workdir, "bench_dem.tif"),
+             "image": os.path.join(workdir, "bench_image.tif"),
+             "lum": os.path.join(workdir, "bench_lum.csv")}
+    write_raster(paths["dem"], dem.astype(np.float32), bench_nodata)
+    write_raster(paths["image"], image, dtype=gdal.GDT_Byte)
+    with open(paths["lum"], 'w') as lum:
+        for line in bench_lum_lines:
+            lum.write("{},{},{}\n".format(*line))
+    return paths
+
+
+def read_input(path, size):
+    '''
+    Reads (up to) a size by size window from the middle of the first band of
+    a raster (away from the clipped-off corner) into an array of the type
+    ParallelRCP() would pick for its super arrays (see rcp.work_dtype()), so
+    the in-process timings match what the chunks actually run in.
+    path:           Full path to the raster.
+    size:           Rows and columns to read.
+    '''
+    fh = gdal.Open(path, gdal.GA_ReadOnly)
+    size = min(size, fh.RasterXSize, fh.RasterYSize)
+    x_off = (fh.RasterXSize - size) // 2
+    y_off = (fh.RasterYSize - size) // 2
+    band = fh.GetRasterBand(1)
+    dtype = rcp.work_dtype(band.DataType, band.GetNoDataValue())
+    array = band.ReadAsArray(x_off, y_off, size, size)
+    fh = None
+    return array.astype(dtype)
+
+
+def bench_in_process(method, options, array, repeat):
+    '''
+    Times a method's function on a single in-memory array, with no chunking
+    or I/O. Returns the best time of repeat runs and tracemalloc's peak.
+    method:         Name of the method.
+    options:        Dictionary of method options (with lum_lines read in).
+    array:          The input array.
+    repeat:         Number of times to run it.
+    '''
+    function = rcp.methods[method].function
+    # skymodel uses the overlap to trim its shadow tracing; the rest ignore it
+    overlap = 25
+    # The methods get the source nodata, cell size, and verbosity from RCP's
+    # globals
+    rcp.s_nodata = bench_nodata
+    rcp.cell_size = bench_cell_size
+    rcp.verbose = False
+
+    # Run once first so numba compiling (skymodel's shadows()) isn't timed
+    function(array.copy(), options, "bench", overlap)
+
+    best = None
+    peak = 0
+    for run in range(repeat):
+        in_array = array.copy()
+        tracemalloc.start()
+        start = time.perf_counter()
+        function(in_array, options, "bench", overlap)
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+        in_array = None
+    return best, peak
+
+
+def run_rcp(in_path, out_path, chunk_size, method, options, procs, backend,
+            verbose, results):
+    '''
+    Runs ParallelRCP() once and puts its time and the peak RSS of this
+    process and its workers on the results queue (or None and the error if
+    it failed). Run in its own process by bench_rcp(), since the peaks are
+    high-water marks for the life of the process.
+    '''
+    output = io.StringIO()
+    redirect = (contextlib.redirect_stdout(output) if not verbose
+                else contextlib.nullcontext())
+    try:
+        with redirect:
+            start = time.perf_counter()
+            rcp.ParallelRCP(in_path, out_path, chunk_size, 25, method,
+                            dict(options), procs, verbose, backend=backend)
+            elapsed = time.perf_counter() - start
+    except Exception as e:
+        results.put((None, "{}: {}".format(type(e).__name__, e)))
+        return
+    results.put((elapsed, rcp.peak_rss(children=True)))
+
+
+def remove_outputs(out_path):
+    '''
+    Removes a ParallelRCP() run's output and the journal and failure report
+    it leaves next to it, so they can't carry over into the next run.
+    out_path:       Full path to the run's output raster.
+    '''
+    for path in (out_path, out_path + ".journal", out_path + ".failed.json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_rcp(method, options, in_path, workdir, chunk_size, procs, repeat,
+              backend="processes", verbose=False):
+    '''
+    Times a full ParallelRCP() run, each in a fresh process. Returns the
+    best time of repeat runs, the peak RSS (see rcp.peak_rss()), and None,
+    or None, None, and what went wrong if a run failed. Runs pushing the
+    memory or chunk limits can get OOM-killed or crash outright, so the
+    process is watched rather than just waited on. A run with chunks that
+    failed (see rcp.write_failure_report()) counts as failed too; it skipped
+    some of the work, so its time would look better than it is.
+    method:         Name of the method.
+    options:        Dictionary of method options.
+    in_path:        Full path to the input raster.
+    workdir:        Directory for the output rasters.
+    chunk_size:     Chunk size to use.
+    procs:          Number of processes (or threads) to use.
+    repeat:         Number of times to run it.
+    backend:        ParallelRCP()'s backend (processes, threads, or serial).
+    verbose:        Show ParallelRCP()'s output instead of hiding it.
+    '''
+    out_path = os.path.join(workdir, "bench_out.tif")
+    best = None
+    peak = None
+    for run in range(repeat):
+        remove_outputs(out_path)
+        results = mp.Queue()
+        runner = mp.Process(target=run_rcp,
+                            args=(in_path, out_path, chunk_size, method,
+                                  options, procs, backend, verbose,
+                                  results))
+        runner.start()
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if runner.is_alive():
+                    continue
+                # One last look in case it finished just as we checked
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    break
+        runner.join()
+        if result is None:
+            if runner.exitcode is not None and runner.exitcode < 0:
+                reason = "killed by signal {}".format(-runner.exitcode)
+            else:
+                reason = "exited with code {}".format(runner.exitcode)
+            remove_outputs(out_path)
+            return None, None, "process {} without a result".format(reason)
+        elapsed, run_peak = result
+        if elapsed is None:
+            remove_outputs(out_path)
+            return None, None, run_peak
+        report_path = out_path + ".failed.json"
+        if os.path.exists(report_path):
+            with open(report_path, 'r') as report:
+                failed = len(json.load(report))
+            remove_outputs(out_path)
+            return None, None, "{} chunks failed".format(failed)
+        best = elapsed if best is None else min(best, elapsed)
+        if run_peak is not None:
+            peak = max(peak or 0, run_peak)
+    remove_outputs(out_path)
+    return best, peak, None
+
+
+def compare(result, baseline, tolerance):
+    '''
+    Compares a result's throughput and peak memory to its baseline. Returns
+    a short note with the percent change in each, and a list of the
+    regressions (a slowdown, or peak memory growth, of more than tolerance).
+    Peak memory is left out if either run couldn't measure it.
+    result:         Dictionary with the result's mpx_s and peak.
+    baseline:       The matching baseline dictionary, or None.
+    tolerance:      Fractional slowdown or memory growth to flag as a
+                    regression.
+    '''
+    if not baseline:
+        return "", []
+    regressions = []
+    change = result["mpx_s"] / baseline["mpx_s"] - 1
+    note = "{:+.1f}% speed".format(100 * change)
+    if change < -tolerance:
+        note += " SLOWER"
+        regressions.append("slower")
+    if result["peak"] and baseline.get("peak"):
+        change = result["peak"] / baseline["peak"] - 1
+        note += ", {:+.1f}% mem".format(100 * change)
+        if change > tolerance:
+            note += " MORE MEMORY"
+            regressions.append("more memory")
+    return note, regressions
+
+
+def print_result(result, note):
+    '''
+    Prints one row of the results table.
+    '''
+    peak = rcp.sizeof_fmt(result["peak"]) if result["peak"] else "n/a"
+    print("{:<12}{:<30}{:>10.2f}{:>10.2f}{:>12}  {}".format(
+        result["method"], result["mode"], result["seconds"], result["mpx_s"],
+        peak, note))
+
+
+# Need this check for multiprocessing in windows
+if "__main__" in __name__:
+
+    args = argparse.ArgumentParser(description='Benchmarks RCP\'s processing methods on a synthetic fractal DEM with NoData holes, both in-process and through ParallelRCP() at several chunk sizes and process counts. Reports throughput (megapixels/s) and peak memory, optionally against a baseline saved by an earlier run.')
+    args.add_argument('--methods', dest='methods',
+                      default='blur_gauss,blur_mean,blur_toews,TPI,hillshade,skymodel,clahe,mdenoise',
+                      help='Comma-separated methods to benchmark (default: all of them; mdenoise is skipped if its executable isn\'t found)')
+    args.add_argument('--size', dest='size', type=int, default=4096,
+                      help='Rows and columns of the synthetic DEM (default 4096)')
+    args.add_argument('--inproc-size', dest='inproc_size', type=int,
+                      default=1024,
+                      help='Rows and columns of the array for the in-process runs (default 1024)')
+    args.add_argument('--chunks', dest='chunks', default='512,1024',
+                      help='Comma-separated chunk sizes for the ParallelRCP() runs (default 512,1024)')
+    args.add_argument('--procs', dest='procs', default='1,{}'.format(
+                      os.cpu_count() or 1),
+                      help='Comma-separated process counts for the ParallelRCP() runs (default 1 and the number of cores)')
+    args.add_argument('--backends', dest='backends', default='processes',
+                      help='Comma-separated ParallelRCP() backends to run (processes, threads, serial; default processes). serial only runs once, with -p 1.')
+    args.add_argument('--repeat', dest='repeat', type=int, default=3,
+                      help='Runs of each configuration; the best time is kept (default 3)')
+    args.add_argument('--no-rcp', dest='no_rcp', default=False,
+                      action='store_true',
+                      help='Only run the in-process benchmarks')
+    args.add_argument('--baseline', dest='baseline',
+                      help='JSON results from an earlier --save-baseline run to compare against')
+    args.add_argument('--tolerance', dest='tolerance', type=float,
+                      default=0.1,
+                      help='Slowdown or peak memory growth vs the baseline to flag, as a fraction (default 0.1)')
+    args.add_argument('--save-baseline', dest='save_baseline',
+                      help='Save the results as JSON to this file')
+    args.add_argument('--workdir', dest='workdir',
+                      help='Directory for the synthetic inputs and outputs (default: a temp directory that\'s removed afterwards)')
+    args.add_argument('--seed', dest='seed', type=int, default=0,
+                      help='Random seed for the synthetic DEM (default 0)')
+    args.add_argument('--verbose', dest='verbose', default=False,
+                      action='store_true',
+                      help='Show ParallelRCP()\'s output')
+    arg_dict = vars(args.parse_args())
+
+    method_list = rcp.split_stages(arg_dict['methods'])
+    for method in method_list:
+        if method not in bench_options:
+            args.error('no benchmark options for method {}'.format(method))
+    if 'mdenoise' in method_list and not os.path.isfile(rcp.mdenoise_path):
+        print("Skipping mdenoise: {} not found".format(rcp.mdenoise_path))
+        method_list.remove('mdenoise')
+    chunk_sizes = [int(c) for c in arg_dict['chunks'].split(',')]
+    proc_counts = [int(p) for p in arg_dict['procs'].split(',')]
+    configs = []
+    for backend in arg_dict['backends'].split(','):
+        if backend not in ('processes', 'threads', 'serial'):
+            args.error('unknown backend {}'.format(backend))
+        if backend == 'serial':
+            configs.append((1, backend))
+        else:
+            configs += [(procs, backend) for procs in proc_counts]
+
+    baseline = {}
+    if arg_dict['baseline']:
+        with open(arg_dict['baseline'], 'r') as b:
+            baseline = json.load(b)["results"]
+
+    workdir = arg_dict['workdir'] or tempfile.mkdtemp(prefix='rcp_bench_')
+    os.makedirs(workdir, exist_ok=True)
+
+    gdal.UseExceptions()
+    print("Generating {0} x {0} synthetic DEM in {1}...".format(
+        arg_dict['size'], workdir))
+    paths = make_inputs(workdir, arg_dict['size'], arg_dict['seed'])
+    bench_options["skymodel"]["lum_file"] = paths["lum"]
+
+    results = {}
+    regressions = {}
+    failed = {}
+    print("\n{:<12}{:<30}{:>10}{:>10}{:>12}  {}".format(
+        "method", "mode", "seconds", "Mpx/s", "peak mem", "vs baseline"))
+    try:
+        for method in method_list:
+            options = dict(bench_options[method])
+            in_path = paths["image"] if method == "clahe" else paths["dem"]
+            if rcp.methods[method].prepare:
+                rcp.methods[method].prepare(options)
+
+            # In-process: just the method on one array
+            array = read_input(in_path, arg_dict['inproc_size'])
+            seconds, peak = bench_in_process(method, options, array,
+                                             arg_dict['repeat'])
+            mode = "in-process {}".format(array.shape[0])
+            result = {"method": method, "mode": mode, "seconds": seconds,
+                      "mpx_s": array.size / 1e6 / seconds, "peak": peak}
+            key = "{}|{}".format(method, mode)
+            results[key] = result
+            note, regressions[key] = compare(result, baseline.get(key),
+                                             arg_dict['tolerance'])
+            print_result(result, note)
+            array = None
+
+            if arg_dict['no_rcp']:
+                continue
+
+            # Whole raster through ParallelRCP()
+            pixels = arg_dict['size'] ** 2
+            for chunk_size in chunk_sizes:
+                for procs, backend in configs:
+                    seconds, peak, error = bench_rcp(
+                        method, options, in_path, workdir, chunk_size, procs,
+                        arg_dict['repeat'], backend, arg_dict['verbose'])
+                    mode = "rcp -s {} -p {}".format(chunk_size, procs)
+                    if backend != "processes":
+                        mode += " " + backend
+                    key = "{}|{}".format(method, mode)
+                    if error:
+                        # Left out of the results (and any new baseline)
+                        failed[key] = error
+                        print("{:<12}{:<30}  FAILED: {}".format(method, mode,
+                                                               error))
+                        continue
+                    result = {"method": method, "mode": mode,
+                              "seconds": seconds,
+                              "mpx_s": pixels / 1e6 / seconds, "peak": peak}
+                    results[key] = result
+                    note, regressions[key] = compare(
+                        result, baseline.get(key), arg_dict['tolerance'])
+                    print_result(result, note)
+    finally:
+        if not arg_dict['workdir']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Listed again at the end so they don't scroll by unnoticed (and end up
+    # in the next baseline)
+    flagged = [(key, kinds) for key, kinds in regressions.items() if kinds]
+    if flagged:
+        print("\n{} regressions vs {} (tolerance {:.0f}%):".format(
+            len(flagged), arg_dict['baseline'], 100 * arg_dict['tolerance']))
+        for key, kinds in flagged:
+            print("\t{}: {}".format(key.replace("|", ", "),
+                                    " and ".join(kinds)))
+
+    if failed:
+        print("\n{} configurations failed:".format(len(failed)))
+        for key, error in failed.items():
+            print("\t{}: {}".format(key.replace("|", ", "), error))
+
+    if arg_dict['save_baseline']:
+        with open(arg_dict['save_baseline'], 'w') as b:
+            json.dump({"size": arg_dict['size'],
+                       "inproc_size": arg_dict['inproc_size'],
+                       "machine": platform.node(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "results": results}, b, indent=2)
+        print("\nSaved results to {}{}".format(
+            arg_dict['save_baseline'],
+            ", regressions included" if flagged else ""))
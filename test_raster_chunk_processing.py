@@ -0,0 +1,477 @@
+#*****************************************************************************
+#
+#  Project:  Parallel Raster Chunk Processing
+#  Purpose:  Tests for RCP's run bookkeeping: the journal, manifest claims,
+#            chunk retries and failure reports, and the strip and prefetch
+#            read paths. Everything runs on in-memory arrays; the GDAL
+#            handles are stood in for, so no data files are needed.
+#
+#*****************************************************************************
+# MIT License
+#
+# Copyright (c) 2019 Jacob Adams
+#
+# See LICENSE for the full text.
+#*****************************************************************************
+
+# Usage:
+#   python -m pytest test_raster_chunk_processing.py
+
+
+import datetime
+import json
+import os
+import time
+import threading
+import queue
+
+import numpy as np
+import pytest
+
+# raster_chunk_processing needs GDAL (and numba and skimage) to import at
+# all, even though these tests don't use it
+pytest.importorskip("osgeo")
+import raster_chunk_processing as rcp
+
+
+class FakeSource:
+    '''
+    Stands in for an open GDAL dataset: ReadAsArray() reads a window of a
+    [bands, rows, cols] array, and the windows it was asked for are kept in
+    reads.
+    '''
+
+    def __init__(self, array):
+        self.array = array
+        self.reads = []
+
+    def ReadAsArray(self, x_off, y_off, x_size, y_size):
+        self.reads.append((x_off, y_off, x_size, y_size))
+        window = self.array[:, y_off:y_off + y_size, x_off:x_off + x_size]
+        return window[0].copy() if len(self.array) == 1 else window.copy()
+
+
+def make_run(source, chunk, f2, method="test", retries=0, nodata=-9999.):
+    '''
+    Sets up a worker the way pool_init() would for a run over source (a
+    [bands, rows, cols] array) with a square chunk grid, and returns the
+    run context. Chunks are handed to a plain queue.Queue() instead of a
+    writer.
+    '''
+    bands, rows, cols = source.shape
+    run = rcp.Chunk()
+    run.bands = bands
+    run.rows = rows
+    run.cols = cols
+    run.row_splits = list(range(0, rows, chunk)) + [rows]
+    run.col_splits = list(range(0, cols, chunk)) + [cols]
+    run.total_chunks = ((len(run.row_splits) - 1) *
+                        (len(run.col_splits) - 1))
+    run.f2 = f2
+    run.method = rcp.split_stages(method)
+    run.options = {}
+    run.s_nodata = nodata
+    run.t_nodata = nodata
+    run.outputs = [None]
+    run.compact = None
+    run.scale = 1
+    run.offset = 0
+    run.np_dtype = np.float64
+    run.work_dtype = np.float64
+    run.sparse = False
+    run.tile_dir = None
+    run.retries = retries
+    run.low_memory = False
+    run.prefetch = 0
+    run.start_time = datetime.datetime.now()
+
+    rcp.s_nodata = nodata
+    rcp.verbose = False
+    rcp.write_queue = queue.Queue()
+    rcp.worker.run = run
+    rcp.worker.source_fh = FakeSource(source)
+    rcp.worker.reader_fh = FakeSource(source)
+    rcp.worker.started = None
+    rcp.worker.scratch = None
+    return run
+
+
+def written_chunks():
+    '''
+    Returns the chunks handed to the writer so far, as a dictionary of
+    (x_start, y_start, array) by tile.
+    '''
+    chunks = {}
+    while not rcp.write_queue.empty():
+        tile, x_start, y_start, arrays = rcp.write_queue.get()
+        chunks[tile] = (x_start, y_start, arrays[None])
+    return chunks
+
+
+@pytest.fixture
+def source():
+    return np.arange(3 * 40 * 50, dtype=np.float64).reshape(3, 40, 50)
+
+
+# Journal
+
+def write_journal(path, header, tiles, partial=None):
+    with open(path, 'w') as j:
+        j.write(json.dumps(header) + "\n")
+        for tile in tiles:
+            j.write(json.dumps({"tile": tile}) + "\n")
+        if partial:
+            j.write(partial)
+
+
+def test_read_journal(tmp_path):
+    path = str(tmp_path / "out.tif.journal")
+    header = {"method": "hillshade", "chunk_x": 512, "chunk_y": 512,
+              "f2": 0}
+    write_journal(path, header, ["0-0", "0-1", "1-0"])
+    assert rcp.read_journal(path) == (header, {"0-0", "0-1", "1-0"})
+
+
+def test_read_journal_skips_partial_last_line(tmp_path):
+    # A crash partway through appending a tile
+    path = str(tmp_path / "out.tif.journal")
+    write_journal(path, {"f2": 0}, ["0-0"], partial='{"tile": "0-')
+    assert rcp.read_journal(path)[1] == {"0-0"}
+
+
+def test_read_journal_empty(tmp_path):
+    path = str(tmp_path / "out.tif.journal")
+    open(path, 'w').close()
+    with pytest.raises(ValueError):
+        rcp.read_journal(path)
+
+
+def test_changed_settings(tmp_path):
+    settings = {"method": "TPI", "options": {"radius": 10},
+                "nodata": float("nan"), "compact": [3, -32768, 0.1, 0]}
+    path = str(tmp_path / "out.tif.journal")
+    write_journal(path, dict(settings, chunk_x=512), [])
+    header = rcp.read_journal(path)[0]
+
+    # Tuples come back from the journal as lists, and NaN as NaN
+    assert rcp.changed_settings(
+        header, dict(settings, compact=(3, -32768, 0.1, 0))) == []
+    assert rcp.changed_settings(
+        header, dict(settings, options={"radius": 12})) == ["options"]
+    # Settings the journal doesn't have don't match either
+    assert rcp.changed_settings(header, dict(settings, scale=1)) == ["scale"]
+
+
+def test_plain_json_numpy_options():
+    settings = {"options": {"radius": np.int64(10), "sigma": np.float32(1.5),
+                            "azimuths": np.array([315, 45])}}
+    text = json.dumps(settings, default=rcp.plain_json)
+    assert json.loads(text) == {"options": {"radius": 10, "sigma": 1.5,
+                                            "azimuths": [315, 45]}}
+
+
+# Manifest claims
+
+def test_claim_tile_once(tmp_path):
+    tile_dir = str(tmp_path)
+    assert rcp.claim_tile(tile_dir, "0-0")
+    assert not rcp.claim_tile(tile_dir, "0-0")
+    assert rcp.claim_tile(tile_dir, "0-1")
+    with open(os.path.join(tile_dir, "0-0.claim")) as claim:
+        assert json.load(claim)["pid"] == os.getpid()
+
+
+@pytest.mark.parametrize("marker", [".done", ".failed"])
+def test_claim_tile_finished(tmp_path, marker):
+    tile_dir = str(tmp_path)
+    open(os.path.join(tile_dir, "0-0" + marker), 'w').close()
+    assert not rcp.claim_tile(tile_dir, "0-0")
+    assert not rcp.claim_tile(tile_dir, "0-0", stale_after=0)
+
+
+def make_stale(tile_dir, tile, age=3600):
+    claim_path = os.path.join(tile_dir, tile + ".claim")
+    open(claim_path, 'w').close()
+    then = time.time() - age
+    os.utime(claim_path, (then, then))
+    return claim_path
+
+
+def test_claim_tile_stale_takeover(tmp_path):
+    tile_dir = str(tmp_path)
+    claim_path = make_stale(tile_dir, "0-0")
+    assert not rcp.claim_tile(tile_dir, "0-0")
+    assert not rcp.claim_tile(tile_dir, "0-0", stale_after=7200)
+    assert rcp.claim_tile(tile_dir, "0-0", stale_after=60)
+    # The new claim is ours and fresh, and the old one is gone for good
+    assert time.time() - os.path.getmtime(claim_path) < 60
+    assert os.listdir(tile_dir) == ["0-0.claim"]
+    assert not rcp.claim_tile(tile_dir, "0-0", stale_after=60)
+
+
+def test_claim_tile_stale_takeover_race(tmp_path, monkeypatch):
+    # Another worker takes the stale claim over (and makes a fresh one)
+    # between our finding it stale and renaming it away. We mustn't end up
+    # with its fresh claim.
+    tile_dir = str(tmp_path)
+    claim_path = make_stale(tile_dir, "0-0")
+    rename = os.rename
+
+    def other_worker_first(src, dst):
+        if src == claim_path:
+            os.remove(claim_path)
+            time.sleep(0.01)
+            with open(claim_path, 'w') as claim:
+                claim.write("theirs")
+        rename(src, dst)
+
+    monkeypatch.setattr(rcp.os, "rename", other_worker_first)
+    assert not rcp.claim_tile(tile_dir, "0-0", stale_after=60)
+    monkeypatch.undo()
+    # Their claim is back where it was
+    assert os.listdir(tile_dir) == ["0-0.claim"]
+    with open(claim_path) as claim:
+        assert claim.read() == "theirs"
+
+
+def test_claim_tasks(tmp_path):
+    tile_dir = str(tmp_path)
+    tasks = [[0, 0, 1], [0, 1, 2], [1, 0, 3]]
+    open(os.path.join(tile_dir, "0-1.done"), 'w').close()
+    make_stale(tile_dir, "1-0")
+    assert list(rcp.claim_tasks(tasks, tile_dir)) == [(0, 0, 1)]
+    assert list(rcp.claim_tasks(tasks, tile_dir, stale_after=60)) == [
+        (1, 0, 3)]
+
+
+def test_touch_claims(tmp_path):
+    tile_dir = str(tmp_path)
+    claim_path = make_stale(tile_dir, "0-0")
+    stop = threading.Event()
+    toucher = threading.Thread(target=rcp.touch_claims,
+                               args=(tile_dir, {"0-0", "0-1"}, 0.01, stop))
+    toucher.start()
+    time.sleep(0.1)
+    stop.set()
+    toucher.join()
+    # A claim that's gone (taken over by someone else) is skipped
+    assert time.time() - os.path.getmtime(claim_path) < 60
+    assert not os.path.exists(os.path.join(tile_dir, "0-1.claim"))
+
+
+# Retries and failures
+
+@pytest.fixture
+def fails_big():
+    '''
+    Registers a method that adds 1, but fails on super arrays more than
+    options["limit"] (default 20) pixels across (like mdenoise.exe on big
+    windows), and returns the shapes it was called on.
+    '''
+    shapes = []
+
+    def add_one(in_array, options, tile, f2):
+        shapes.append(in_array.shape)
+        if max(in_array.shape) > options.get("limit", 20):
+            raise RuntimeError("too big")
+        return in_array + 1
+
+    rcp.register_method("fails_big", add_one)
+    yield shapes
+    del rcp.methods["fails_big"]
+
+
+def test_retry_splits_chunk(source, fails_big):
+    make_run(source, 20, 2, "fails_big", retries=2)
+    tile, stats = rcp.RunChunk((1, 1, 1))
+    assert tile == "1-1"
+    assert "error" not in stats
+    # The whole chunk (20 + 2 * 2 across) failed on the first band, then
+    # each of the 3 bands was run in 2 x 2 pieces of 10 + 2 * 2
+    assert fails_big[0] == (24, 24)
+    assert fails_big[1:] == [(14, 14)] * 4 * 3
+    x_start, y_start, result = written_chunks()["1-1"]
+    assert (x_start, y_start) == (20, 20)
+    np.testing.assert_array_equal(result, source[:, 20:40, 20:40] + 1)
+
+
+def test_retry_split_sizes(source, fails_big):
+    # Each retry splits the chunk into 2**attempt pieces along each side,
+    # and the pieces cover it exactly
+    run = make_run(source, 40, 0, "fails_big", retries=3)
+    run.options = {"limit": 10}
+    tile, stats = rcp.RunChunk((0, 0, 1))
+    assert "error" not in stats
+    # A failed attempt stops at its first failure
+    assert fails_big[:2] == [(40, 40), (20, 20)]
+    assert fails_big[2:] == [(10, 10)] * 16 * 3
+    np.testing.assert_array_equal(written_chunks()["0-0"][2],
+                                  source[:, :, :40] + 1)
+
+
+def test_retry_gives_up(source, fails_big):
+    run = make_run(source, 40, 0, "fails_big", retries=1)
+    run.options = {"limit": 10}
+    tile, stats = rcp.RunChunk((0, 0, 1))
+    assert stats["attempts"] == 2
+    assert stats["error"] == "RuntimeError: too big"
+    assert "too big" in stats["traceback"]
+    assert written_chunks() == {}
+
+
+def test_failure_report(tmp_path, source, fails_big):
+    run = make_run(source, 20, 0, "fails_big")
+    run.options = {"limit": 0}
+    failures = [rcp.RunChunk((1, 2, 1))[1]]
+    report_path = str(tmp_path / "out.tif.failed.json")
+    rcp.write_failure_report(report_path, failures, run)
+    with open(report_path) as report:
+        failed, = json.load(report)
+    assert failed["tile"] == "1-2"
+    assert failed["attempts"] == 1
+    assert failed["error"] == "RuntimeError: too big"
+    # The last chunk in the row only goes to the edge of the raster
+    assert (failed["x_start"], failed["x_end"]) == (40, 50)
+    assert (failed["y_start"], failed["y_end"]) == (20, 40)
+
+
+class FakeProcess:
+    def __init__(self, pid, exitcode=None):
+        self.pid = pid
+        self.exitcode = exitcode
+
+
+class FakePool:
+    def __init__(self, processes):
+        self._pool = processes
+
+
+def test_find_lost_work():
+    started = queue.Queue()
+    for tile, pid in [("0-0", 1), ("0-1", 2), ("0-2", 3), ("1-0", 4)]:
+        started.put((tile, pid))
+    # 1 is still working, 2 was killed, 3 exited normally (and its chunk
+    # came back), and the pool already cleaned up after 4
+    pool = FakePool([FakeProcess(1), FakeProcess(2, -9),
+                     FakeProcess(3, 0)])
+    running = {}
+    gone = {}
+    returned = {"0-2"}
+    lost = rcp.find_lost_work(pool, started, running, returned, gone)
+    assert lost == [("0-1", -9)]
+    assert running == {1: "0-0", 4: "1-0"}
+
+    # 4's chunk may still be on its way, for a little while
+    lost = rcp.find_lost_work(pool, started, running, returned, gone,
+                              grace=0)
+    assert lost == [("1-0", None)]
+    assert running == {1: "0-0"}
+
+
+# Strips and prefetching
+
+@pytest.fixture
+def box_sum():
+    '''
+    Registers a method that sums each pixel's 3 x 3 neighborhood (so wrong
+    overlap shows up in the results) and then scribbles over its input,
+    which methods are free to do.
+    '''
+    def box(in_array, options, tile, f2):
+        out = np.zeros_like(in_array)
+        for dy in range(3):
+            for dx in range(3):
+                out[1:-1, 1:-1] += in_array[dy:dy + in_array.shape[0] - 2,
+                                            dx:dx + in_array.shape[1] - 2]
+        in_array[:] = -1
+        return out
+
+    rcp.register_method("box_sum", box)
+    yield
+    del rcp.methods["box_sum"]
+
+
+def pixels_read(source_fh):
+    return sum(y_size * x_size for _, _, x_size, y_size in source_fh.reads)
+
+
+def test_read_window_carry(source):
+    run = make_run(source, 10, 3)
+    source_fh = rcp.worker.source_fh
+    first = rcp.read_window(run, source_fh, 10, 0, 20, 10)
+    carry = (first[:, 10:].copy(), 7)
+    source_fh.reads = []
+    second = rcp.read_window(run, source_fh, 10, 10, 20, 20, carry)
+    np.testing.assert_array_equal(
+        second, rcp.read_block(run, source_fh, 7, 7, 16, 16))
+    # Only the 10 rows below the carried 6 were read
+    assert source_fh.reads[0] == (7, 13, 16, 10)
+
+
+def test_read_window_carry_mismatch(source):
+    # Carried rows of a different width (the last column of chunks) aren't
+    # used
+    run = make_run(source, 10, 3)
+    source_fh = rcp.worker.source_fh
+    carry = (np.zeros((3, 6, 12)), 7)
+    window = rcp.read_window(run, source_fh, 10, 10, 20, 20, carry)
+    assert source_fh.reads == [(7, 7, 16, 16)]
+    np.testing.assert_array_equal(window, source[:, 7:23, 7:23])
+
+
+def test_read_window_core(source):
+    run = make_run(source, 10, 3)
+    source_fh = rcp.worker.source_fh
+    core = rcp.read_block(run, source_fh, 40, 30, 10, 10)
+    window = rcp.read_window(run, source_fh, 40, 30, 50, 40, core=core)
+    plain = rcp.read_window(run, source_fh, 40, 30, 50, 40)
+    np.testing.assert_array_equal(window, plain)
+    # Off the edge of the raster is NoData
+    assert (window[:, -3:] == -9999.).all()
+    assert (window[:, :, -3:] == -9999.).all()
+
+
+def run_each(source, chunk, f2, method):
+    '''
+    Runs every chunk on its own with RunChunk() and returns the chunks
+    written.
+    '''
+    run = make_run(source, chunk, f2, method)
+    for i in range(len(run.row_splits) - 1):
+        for j in range(len(run.col_splits) - 1):
+            rcp.RunChunk((i, j, 1))
+    return written_chunks()
+
+
+@pytest.mark.usefixtures("box_sum")
+def test_run_strip(source):
+    expected = run_each(source, 10, 4, "box_sum")
+    single_read = pixels_read(rcp.worker.source_fh)
+    run = make_run(source, 10, 4, "box_sum")
+    for j in range(len(run.col_splits) - 1):
+        strip = [(i, j, 1) for i in range(len(run.row_splits) - 1)]
+        results = rcp.RunStrip(strip)
+        assert [tile for tile, _ in results] == [
+            "{}-{}".format(i, j) for i, _, _ in strip]
+        assert all("error" not in stats for _, stats in results)
+    chunks = written_chunks()
+    assert chunks.keys() == expected.keys()
+    for tile, (x_start, y_start, result) in expected.items():
+        assert chunks[tile][:2] == (x_start, y_start)
+        np.testing.assert_array_equal(chunks[tile][2], result)
+    assert pixels_read(rcp.worker.source_fh) < single_read
+
+
+@pytest.mark.usefixtures("box_sum")
+def test_run_chunks(source):
+    expected = run_each(source, 10, 2, "box_sum")
+    make_run(source, 10, 2, "box_sum")
+    batch = [(i, j, 1) for i in range(4) for j in range(5)]
+    results = rcp.RunChunks(batch)
+    assert [tile for tile, _ in results] == [
+        "{}-{}".format(i, j) for i, j, _ in batch]
+    # The reads were all done on the reader thread's handle
+    assert rcp.worker.source_fh.reads == []
+    chunks = written_chunks()
+    for tile, (x_start, y_start, result) in expected.items():
+        np.testing.assert_array_equal(chunks[tile][2], result)